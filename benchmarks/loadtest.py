@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end load test of se-leg-ra.
+
+Starts a temporary MongoDB, a local stub of the OP vetting endpoint and the app in gunicorn for every
+combination of worker class and thread count, and drives the proofing views and the health check.
+
+Usage:
+    python benchmarks/loadtest.py --requests 1000 --concurrency 20 --workers 2 \\
+        --worker-class sync,gthread --threads 1,8 --op-latency 0.1
+
+Requires the test requirements and gunicorn (and gevent/eventlet for those worker classes).
+"""
+
+from __future__ import absolute_import
+
+import os
+import ast
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import itertools
+import subprocess
+import threading
+from uuid import uuid4
+from datetime import date, timedelta
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import requests
+from pymongo import MongoClient
+from eduid_userdb.testing import MongoTemporaryInstance
+
+__author__ = 'lundberg'
+
+
+EPPN = 'load-test@localhost'
+ASSURANCE = 'http://www.swamid.se/policy/assurance/al2'
+SUCCESS_MESSAGES = [b'Verifiering mottagen', b'Verifiering sparad']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    """
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    >>> percentile([1, 2, 3, 4], 99)
+    4
+    """
+    if not values:
+        return 0
+    values = sorted(values)
+    index = max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def luhn_checksum_digit(digits):
+    total = 0
+    for i, d in enumerate(reversed(digits)):
+        d = int(d)
+        if i % 2 == 0:
+            d *= 2
+            if d > 9:
+                d -= 9
+        total += d
+    return str((10 - total % 10) % 10)
+
+
+def random_nin():
+    birth_date = date(1950, 1, 1) + timedelta(days=random.randint(0, 20000))
+    digits = '{:%y%m%d}{:03d}'.format(birth_date, random.randint(0, 999))
+    return '{:%Y%m%d}{}{}'.format(birth_date, digits[6:], luhn_checksum_digit(digits))
+
+
+def random_qr_code():
+    return '1' + json.dumps({'token': uuid4().hex, 'nonce': uuid4().hex})
+
+
+def random_digits(n):
+    return ''.join(random.choice('0123456789') for _ in range(n))
+
+
+def proofing_data(**kwargs):
+    data = {
+        'qr_code': random_qr_code(),
+        'nin': random_nin(),
+        'expiry_date': str(date.today() + timedelta(days=365)),
+        'ocular_validation': 'y',
+    }
+    data.update(kwargs)
+    return data
+
+
+SCENARIOS = {
+    '/drivers-license': lambda: proofing_data(reference_number=random_digits(9)),
+    '/passport': lambda: proofing_data(passport_number=random_digits(8)),
+    '/id-card': lambda: proofing_data(card_number=random_digits(10)),
+    '/national-id-card': lambda: proofing_data(card_number=random_digits(8)),
+    '/status/healthy': None,
+}
+
+
+class StubOP(ThreadingMixIn, HTTPServer):
+    """
+    Vetting endpoint stand-in that answers after a configurable latency.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.received = 0
+        super(StubOP, self).__init__(('127.0.0.1', free_port()), StubOPHandler)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/vetting-result'.format(self.server_address[1])
+
+
+class StubOPHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.server.latency)
+        self.server.received += 1
+        status = 400 if random.random() < self.server.error_rate else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_settings(mongo_uri, vetting_endpoint, extra_settings):
+    settings = {
+        'SERVER_NAME': 'localhost',
+        'SECRET_KEY': 'load-test',
+        'DB_URI': mongo_uri,
+        'RA_APP_ID': 'load_test_ra_app',
+        'VETTING_ENDPOINT': vetting_endpoint,
+        'WTF_CSRF_ENABLED': False,
+        'AL2_ASSURANCES': [ASSURANCE],
+        # Every request comes from one RA user and one IP, rate limited requests would be counted as errors
+        'RATE_LIMIT_ENABLED': False,
+    }
+    settings.update(extra_settings)
+    fd, path = tempfile.mkstemp(suffix='.py', prefix='se_leg_ra_load_test_')
+    with os.fdopen(fd, 'w') as f:
+        for key, value in settings.items():
+            f.write('{} = {!r}\n'.format(key, value))
+    return path
+
+
+def start_gunicorn(port, settings_path, workers, worker_class, threads):
+    env = dict(os.environ, SE_LEG_RA_SETTINGS=settings_path)
+    cmd = [sys.executable, '-m', 'gunicorn', '--bind', '127.0.0.1:{}'.format(port), '--workers', str(workers),
+           '--worker-class', worker_class, '--threads', str(threads), '--log-level', 'warning',
+           'se_leg_ra.run:app']
+    process = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL)
+    health_url = 'http://127.0.0.1:{}/status/healthy'.format(port)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited with {}'.format(process.returncode))
+        try:
+            if b'STATUS_OK' in requests.get(health_url, timeout=1).content:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('gunicorn did not become healthy')
+
+
+def run_load(base_url, endpoints, total_requests, concurrency):
+    """
+    :return: Wall clock seconds and a dict of endpoint -> (latencies, errors)
+    :rtype: tuple
+    """
+    local = threading.local()
+    headers = {'EPPN': EPPN, 'ASSURANCE': ASSURANCE}
+    results = defaultdict(lambda: ([], [0]))
+
+    def one_request(endpoint):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        data_factory = SCENARIOS[endpoint]
+        start = time.monotonic()
+        try:
+            if data_factory is None:
+                r = local.session.get(base_url + endpoint, headers=headers)
+                ok = r.status_code == 200 and b'STATUS_OK' in r.content
+            else:
+                r = local.session.post(base_url + endpoint, headers=headers, data=data_factory())
+                ok = r.status_code == 200 and any(message in r.content for message in SUCCESS_MESSAGES)
+        except requests.RequestException:
+            ok = False
+        elapsed = time.monotonic() - start
+        latencies, errors = results[endpoint]
+        latencies.append(elapsed)
+        if not ok:
+            errors[0] += 1
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one_request, itertools.islice(itertools.cycle(endpoints), total_requests)))
+    return time.monotonic() - start, results
+
+
+def report(worker_class, threads, wall_time, results):
+    rows = []
+    print('\nworker_class={} threads={}'.format(worker_class, threads))
+    print('{:<20} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}'.format('endpoint', 'requests', 'errors', 'req/s',
+                                                              'p50 ms', 'p95 ms', 'p99 ms'))
+    for endpoint, (latencies, errors) in sorted(results.items()):
+        row = {
+            'worker_class': worker_class,
+            'threads': threads,
+            'endpoint': endpoint,
+            'requests': len(latencies),
+            'errors': errors[0],
+            'throughput': len(latencies) / wall_time,
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+        }
+        rows.append(row)
+        print('{endpoint:<20} {requests:>8} {errors:>7} {throughput:>9.1f} {p50:>9.1f} {p95:>9.1f} '
+              '{p99:>9.1f}'.format(**row))
+    total = sum(len(latencies) for latencies, _ in results.values())
+    errors = sum(e[0] for _, e in results.values())
+    print('{:<20} {:>8} {:>7} {:>9.1f}'.format('total', total, errors, total / wall_time))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=500, help='Requests per configuration')
+    parser.add_argument('--concurrency', type=int, default=10, help='Concurrent clients')
+    parser.add_argument('--workers', type=int, default=1, help='Gunicorn worker processes')
+    parser.add_argument('--worker-class', default='sync', help='Comma separated gunicorn worker classes')
+    parser.add_argument('--threads', default='1', help='Comma separated thread counts')
+    parser.add_argument('--endpoints', default=','.join(SCENARIOS), help='Comma separated endpoints to drive')
+    parser.add_argument('--op-latency', type=float, default=0.05, help='Seconds the stub OP waits before answering')
+    parser.add_argument('--op-error-rate', type=float, default=0.0, help='Share of requests the stub OP rejects')
+    parser.add_argument('--setting', action='append', default=[],
+                        help='Extra app setting as KEY=python literal, can be repeated. Rate limiting is off '
+                             'unless RATE_LIMIT_ENABLED=True is given.')
+    parser.add_argument('--json', help='Write the results to this file')
+    args = parser.parse_args()
+
+    endpoints = args.endpoints.split(',')
+    for endpoint in endpoints:
+        if endpoint not in SCENARIOS:
+            parser.error('Unknown endpoint {}'.format(endpoint))
+    extra_settings = {}
+    for setting in args.setting:
+        key, value = setting.split('=', 1)
+        extra_settings[key] = ast.literal_eval(value)
+
+    mongo = MongoTemporaryInstance()
+    op = StubOP(latency=args.op_latency, error_rate=args.op_error_rate)
+    threading.Thread(target=op.serve_forever, daemon=True).start()
+    settings_path = write_settings(mongo.uri, op.url, extra_settings)
+    db = MongoClient(mongo.uri)['se_leg_ra']
+    rows = []
+    try:
+        for worker_class, threads in itertools.product(args.worker_class.split(','), args.threads.split(',')):
+            db.users.delete_many({})
+            db.proofing_log.delete_many({})
+            db.users.insert_one({'eppn': EPPN})
+            port = free_port()
+            process = start_gunicorn(port, settings_path, args.workers, worker_class, int(threads))
+            try:
+                wall_time, results = run_load('http://127.0.0.1:{}'.format(port), endpoints, args.requests,
+                                              args.concurrency)
+            finally:
+                process.terminate()
+                process.wait()
+            rows.extend(report(worker_class, threads, wall_time, results))
+    finally:
+        op.shutdown()
+        os.unlink(settings_path)
+        mongo.shutdown()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+from prometheus_client import multiprocess
+
+__author__ = 'lundberg'
+
+
+def child_exit(server, worker):
+    # Remove live gauge values from a worker that has exited
+    multiprocess.mark_process_dead(worker.pid)
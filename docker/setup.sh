@@ -9,5 +9,7 @@ virtualenv -p python3 /ra/env
 cd /ra/src
 /ra/env/bin/pip install -U pip
 /ra/env/bin/pip install -r requirements.txt
-/ra/env/bin/pip install gunicorn
+/ra/env/bin/pip install gunicorn gevent
+# Optional, for brotli compressed static files
+/ra/env/bin/pip install brotli
 
@@ -16,6 +16,8 @@ cfg_file=${cfg_file-"${cfg_dir}/app_config.py"}
 workers=${workers-1}
 worker_class=${worker_class-sync}
 worker_threads=${worker_threads-1}
+# Concurrent requests per worker with worker_class=gevent, Mongo and OP calls yield to other requests
+worker_connections=${worker_connections-100}
 worker_timeout=${worker_timeout-30}
 request_fields_limit=${request_fields_limit-200}
 
@@ -27,16 +29,22 @@ echo "PYTHONPATH=${PYTHONPATH}"
 # version of something is actually running.
 /ra/env/bin/pip freeze
 
-# Copy static files for data volume use
+# Metrics from all workers are aggregated in this directory, it has to be emptied between runs
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR-/tmp/se_leg_ra_metrics}
+rm -rf "${PROMETHEUS_MULTIPROC_DIR}"
+mkdir -p "${PROMETHEUS_MULTIPROC_DIR}"
+chown seleg:seleg "${PROMETHEUS_MULTIPROC_DIR}"
+
+# Build static files for data volume use, with content hashed names, compressed variants and without source maps
 mkdir -p /ra/static
-cp -r /ra/src/se_leg_ra/static/* /ra/static/.
+python -m se_leg_ra.static_assets /ra/src/se_leg_ra/static /ra/static
 
 extra_args=""
 if [ -d "/opt/se-leg/se-leg-ra/se_leg_ra/" ]; then
     # developer mode, restart on code changes
     extra_args="--reload"
-    # Copy static files for data volume use
-    cp -r /opt/se-leg/se-leg-ra/se_leg_ra/static/* /ra/static/.
+    # Build static files for data volume use
+    python -m se_leg_ra.static_assets /opt/se-leg/se-leg-ra/se_leg_ra/static /ra/static
 fi
 
 echo ""
@@ -50,9 +58,11 @@ exec start-stop-daemon --start -c seleg:seleg --exec \
      --pidfile "/var/run/${app_name}.pid" \
      --user=seleg --group=seleg -- \
      --bind 0.0.0.0:5000 \
+     --config "${project_dir}/docker/gunicorn_config.py" \
      --chdir "/tmp" \
      --workers ${workers} --worker-class ${worker_class} \
      --threads ${worker_threads} --timeout ${worker_timeout} \
+     --worker-connections ${worker_connections} \
      --capture-output \
      --limit-request-fields ${request_fields_limit} \
      ${extra_args} se_leg_ra.run:app
@@ -2,12 +2,25 @@
 
 from __future__ import absolute_import
 
-import logging
+from threading import Thread
 from flask import Flask, current_app
 from werkzeug.contrib.fixers import ProxyFix
 from flask_wtf.csrf import CSRFProtect
-from se_leg_ra.db import UserDB, ProofingLog
+from se_leg_ra.db import UserDB, ProofingLog, ProofingStatsDB
+from se_leg_ra.pool_monitor import init_pool_monitor
+from se_leg_ra.store import init_store
+from se_leg_ra.nonce_cache import NonceCache
+from se_leg_ra.idempotency import IdempotencyCache
 from se_leg_ra.utils import urlappend
+from se_leg_ra.vetting import VettingClient
+from se_leg_ra.circuit_breaker import CircuitBreaker
+from se_leg_ra.outbox import OutboxWorker
+from se_leg_ra.commands import init_commands
+from se_leg_ra.metrics import init_metrics
+from se_leg_ra.log import init_logging
+from se_leg_ra.health import init_health_prober
+from se_leg_ra.templating import init_template_cache
+from se_leg_ra.static_assets import load_manifest
 from se_leg_ra.middleware import LocalhostMiddleware
 
 
@@ -17,25 +30,47 @@ __author__ = 'lundberg'
 SE_LEG_RA_SETTINGS_ENVVAR = 'SE_LEG_RA_SETTINGS'
 
 
-def init_logging(app):
-    out_handler = logging.StreamHandler()
-    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    out_handler.setFormatter(formatter)
-    out_handler.setLevel(logging.DEBUG)
-    app.logger.addHandler(out_handler)
-    return app
-
-
 def init_template_functions(app):
 
+    app.static_manifest = {}
+    if app.config.get('STATIC_MANIFEST'):
+        try:
+            app.static_manifest = load_manifest(app.config['STATIC_MANIFEST'])
+        except (IOError, ValueError) as e:
+            app.logger.error('Could not load static manifest: %s', e)
+
     @app.template_global()
     def static_url_for(f):
         static_url = current_app.config.get('STATIC_URL', '/static/')
-        return urlappend(static_url, f)
+        return urlappend(static_url, current_app.static_manifest.get(f, f))
 
     return app
 
 
+def setup_indexes(app, force=False):
+    for db in [app.user_db, app.proofing_log, app.proofing_stats]:
+        if db is None:
+            continue
+        if db.ensure_indexes(force=force):
+            app.logger.info('%r indexes set up', db)
+        else:
+            app.logger.debug('%r indexes already up to date', db)
+
+
+def init_indexes(app):
+    mode = app.config['DB_INDEX_SETUP']
+    if mode == 'startup':
+        setup_indexes(app)
+    elif mode == 'background':
+        def _setup_indexes():
+            try:
+                setup_indexes(app)
+            except Exception as e:
+                app.logger.error('Index setup failed: %s', e)
+        Thread(target=_setup_indexes, name='index-setup', daemon=True).start()
+    return app
+
+
 def init_se_leg_ra_app(name=None, config=None):
     """
     :param name: The name of the instance, it will affect the configuration loaded.
@@ -65,8 +100,10 @@ def init_se_leg_ra_app(name=None, config=None):
     # Init other
     app.wsgi_app = ProxyFix(app.wsgi_app)
     app.url_map.strict_slashes = False
-    CSRFProtect(app)
+    csrf = CSRFProtect(app)
     app = init_template_functions(app)
+    app = init_commands(app)
+    app = init_metrics(app)
     app.wsgi_app = LocalhostMiddleware(app.wsgi_app, server_name=app.config['SERVER_NAME'])
 
     # Register views
@@ -74,15 +111,86 @@ def init_se_leg_ra_app(name=None, config=None):
     app.register_blueprint(se_leg_ra_views)
     from se_leg_ra.views.status import status_views
     app.register_blueprint(status_views)
+    from se_leg_ra.views.audit import audit_views
+    app.register_blueprint(audit_views)
+    from se_leg_ra.views.api import api_views
+    # Only accepts JSON, see the view
+    csrf.exempt(api_views)
+    app.register_blueprint(api_views)
+
+    # Init template caches after all templates are registered
+    app = init_template_cache(app)
 
     # Init db
-    app.user_db = UserDB(db_uri=app.config['DB_URI'])
+    app = init_pool_monitor(app)
+    app.user_db = UserDB(db_uri=app.config['DB_URI'], cache_size=app.config['WHITELIST_CACHE_SIZE'],
+                         cache_ttl=app.config['WHITELIST_CACHE_TTL'],
+                         cache_negative_ttl=app.config['WHITELIST_CACHE_NEGATIVE_TTL'],
+                         cache_version_check_interval=app.config['WHITELIST_CACHE_VERSION_CHECK_INTERVAL'],
+                         mongo_options=app.config['USER_DB_MONGO_OPTIONS'],
+                         whitelist_read_preference=app.config['WHITELIST_READ_PREFERENCE'])
     app.logger.info('user_db initialized')
-    app.user_db.setup_indexes({'index-eppn': {'key': [('eppn', 1)], 'unique': True, 'background': True}, })
-    app.logger.info('user_db indexing started')
 
-    app.proofing_log = ProofingLog(db_uri=app.config['DB_URI'])
+    # Init caches for QR code nonces and submitted forms
+    app = init_store(app)
+    app.nonce_cache = None
+    if app.config['QR_NONCE_CACHE_ENABLED']:
+        app.nonce_cache = NonceCache(app.store, ttl=app.config['QR_NONCE_CACHE_TTL'])
+        app.logger.info('nonce_cache initialized')
+    app.idempotency_cache = None
+    if app.config['IDEMPOTENCY_ENABLED']:
+        app.idempotency_cache = IdempotencyCache(app.store, ttl=app.config['IDEMPOTENCY_TTL'],
+                                                 in_progress_ttl=app.config['IDEMPOTENCY_IN_PROGRESS_TTL'],
+                                                 wait=app.config['IDEMPOTENCY_WAIT'])
+        app.logger.info('idempotency_cache initialized')
+
+    app.proofing_stats = None
+    if app.config['PROOFING_STATS_ENABLED']:
+        app.proofing_stats = ProofingStatsDB(db_uri=app.config['DB_URI'],
+                                             mongo_options=app.config['PROOFING_LOG_MONGO_OPTIONS'])
+        app.logger.info('proofing_stats initialized')
+    app.proofing_log = ProofingLog(db_uri=app.config['DB_URI'],
+                                   group_commit=app.config['PROOFING_LOG_GROUP_COMMIT'],
+                                   group_commit_window=app.config['PROOFING_LOG_GROUP_COMMIT_WINDOW'],
+                                   group_commit_max_docs=app.config['PROOFING_LOG_GROUP_COMMIT_MAX_DOCS'],
+                                   compact=app.config['PROOFING_LOG_COMPACT'],
+                                   legacy_documents=app.config['PROOFING_LOG_LEGACY_DOCUMENTS'],
+                                   mongo_options=app.config['PROOFING_LOG_MONGO_OPTIONS'],
+                                   stats=app.proofing_stats)
     app.logger.info('proofing_log initialized')
 
-    app.logger.info('{!s} initialized'.format(name))
+    # Init vetting endpoint client
+    app.vetting_client = VettingClient(app.config['VETTING_ENDPOINT'], app.config['RA_APP_SECRET'],
+                                       connect_timeout=app.config['VETTING_CONNECT_TIMEOUT'],
+                                       read_timeout=app.config['VETTING_READ_TIMEOUT'],
+                                       retries=app.config['VETTING_RETRIES'],
+                                       backoff_factor=app.config['VETTING_RETRY_BACKOFF_FACTOR'],
+                                       pool_connections=app.config['VETTING_POOL_CONNECTIONS'],
+                                       pool_maxsize=app.config['VETTING_POOL_MAXSIZE'])
+    app.logger.info('vetting_client initialized')
+    app.vetting_circuit_breaker = None
+    if app.config['VETTING_CIRCUIT_BREAKER_ENABLED']:
+        probe_timeout = app.config['VETTING_CONNECT_TIMEOUT'] + app.config['VETTING_READ_TIMEOUT'] + 1
+        app.vetting_circuit_breaker = CircuitBreaker(app.store, 'vetting',
+                                                     failure_threshold=app.config['VETTING_CIRCUIT_FAILURE_THRESHOLD'],
+                                                     window=app.config['VETTING_CIRCUIT_FAILURE_WINDOW'],
+                                                     slow_call_time=app.config['VETTING_CIRCUIT_SLOW_CALL_TIME'],
+                                                     reset_timeout=app.config['VETTING_CIRCUIT_RESET_TIMEOUT'],
+                                                     probe_timeout=probe_timeout)
+        app.logger.info('vetting_circuit_breaker initialized')
+
+    # Init outbox worker
+    app.outbox_worker = None
+    if app.config['VETTING_OUTBOX_ENABLED'] and app.config['VETTING_OUTBOX_WORKER_THREAD']:
+        app.outbox_worker = OutboxWorker(app)
+        app.outbox_worker.start()
+        app.logger.info('outbox_worker started')
+
+    # Init db indexes
+    app = init_indexes(app)
+
+    # Init health checks
+    app = init_health_prober(app)
+
+    app.logger.info('%s initialized', name)
     return app
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+__author__ = 'lundberg'
+
+
+class TTLCache(object):
+    """
+    Bounded, thread safe LRU cache where every entry has its own time to live.
+
+    The cache can be tied to an external version stamp, if the stamp changes all entries are dropped.
+    """
+
+    def __init__(self, max_size=1000, version_check_interval=None, version_getter=None):
+        """
+        :param max_size: Maximum number of entries, the least recently used entry is evicted when full
+        :param version_check_interval: Seconds between checks of the version stamp
+        :param version_getter: Callable returning the current version stamp
+
+        :type max_size: int
+        :type version_check_interval: int | float | None
+        :type version_getter: callable | None
+        """
+        self.max_size = max_size
+        self.version_check_interval = version_check_interval
+        self.version_getter = version_getter
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self._version = None
+        self._version_checked_ts = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def _check_version(self):
+        if self.version_getter is None or self.version_check_interval is None:
+            return
+        now = time.monotonic()
+        if now - self._version_checked_ts < self.version_check_interval:
+            return
+        self._version_checked_ts = now
+        version = self.version_getter()
+        if self._version is None:
+            self._version = version
+        elif version != self._version:
+            with self._lock:
+                if self._data:
+                    self.invalidations += 1
+                self._data.clear()
+            self._version = version
+
+    def get(self, key):
+        """
+        :param key: Cache key
+        :type key: collections.Hashable
+
+        :return: Tuple of (found, value)
+        :rtype: tuple
+        """
+        if self.max_size <= 0:
+            self.misses += 1
+            return False, None
+        self._check_version()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_ts = item
+                if expires_ts > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._data[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value, ttl):
+        """
+        :param key: Cache key
+        :param value: Value to cache
+        :param ttl: Seconds until the entry expires
+
+        :type key: collections.Hashable
+        :type value: object
+        :type ttl: int | float
+        """
+        if self.max_size <= 0 or ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.invalidations += 1
+        # Force a version check on next lookup
+        self._version_checked_ts = 0
+
+    @property
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""
+Circuit breaker for calls to a remote service, the state is kept in a store shared by the workers.
+
+closed: calls are made, failed and slow calls are counted in a window of window seconds
+open: failure_threshold failures were counted, calls fail fast for reset_timeout seconds
+half_open: one probe call at a time is let through, a successful probe closes the circuit and a failed probe
+           opens it again
+"""
+
+from se_leg_ra.metrics import CIRCUIT_BREAKER_TRANSITIONS_TOTAL
+
+__author__ = 'lundberg'
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, store, name, failure_threshold=5, window=60, slow_call_time=5, reset_timeout=30,
+                 probe_timeout=15):
+        """
+        :param store: Store shared by the workers, see se_leg_ra.store
+        :param name: Name of the remote service
+        :param failure_threshold: Number of failed or slow calls within window that opens the circuit
+        :param window: Seconds failures are counted
+        :param slow_call_time: Calls taking longer than this many seconds count as failures
+        :param reset_timeout: Seconds the circuit stays open before a probe call is let through
+        :param probe_timeout: Seconds before another probe call is let through if a probe never finishes
+
+        :type name: str
+        :type failure_threshold: int
+        :type window: int | float
+        :type slow_call_time: int | float
+        :type reset_timeout: int | float
+        :type probe_timeout: int | float
+        """
+        self.store = store
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.slow_call_time = slow_call_time
+        self.reset_timeout = reset_timeout
+        self.probe_timeout = probe_timeout
+
+    def _key(self, part):
+        return 'circuit:{}:{}'.format(self.name, part)
+
+    def _transition(self, state):
+        CIRCUIT_BREAKER_TRANSITIONS_TOTAL.labels(self.name, state).inc()
+
+    @property
+    def state(self):
+        """
+        :return: closed, open or half_open
+        :rtype: str
+        """
+        if self.store.get(self._key('open')) is not None:
+            return OPEN
+        if self.store.get(self._key('tripped')) is not None:
+            return HALF_OPEN
+        return CLOSED
+
+    def allow(self):
+        """
+        :return: True if a call should be made, every allowed call must be followed by record_success,
+                 record_failure or release
+        :rtype: bool
+        """
+        state = self.state
+        if state == OPEN:
+            return False
+        if state == HALF_OPEN:
+            # Only one probe call at a time
+            return self.store.add(self._key('probe'), True, self.probe_timeout)
+        return True
+
+    def release(self):
+        """
+        Gives back an allowed call that was never made, so that a half open circuit lets another probe through.
+        """
+        if self.state == HALF_OPEN:
+            self.store.delete(self._key('probe'))
+
+    def _open(self):
+        self.store.set(self._key('open'), True, self.reset_timeout)
+        # Kept until a probe call succeeds, the circuit is half open when the open key has expired
+        self.store.set(self._key('tripped'), True, max(self.reset_timeout * 100, 86400))
+        self.store.delete(self._key('failures'))
+        self.store.delete(self._key('probe'))
+        self._transition(OPEN)
+
+    def record_success(self, elapsed):
+        """
+        :param elapsed: Seconds the call took
+        :type elapsed: float
+        """
+        if elapsed > self.slow_call_time:
+            self.record_failure()
+            return
+        if self.store.get(self._key('tripped')) is not None:
+            self.store.delete(self._key('tripped'))
+            self.store.delete(self._key('probe'))
+            self._transition(CLOSED)
+
+    def record_failure(self):
+        if self.store.get(self._key('tripped')) is not None:
+            # A failed probe call
+            self._open()
+            return
+        if self.store.incr(self._key('failures'), 1, self.window) >= self.failure_threshold:
+            self._open()
+
+    @property
+    def stats(self):
+        """
+        :return: Circuit breaker state
+        :rtype: dict
+        """
+        return {
+            'state': self.state,
+            'failures': self.store.get(self._key('failures')) or 0,
+            'failure_threshold': self.failure_threshold,
+        }
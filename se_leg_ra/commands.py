@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import click
+from datetime import datetime
+from se_leg_ra.outbox import run_outbox_worker
+from se_leg_ra.export import export_to_file, EXPORT_FORMATS, MASKABLE_FIELDS
+from se_leg_ra.utils import parse_datetime, load_whitelist
+
+__author__ = 'lundberg'
+
+
+def init_commands(app):
+    """
+    Register management commands, run them with FLASK_APP=se_leg_ra.run flask <command>.
+    """
+
+    @app.cli.command('outbox-worker')
+    def outbox_worker():
+        """Deliver pending proofings to the vetting endpoint."""
+        run_outbox_worker(app)
+
+    @app.cli.command('setup-indexes')
+    @click.option('--force', is_flag=True, help='Set up indexes even if they are at the current version.')
+    def setup_indexes_command(force):
+        """Create or update the database indexes."""
+        from se_leg_ra.app import setup_indexes
+        setup_indexes(app, force=force)
+
+    @app.cli.command('proofing-log-size-report')
+    @click.option('--sample-size', default=1000, help='Number of documents to compare.')
+    def proofing_log_size_report(sample_size):
+        """Compare proofing log document sizes in the original and the compact format."""
+        report = app.proofing_log.size_report(sample_size=sample_size)
+        click.echo('Documents: {count}, data size: {size} bytes, storage size: {storage_size} bytes, '
+                   'average document size: {avg_obj_size} bytes'.format(**report))
+        if report['sampled']:
+            original, compact = report['sampled_original_size'], report['sampled_compact_size']
+            click.echo('Sampled {} documents ({} already compact)'.format(report['sampled'],
+                                                                          report['sampled_compact']))
+            click.echo('Original format: {} bytes, {:.1f} bytes/document'.format(original,
+                                                                                 original / report['sampled']))
+            click.echo('Compact format: {} bytes, {:.1f} bytes/document ({:.1%} of original)'.format(
+                compact, compact / report['sampled'], compact / original))
+
+    @app.cli.command('compact-proofing-log')
+    @click.option('--batch-size', default=500, help='Number of documents per bulk write.')
+    def compact_proofing_log(batch_size):
+        """Rewrite proofing log documents in the original format to the compact format."""
+        count = app.proofing_log.compact_documents(batch_size=batch_size)
+        click.echo('Rewrote {} documents'.format(count))
+
+    @app.cli.command('sync-whitelist')
+    @click.argument('path')
+    @click.option('--dry-run', is_flag=True, help='Only show the changes.')
+    @click.option('--batch-size', default=500, help='Max number of operations per bulk write.')
+    def sync_whitelist(path, dry_run, batch_size):
+        """Make the whitelist match the eppns in a CSV or JSON file."""
+        eppns = load_whitelist(path)
+        result = app.user_db.sync_whitelist(eppns, dry_run=dry_run, batch_size=batch_size)
+        for eppn in result['added']:
+            click.echo('+ {}'.format(eppn))
+        for eppn in result['removed']:
+            click.echo('- {}'.format(eppn))
+        click.echo('{}{} added, {} removed, {} unchanged'.format('Dry run: ' if dry_run else '',
+                                                                 len(result['added']), len(result['removed']),
+                                                                 result['unchanged']))
+
+    def _datetime_option(ctx, param, value):
+        try:
+            return parse_datetime(value) if value else None
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+
+    @app.cli.command('export-proofings')
+    @click.argument('output')
+    @click.option('--format', 'fmt', type=click.Choice(EXPORT_FORMATS), default='ndjson', help='Output format.')
+    @click.option('--gzip', 'compress', is_flag=True, help='Gzip compress the output.')
+    @click.option('--mask', multiple=True, type=click.Choice(MASKABLE_FIELDS), help='Field to mask.')
+    @click.option('--created-after', callback=_datetime_option, help='YYYY-MM-DD[THH:MM:SS] (UTC), inclusive.')
+    @click.option('--created-before', callback=_datetime_option, help='YYYY-MM-DD[THH:MM:SS] (UTC), exclusive.')
+    @click.option('--batch-size', default=1000, help='Number of documents read per query.')
+    @click.option('--resume', is_flag=True, help='Continue an interrupted export to OUTPUT with its options.')
+    def export_proofings(output, fmt, compress, mask, created_after, created_before, batch_size, resume):
+        """Export the proofing log to OUTPUT."""
+        try:
+            count = export_to_file(app.proofing_log, output, fmt=fmt, compress=compress, mask=mask,
+                                   created_after=created_after, created_before=created_before,
+                                   batch_size=batch_size, resume=resume)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        click.echo('Exported {} proofings to {}'.format(count, output))
+
+    @app.cli.command('backfill-proofing-stats')
+    @click.option('--until', callback=_datetime_option,
+                  help='YYYY-MM-DD (UTC), exclusive, the day the statistics were enabled. Default today.')
+    def backfill_proofing_stats(until):
+        """Build the proofing statistics from the proofing log."""
+        if app.proofing_stats is None:
+            raise click.ClickException('PROOFING_STATS_ENABLED is not set')
+        if until is None:
+            until = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        # Counts of days before until are replaced, the counts from then on are kept up to date by the app
+        count = app.proofing_stats.set_counts(app.proofing_log.daily_counts(until=until))
+        click.echo('Wrote {} daily counts'.format(count))
+
+    return app
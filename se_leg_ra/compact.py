@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact storage format for proofing log documents.
+
+Version 2 documents use short keys, encode the proofing method and version as integers, store the expiry
+date as an integer (YYYYMMDD) and the opaque QR data compressed. Documents without a version are in the
+original format, as written by ProofingLogElement.to_dict().
+
+    {
+        'v': 2,
+        'ts': created_ts,
+        'cb': created_by,
+        'vb': verified_by,
+        'n': nin,
+        'di': reference_number, passport_number or card_number depending on the proofing method,
+        'o': compressed opaque,
+        'ov': ocular_validation,
+        'ed': 20181231,
+        'm': 1,
+        'pv': 1,
+    }
+"""
+
+import zlib
+from datetime import datetime
+from bson.binary import Binary
+
+__author__ = 'lundberg'
+
+
+COMPACT_VERSION = 2
+
+# Never change the order of these lists, only append
+PROOFING_METHODS = ['drivers_license', 'passport', 'id_card', 'national_id_card']
+PROOFING_VERSIONS = ['2018v1']
+
+DOCUMENT_IDENTIFIER_KEYS = {
+    'drivers_license': 'reference_number',
+    'passport': 'passport_number',
+    'id_card': 'card_number',
+    'national_id_card': 'card_number',
+}
+
+COMPACT_KEYS = {
+    'created_ts': 'ts',
+    'created_by': 'cb',
+    'verified_by': 'vb',
+    'nin': 'n',
+    'opaque': 'o',
+    'ocular_validation': 'ov',
+    'expiry_date': 'ed',
+    'proofing_method': 'm',
+    'proofing_version': 'pv',
+}
+EXPANDED_KEYS = {value: key for key, value in COMPACT_KEYS.items()}
+
+# Opaque data format markers
+_OPAQUE_RAW = b'\x00'
+_OPAQUE_ZLIB = b'\x01'
+# Preset dictionary with the parts common to all QR codes
+_OPAQUE_ZDICT = b'1{"token":"","nonce":""}{"nonce":"","token":""}'
+
+
+def compress_opaque(opaque):
+    """
+    >>> decompress_opaque(compress_opaque('1{"token":"a_token","nonce":"a_nonce"}'))
+    '1{"token":"a_token","nonce":"a_nonce"}'
+    """
+    data = opaque.encode('utf-8')
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, _OPAQUE_ZDICT)
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) < len(data):
+        return Binary(_OPAQUE_ZLIB + compressed)
+    return Binary(_OPAQUE_RAW + data)
+
+
+def decompress_opaque(value):
+    value = bytes(value)
+    if value[:1] == _OPAQUE_ZLIB:
+        decompressor = zlib.decompressobj(-15, _OPAQUE_ZDICT)
+        data = decompressor.decompress(value[1:]) + decompressor.flush()
+    else:
+        data = value[1:]
+    return data.decode('utf-8')
+
+
+def _encode_enum(value, values):
+    try:
+        return values.index(value) + 1
+    except ValueError:
+        # Unknown values are stored as they are
+        return value
+
+
+def _decode_enum(value, values):
+    if isinstance(value, int):
+        return values[value - 1]
+    return value
+
+
+def encode_expiry_date(expiry_date):
+    """
+    >>> encode_expiry_date(datetime(2018, 12, 31))
+    20181231
+    """
+    return expiry_date.year * 10000 + expiry_date.month * 100 + expiry_date.day
+
+
+def decode_expiry_date(value):
+    """
+    >>> decode_expiry_date(20181231)
+    datetime.datetime(2018, 12, 31, 0, 0)
+    """
+    if isinstance(value, int):
+        return datetime(value // 10000, value // 100 % 100, value % 100)
+    return value
+
+
+def encode_value(key, value):
+    """
+    :param key: Key in the original format
+    :param value: Value in the original format
+    :return: Value in the compact format
+    """
+    if key == 'proofing_method':
+        return _encode_enum(value, PROOFING_METHODS)
+    if key == 'proofing_version':
+        return _encode_enum(value, PROOFING_VERSIONS)
+    if key == 'expiry_date' and value is not None:
+        return encode_expiry_date(value)
+    if key == 'opaque' and value is not None:
+        return compress_opaque(value)
+    return value
+
+
+def decode_value(key, value):
+    """
+    :param key: Key in the original format
+    :param value: Value in the compact format
+    :return: Value in the original format
+    """
+    if key == 'proofing_method':
+        return _decode_enum(value, PROOFING_METHODS)
+    if key == 'proofing_version':
+        return _decode_enum(value, PROOFING_VERSIONS)
+    if key == 'expiry_date' and value is not None:
+        return decode_expiry_date(value)
+    if key == 'opaque' and value is not None:
+        return decompress_opaque(value)
+    return value
+
+
+def is_compact(doc):
+    return doc.get('v') == COMPACT_VERSION
+
+
+def compact_document(doc):
+    """
+    :param doc: Proofing log document in the original format
+    :type doc: dict
+    :return: Proofing log document in the compact format
+    :rtype: dict
+    """
+    if is_compact(doc):
+        return doc
+    compact = {'v': COMPACT_VERSION}
+    identifier_key = DOCUMENT_IDENTIFIER_KEYS.get(doc.get('proofing_method'))
+    for key, value in doc.items():
+        if key in COMPACT_KEYS:
+            compact[COMPACT_KEYS[key]] = encode_value(key, value)
+        elif key == identifier_key:
+            compact['di'] = value
+        else:
+            compact[key] = value
+    return compact
+
+
+def expand_document(doc):
+    """
+    :param doc: Proofing log document in any format
+    :type doc: dict
+    :return: Proofing log document in the original format
+    :rtype: dict
+    """
+    if not is_compact(doc):
+        return doc
+    expanded = {}
+    for key, value in doc.items():
+        if key == 'v':
+            continue
+        if key in EXPANDED_KEYS:
+            expanded[EXPANDED_KEYS[key]] = decode_value(EXPANDED_KEYS[key], value)
+        elif key != 'di':
+            expanded[key] = value
+    if 'di' in doc:
+        expanded[DOCUMENT_IDENTIFIER_KEYS[expanded['proofing_method']]] = doc['di']
+    return expanded
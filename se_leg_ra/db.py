@@ -1,23 +1,187 @@
 # -*- coding: utf-8 -*-
 
+import copy
+import json
+import hashlib
+from collections import Counter
+from datetime import datetime, timedelta
+from six.moves.urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from threading import Lock, Event
+from bson import BSON, ObjectId
+from pymongo import ReturnDocument, ReplaceOne, InsertOne, DeleteMany, UpdateOne, ReadPreference
+from pymongo.read_preferences import read_pref_mode_from_name, make_read_preference
+from pymongo.errors import BulkWriteError, WriteError, PyMongoError
 from eduid_userdb.db import BaseDB
 from eduid_userdb.logs.element import LogElement
+from se_leg_ra.cache import TTLCache
+from se_leg_ra.compact import COMPACT_KEYS, compact_document, expand_document, encode_value, decode_value
+from se_leg_ra.metrics import WHITELIST_LOOKUP_SECONDS, WHITELIST_CACHE_TOTAL, USER_UPDATE_SECONDS
+from se_leg_ra.metrics import PROOFING_LOG_SAVE_SECONDS, PROOFING_STATS_ERRORS_TOTAL, OUTCOME_SUCCESS
 
 __author__ = 'lundberg'
 
 
+META_COLLECTION = 'meta'
+HEALTH_COLLECTION = 'health'
+
+# Delivery states of proofings sent to the vetting endpoint by the outbox worker
+DELIVERY_PENDING = 'pending'
+DELIVERY_SENT = 'sent'
+DELIVERY_FAILED = 'failed'
+
+# Proofing statistics outcomes, besides the vetting endpoint outcomes in se_leg_ra.metrics
+STATS_SAVED = 'saved'
+STATS_DELIVERY_FAILED = 'delivery_failed'
+STATS_DAY_FORMAT = '%Y-%m-%d'
+
+
+def mongo_uri(db_uri, options=None):
+    """
+    :param db_uri: MongoDB URI
+    :param options: Connection options, see the pymongo MongoClient documentation, that replace the URI options
+
+    :type db_uri: str
+    :type options: dict | None
+
+    :return: MongoDB URI with the options
+    :rtype: str
+
+    >>> mongo_uri('mongodb://localhost:27017/?replicaSet=rs0', {'maxPoolSize': 20})
+    'mongodb://localhost:27017/?replicaSet=rs0&maxPoolSize=20'
+    """
+    if not options:
+        return db_uri
+    parts = urlsplit(db_uri)
+    query = [(key, value) for key, value in parse_qsl(parts.query) if key not in options]
+    query.extend(sorted((key, str(value)) for key, value in options.items()))
+    return urlunsplit((parts.scheme, parts.netloc, parts.path or '/', urlencode(query), parts.fragment))
+
+
+def attributes_digest(user):
+    """
+    :param user: user data
+    :type user: dict
+    :return: Digest of the user attributes
+    :rtype: six.string_type
+    """
+    data = json.dumps(user, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
 class BaseSeLegDB(BaseDB):
 
+    # Bump INDEX_VERSION when INDEXES is changed, indexes not in INDEXES are dropped
+    INDEXES = {}
+    INDEX_VERSION = 0
+    # Set when INDEXES depends on the configuration, the indexes are set up again when it changes
+    INDEX_FORMAT = None
+
     def __repr__(self):
         return '<se-leg {!s}: {!s} {!r}>'.format(self.__class__.__name__,
                                                  self._db.sanitized_uri,
                                                  self._coll_name)
 
+    @property
+    def _meta_coll(self):
+        return self._coll.database[META_COLLECTION]
+
+    def get_collection_version(self):
+        """
+        Version stamp that is bumped every time the collection content is changed by the application.
+
+        :return: Version number
+        :rtype: int
+        """
+        doc = self._meta_coll.find_one({'_id': self._coll_name}, projection={'version': True})
+        if doc:
+            return doc.get('version', 0)
+        return 0
+
+    def bump_collection_version(self):
+        self._meta_coll.update_one({'_id': self._coll_name}, {'$inc': {'version': 1}}, upsert=True)
+
+    def ensure_indexes(self, force=False):
+        """
+        Set up the collection indexes unless they already are at INDEX_VERSION and INDEX_FORMAT.
+
+        :param force: Set up the indexes regardless of the stored index version
+        :type force: bool
+        :return: True if the indexes were set up
+        :rtype: bool
+        """
+        if not force:
+            doc = self._meta_coll.find_one({'_id': self._coll_name},
+                                           projection={'index_version': True, 'index_format': True})
+            if doc and doc.get('index_version', 0) >= self.INDEX_VERSION and \
+                    doc.get('index_format') == self.INDEX_FORMAT:
+                return False
+        # setup_indexes modifies the index parameters
+        self.setup_indexes(copy.deepcopy(self.INDEXES))
+        self._meta_coll.update_one({'_id': self._coll_name},
+                                   {'$set': {'index_version': self.INDEX_VERSION, 'index_format': self.INDEX_FORMAT}},
+                                   upsert=True)
+        return True
+
+    def _drop_whole_collection(self):
+        super(BaseSeLegDB, self)._drop_whole_collection()
+        self._meta_coll.delete_one({'_id': self._coll_name})
+
 
 class UserDB(BaseSeLegDB):
 
-    def __init__(self, db_uri, db_name='se_leg_ra', collection='users'):
-        super(UserDB, self).__init__(db_uri, db_name, collection=collection)
+    INDEXES = {
+        'index-eppn': {'key': [('eppn', 1)], 'unique': True, 'background': True},
+    }
+    INDEX_VERSION = 1
+
+    def __init__(self, db_uri, db_name='se_leg_ra', collection='users', cache_size=0, cache_ttl=300,
+                 cache_negative_ttl=30, cache_version_check_interval=10, mongo_options=None,
+                 whitelist_read_preference='primary'):
+        """
+        :param cache_size: Max number of cached whitelist lookups, 0 disables the cache
+        :param cache_ttl: Seconds a whitelisted eppn is cached
+        :param cache_negative_ttl: Seconds a not whitelisted eppn is cached
+        :param cache_version_check_interval: Seconds between checks of the collection version stamp
+        :param mongo_options: Connection pool options, see mongo_uri
+        :param whitelist_read_preference: Read preference mode for whitelist lookups
+
+        :type cache_size: int
+        :type cache_ttl: int
+        :type cache_negative_ttl: int
+        :type cache_version_check_interval: int
+        :type mongo_options: dict | None
+        :type whitelist_read_preference: str
+        """
+        super(UserDB, self).__init__(mongo_uri(db_uri, mongo_options), db_name, collection=collection)
+        # Whitelist lookups may be served by secondaries, everything else uses the primary
+        self._coll = self._coll.with_options(read_preference=ReadPreference.PRIMARY)
+        mode = read_pref_mode_from_name(whitelist_read_preference)
+        self._whitelist_coll = self._coll.with_options(read_preference=make_read_preference(mode, None))
+        self.cache_ttl = cache_ttl
+        self.cache_negative_ttl = cache_negative_ttl
+        self.whitelist_cache = TTLCache(max_size=cache_size, version_check_interval=cache_version_check_interval,
+                                        version_getter=self.get_collection_version)
+
+    def _get_attributes_digest(self, eppn):
+        """
+        :param eppn: User eppn
+        :type eppn: six.string_type
+        :return: Stored attributes digest for a whitelisted user ('' if never stored) or None if not whitelisted
+        :rtype: six.string_type | None
+        """
+        with WHITELIST_LOOKUP_SECONDS.time():
+            found, digest = self.whitelist_cache.get(eppn)
+            if found:
+                WHITELIST_CACHE_TOTAL.labels('hit').inc()
+                return digest
+            WHITELIST_CACHE_TOTAL.labels('miss').inc()
+            doc = self._whitelist_coll.find_one({'eppn': eppn}, projection={'_id': False, 'attributes_digest': True})
+            if doc is None:
+                self.whitelist_cache.set(eppn, None, self.cache_negative_ttl)
+                return None
+            digest = doc.get('attributes_digest', '')
+            self.whitelist_cache.set(eppn, digest, self.cache_ttl)
+            return digest
 
     def is_whitelisted(self, eppn):
         """
@@ -26,12 +190,12 @@ class UserDB(BaseSeLegDB):
         :return: True or False
         :rtype: bool
         """
-        if self._get_documents_by_attr('eppn', eppn, raise_on_missing=False):
-            return True
-        return False
+        return self._get_attributes_digest(eppn) is not None
 
     def update_user(self, user):
         """
+        Only writes to the database if the user attributes differ from the stored ones.
+
         :param user: user data
         :type user: dict
         :return: None
@@ -39,17 +203,249 @@ class UserDB(BaseSeLegDB):
         """
         eppn = user.get('eppn')
         if eppn:
-            result = self._coll.replace_one({'eppn': eppn}, user, upsert=False)
+            self._update_attributes(eppn, user)
+
+    def _update_attributes(self, eppn, user):
+        digest = attributes_digest(user)
+        attributes = {key: value for key, value in user.items() if key != 'eppn'}
+        attributes['attributes_digest'] = digest
+        # Matches nothing if the user is not whitelisted or if the attributes already are up to date
+        with USER_UPDATE_SECONDS.time():
+            self._coll.update_one({'eppn': eppn, 'attributes_digest': {'$ne': digest}}, {'$set': attributes})
+        return digest
+
+    def check_and_update_user(self, user):
+        """
+        Whitelist check combined with an update of changed user attributes. For a user with unchanged attributes
+        this is a single, possibly cached, read.
+
+        :param user: user data
+        :type user: dict
+        :return: True if the user is whitelisted
+        :rtype: bool
+        """
+        eppn = user['eppn']
+        stored_digest = self._get_attributes_digest(eppn)
+        if stored_digest is None:
+            return False
+        if stored_digest != attributes_digest(user):
+            digest = self._update_attributes(eppn, user)
+            self.whitelist_cache.set(eppn, digest, self.cache_ttl)
+        return True
+
+    def sync_whitelist(self, eppns, dry_run=False, batch_size=500):
+        """
+        Make the whitelist contain exactly the given eppns. Attributes of users that stay whitelisted are kept.
+
+        :param eppns: Whitelisted eppns
+        :param dry_run: Only report the changes
+        :param batch_size: Max number of operations per bulk write
+
+        :type eppns: collections.Iterable
+        :type dry_run: bool
+        :type batch_size: int
+
+        :return: Added and removed eppns and the number of unchanged eppns
+        :rtype: dict
+        """
+        desired = set(eppns)
+        current = {doc['eppn'] for doc in self._coll.find({}, projection={'eppn': True, '_id': False})}
+        added = sorted(desired - current)
+        removed = sorted(current - desired)
+        result = {'added': added, 'removed': removed, 'unchanged': len(desired & current)}
+        if dry_run or not (added or removed):
+            return result
+
+        operations = [InsertOne({'eppn': eppn}) for eppn in added]
+        operations.extend(DeleteMany({'eppn': {'$in': removed[i:i + batch_size]}})
+                          for i in range(0, len(removed), batch_size))
+        for i in range(0, len(operations), batch_size):
+            try:
+                self._coll.bulk_write(operations[i:i + batch_size], ordered=False)
+            except BulkWriteError as e:
+                # Users added since the whitelist was read are already whitelisted
+                if any(error['code'] != 11000 for error in e.details['writeErrors']) or \
+                        e.details['writeConcernErrors']:
+                    raise
+        self.invalidate_whitelist()
+        return result
+
+    def invalidate_whitelist(self):
+        """
+        Drop cached whitelist lookups in all processes sharing the database.
+        """
+        self.bump_collection_version()
+        self.whitelist_cache.clear()
+
+    def _drop_whole_collection(self):
+        super(UserDB, self)._drop_whole_collection()
+        self.whitelist_cache.clear()
+
+
+class _InsertBatch(object):
+
+    def __init__(self):
+        self.docs = []
+        self.errors = {}
+        self.full = Event()
+        self.done = Event()
+
+
+class GroupCommitWriter(object):
+    """
+    Collects documents inserted by concurrent threads and writes them with a single insert_many.
+
+    The first thread to insert a document in a batch waits for window seconds, or until max_docs documents
+    have been added, and then writes the whole batch. All threads wait for the write to finish and get their
+    own result, an exception is raised in the thread whose document could not be written.
+    """
+
+    def __init__(self, collection, window=0.003, max_docs=50):
+        """
+        :param collection: Collection to write to
+        :param window: Max seconds to wait for more documents
+        :param max_docs: Max number of documents in a batch
+
+        :type collection: pymongo.collection.Collection
+        :type window: float
+        :type max_docs: int
+        """
+        self.collection = collection
+        self.window = window
+        self.max_docs = max_docs
+        self._lock = Lock()
+        self._batch = None
+
+    def insert(self, doc):
+        """
+        :param doc: Document to insert
+        :type doc: dict
+
+        :raises pymongo.errors.PyMongoError: if the document could not be written
+        """
+        with self._lock:
+            leader = self._batch is None
+            if leader:
+                self._batch = _InsertBatch()
+            batch = self._batch
+            index = len(batch.docs)
+            batch.docs.append(doc)
+            if len(batch.docs) >= self.max_docs:
+                # Close the batch for new documents
+                self._batch = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+            self._write(batch)
+        else:
+            batch.done.wait()
+
+        error = batch.errors.get(index)
+        if error is not None:
+            raise error
+
+    def _write(self, batch):
+        try:
+            self.collection.insert_many(batch.docs, ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get('writeErrors', []):
+                batch.errors[write_error['index']] = WriteError(write_error.get('errmsg'), write_error.get('code'),
+                                                                write_error)
+            if e.details.get('writeConcernErrors'):
+                # The durability of the whole batch is unknown
+                for index in range(len(batch.docs)):
+                    batch.errors.setdefault(index, e)
+        except Exception as e:
+            for index in range(len(batch.docs)):
+                batch.errors[index] = e
+        finally:
+            batch.done.set()
 
 
 class ProofingLog(BaseSeLegDB):
 
-    def __init__(self, db_uri, db_name='se_leg_ra', collection='proofing_log'):
+    # Audit queries filter on one of these fields and page on _id, see find_proofings
+    INDEXES = {
+        'index-delivery': {'key': [('delivery.status', 1), ('delivery.next_attempt_ts', 1)], 'sparse': True,
+                           'background': True},
+        'index-verified-by': {'key': [('verified_by', 1), ('_id', 1)], 'background': True},
+        'index-nin': {'key': [('nin', 1), ('_id', 1)], 'background': True},
+        'index-proofing-method': {'key': [('proofing_method', 1), ('_id', 1)], 'background': True},
+        'index-ocular-validation': {'key': [('ocular_validation', 1), ('_id', 1)], 'background': True},
+    }
+    INDEX_VERSION = 2
+
+    # Max time between creating a log element and inserting it
+    CREATED_TS_SLACK = timedelta(minutes=5)
+
+    def __init__(self, db_uri, db_name='se_leg_ra', collection='proofing_log', group_commit=False,
+                 group_commit_window=0.003, group_commit_max_docs=50, compact=False, legacy_documents=True,
+                 mongo_options=None, stats=None):
+        """
+        :param group_commit: Write documents from concurrent requests in batches
+        :param group_commit_window: Max seconds a document waits for more documents before the batch is written
+        :param group_commit_max_docs: Max number of documents in a batch
+        :param compact: Write new documents in the compact format, see se_leg_ra.compact
+        :param legacy_documents: With compact set, documents in the original format can remain and are indexed
+                                 and matched by find_proofings
+        :param mongo_options: Connection pool options, see mongo_uri
+        :param stats: Proofing statistics to count saved proofings in
+
+        :type group_commit: bool
+        :type group_commit_window: float
+        :type group_commit_max_docs: int
+        :type compact: bool
+        :type legacy_documents: bool
+        :type mongo_options: dict | None
+        :type stats: ProofingStatsDB | None
+        """
         # Make sure writes reach a majority of replicas
-        super(ProofingLog, self).__init__(db_uri, db_name, collection, safe_writes=True)
+        super(ProofingLog, self).__init__(mongo_uri(db_uri, mongo_options), db_name, collection, safe_writes=True)
+        # Reads of proofings just written, like delivery states, must see the writes
+        self._coll = self._coll.with_options(read_preference=ReadPreference.PRIMARY)
+        self.compact = compact
+        self.legacy_documents = compact and legacy_documents
+        self.stats = stats
+        if compact:
+            # Other names than the original indexes, setup_indexes keeps existing indexes with the same name
+            self.INDEXES = {'{}-compact'.format(name): dict(spec, key=[(self.field(key), direction)
+                                                                       for key, direction in spec['key']])
+                            for name, spec in ProofingLog.INDEXES.items()}
+            self.INDEX_FORMAT = 'compact'
+            if self.legacy_documents:
+                self.INDEXES.update(ProofingLog.INDEXES)
+                self.INDEX_FORMAT = 'compact+original'
+        self._writer = None
+        if group_commit:
+            self._writer = GroupCommitWriter(self._coll, window=group_commit_window,
+                                             max_docs=group_commit_max_docs)
+
+    def field(self, name):
+        """
+        :param name: Field name in the original format
+        :type name: six.string_types
+        :return: Field name in the format new documents are written in
+        :rtype: six.string_types
+        """
+        if self.compact:
+            return COMPACT_KEYS.get(name, name)
+        return name
 
     def _insert(self, doc):
-        self._coll.insert_one(doc)
+        stats_doc = doc
+        if self.compact:
+            doc = compact_document(doc)
+        with PROOFING_LOG_SAVE_SECONDS.time():
+            if self._writer is not None:
+                self._writer.insert(doc)
+            else:
+                self._coll.insert_one(doc)
+        if self.stats is not None:
+            self.stats.increment([stats_doc], STATS_SAVED)
 
     def save(self, log_element):
         """
@@ -63,6 +459,459 @@ class ProofingLog(BaseSeLegDB):
             return True
         return False
 
+    def probe_write(self):
+        """
+        Write to a separate collection with the write concern of the proofing log, to keep the proofing log
+        free from anything but proofings.
+
+        @return: True
+        @rtype: bool
+        """
+        coll = self._coll.database.get_collection(HEALTH_COLLECTION, write_concern=self._coll.write_concern)
+        coll.replace_one({'_id': self._coll_name}, {'probe_ts': datetime.utcnow()}, upsert=True)
+        return True
+
+    def save_for_delivery(self, log_element):
+        """
+        Save the log element together with a pending delivery state for the outbox worker.
+
+        @param log_element:
+        @type log_element: ProofingLogElement
+        @return: Document id or None if the log element did not validate
+        @rtype: bson.ObjectId | None
+        """
+        if log_element.validate():
+            doc = dict(log_element.to_dict())
+            doc['_id'] = ObjectId()
+            doc['delivery'] = {
+                'status': DELIVERY_PENDING,
+                'attempts': 0,
+                'next_attempt_ts': datetime.utcnow(),
+            }
+            self._insert(doc)
+            return doc['_id']
+        return None
+
+    def save_many(self, log_elements, for_delivery=False):
+        """
+        Save log elements with a single bulk insert, bypassing group commit.
+
+        @param log_elements: Log elements to save
+        @type log_elements: list[ProofingLogElement]
+        @param for_delivery: Save with a pending delivery state for the outbox worker
+        @type for_delivery: bool
+        @return: Document id, or None if the log element did not validate or could not be written, per log element
+        @rtype: list[bson.ObjectId | None]
+        """
+        ids = [None] * len(log_elements)
+        docs = []
+        stats_docs = []
+        indexes = []
+        for index, log_element in enumerate(log_elements):
+            if not log_element.validate():
+                continue
+            doc = dict(log_element.to_dict())
+            doc['_id'] = ObjectId()
+            if for_delivery:
+                doc['delivery'] = {
+                    'status': DELIVERY_PENDING,
+                    'attempts': 0,
+                    'next_attempt_ts': datetime.utcnow(),
+                }
+            stats_docs.append(doc)
+            if self.compact:
+                doc = compact_document(doc)
+            ids[index] = doc['_id']
+            docs.append(doc)
+            indexes.append(index)
+        if not docs:
+            return ids
+        try:
+            with PROOFING_LOG_SAVE_SECONDS.time():
+                self._coll.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            failed = [write_error['index'] for write_error in e.details.get('writeErrors', [])]
+            if e.details.get('writeConcernErrors'):
+                # The durability of the whole batch is unknown
+                failed = range(len(docs))
+            for doc_index in failed:
+                ids[indexes[doc_index]] = None
+        if self.stats is not None:
+            self.stats.increment([doc for doc, index in zip(stats_docs, indexes) if ids[index] is not None],
+                                 STATS_SAVED)
+        return ids
+
+    def claim_pending_delivery(self, lease_time):
+        """
+        Claim the pending document that has waited longest. The document will not be claimed again
+        until lease_time has passed, in case the worker dies before setting the delivery result.
+
+        @param lease_time: Seconds the document is reserved for the caller
+        @type lease_time: int
+        @return: Document or None if nothing is pending
+        @rtype: dict | None
+        """
+        now = datetime.utcnow()
+        spec = {'delivery.status': DELIVERY_PENDING, 'delivery.next_attempt_ts': {'$lte': now}}
+        update = {
+            '$set': {'delivery.next_attempt_ts': now + timedelta(seconds=lease_time)},
+            '$inc': {'delivery.attempts': 1}
+        }
+        return self._coll.find_one_and_update(spec, update, sort=[('delivery.next_attempt_ts', 1)],
+                                              return_document=ReturnDocument.AFTER)
+
+    def set_delivery_result(self, doc_id, status, next_attempt_ts=None, error=None):
+        """
+        @param doc_id: Document id
+        @param status: New delivery status
+        @param next_attempt_ts: When to retry a pending delivery
+        @param error: Reason for the latest failed attempt
+
+        @type doc_id: bson.ObjectId
+        @type status: six.string_types
+        @type next_attempt_ts: datetime.datetime | None
+        @type error: six.string_types | None
+        """
+        update = {'delivery.status': status, 'delivery.modified_ts': datetime.utcnow()}
+        if next_attempt_ts is not None:
+            update['delivery.next_attempt_ts'] = next_attempt_ts
+        if error is not None:
+            update['delivery.error'] = error
+        self._coll.update_one({'_id': doc_id}, {'$set': update})
+
+    def get_delivery(self, doc_id, verified_by):
+        """
+        @param doc_id: Document id
+        @param verified_by: Eppn of the RA user that saved the document
+        @type doc_id: bson.ObjectId
+        @type verified_by: six.string_types
+        @return: Delivery state or None if not found
+        @rtype: dict | None
+        """
+        spec = {'_id': doc_id, self.field('verified_by'): verified_by}
+        doc = self._coll.find_one(spec, projection={'delivery': True})
+        if doc:
+            return doc.get('delivery')
+        return None
+
+    def find_proofings(self, verified_by=None, nin=None, proofing_method=None, ocular_validation=None,
+                       created_after=None, created_before=None, before_id=None, limit=100, include_opaque=False):
+        """
+        Find proofings, newest first, using keyset pagination. Pass the returned next id as before_id to get
+        the next page. With compact set documents still in the original format are also matched, unless
+        legacy_documents is off.
+
+        @param verified_by: Eppn of the RA user
+        @param nin: National identity number
+        @param proofing_method: Proofing method name
+        @param ocular_validation: Ocular validation result
+        @param created_after: Match proofings created at or after this time (UTC)
+        @param created_before: Match proofings created before this time (UTC)
+        @param before_id: Match proofings older than this document id
+        @param limit: Max number of proofings
+        @param include_opaque: Include the QR code data
+
+        @type verified_by: six.string_types | None
+        @type nin: six.string_types | None
+        @type proofing_method: six.string_types | None
+        @type ocular_validation: bool | None
+        @type created_after: datetime.datetime | None
+        @type created_before: datetime.datetime | None
+        @type before_id: bson.ObjectId | None
+        @type limit: int
+        @type include_opaque: bool
+
+        @return: Proofing log documents and the id to continue from, or None if there are no more documents
+        @rtype: (list, bson.ObjectId | None)
+        """
+        filters = [('verified_by', verified_by), ('nin', nin), ('proofing_method', proofing_method),
+                   ('ocular_validation', ocular_validation)]
+
+        # The _id is created client side right before the insert, a created_ts range is also an _id range
+        # which keeps the query on the _id part of the index
+        id_range = {}
+        created_range = {}
+        if created_after is not None:
+            created_range['$gte'] = created_after
+            id_range['$gte'] = ObjectId.from_datetime(created_after)
+        if created_before is not None:
+            created_range['$lt'] = created_before
+            id_range['$lt'] = ObjectId.from_datetime(created_before + self.CREATED_TS_SLACK)
+        if before_id is not None:
+            id_range['$lt'] = min(id_range.get('$lt', before_id), before_id)
+
+        def format_spec(compact):
+            spec = {}
+            for name, value in filters:
+                if value is None:
+                    continue
+                if compact:
+                    spec[COMPACT_KEYS.get(name, name)] = encode_value(name, value)
+                else:
+                    spec[name] = value
+            if id_range:
+                spec['_id'] = id_range
+            if created_range:
+                spec[COMPACT_KEYS['created_ts'] if compact else 'created_ts'] = created_range
+            return spec
+
+        spec = format_spec(self.compact)
+        if self.legacy_documents:
+            # Both branches have indexes, see INDEXES
+            spec = {'$or': [spec, format_spec(False)]}
+        projection = None if include_opaque else {self.field('opaque'): False, 'opaque': False}
+        cursor = self._coll.find(spec, projection=projection, sort=[('_id', -1)], limit=limit + 1)
+        docs = [expand_document(doc) for doc in cursor]
+        if len(docs) > limit:
+            docs = docs[:limit]
+            return docs, docs[-1]['_id']
+        return docs, None
+
+    def iter_documents(self, created_after=None, created_before=None, after_id=None, batch_size=1000):
+        """
+        Iterate over documents in any format in insert order. Every batch is a separate query continuing after
+        the last id of the previous batch, so no cursor is kept open while the caller processes a batch.
+
+        @param created_after: Only documents created at or after this time (UTC)
+        @param created_before: Only documents created before this time (UTC)
+        @param after_id: Only documents after this document id
+        @param batch_size: Max number of documents per batch
+
+        @type created_after: datetime.datetime | None
+        @type created_before: datetime.datetime | None
+        @type after_id: bson.ObjectId | None
+        @type batch_size: int
+
+        @return: Generator of the last id read and the matching documents in the original format for every batch
+        @rtype: collections.Iterable[(bson.ObjectId, list)]
+        """
+        # The created_ts range is matched exactly after expanding the documents, as it is stored under
+        # different names in different formats
+        id_range = {}
+        if created_after is not None:
+            id_range['$gte'] = ObjectId.from_datetime(created_after)
+        if created_before is not None:
+            id_range['$lt'] = ObjectId.from_datetime(created_before + self.CREATED_TS_SLACK)
+        while True:
+            if after_id is not None:
+                id_range['$gt'] = after_id
+            spec = {'_id': id_range} if id_range else {}
+            docs = list(self._coll.find(spec, sort=[('_id', 1)], limit=batch_size))
+            if not docs:
+                return
+            after_id = docs[-1]['_id']
+            batch = []
+            for doc in docs:
+                doc = expand_document(doc)
+                if created_after is not None and doc['created_ts'] < created_after:
+                    continue
+                if created_before is not None and doc['created_ts'] >= created_before:
+                    continue
+                batch.append(doc)
+            yield after_id, batch
+            if len(docs) < batch_size:
+                return
+
+    def size_report(self, sample_size=1000):
+        """
+        Compare the size of the stored documents in the original and in the compact format.
+
+        @param sample_size: Number of documents to compare
+        @type sample_size: int
+        @return: Collection statistics and the summed sizes of the sampled documents in both formats
+        @rtype: dict
+        """
+        stats = self._coll.database.command('collstats', self._coll_name)
+        report = {
+            'count': stats.get('count', 0),
+            'size': stats.get('size', 0),
+            'storage_size': stats.get('storageSize', 0),
+            'avg_obj_size': stats.get('avgObjSize', 0),
+            'sampled': 0,
+            'sampled_compact': 0,
+            'sampled_original_size': 0,
+            'sampled_compact_size': 0,
+        }
+        for doc in self._coll.find().limit(sample_size):
+            expanded = expand_document(doc)
+            report['sampled'] += 1
+            report['sampled_compact'] += int(expanded is not doc)
+            report['sampled_original_size'] += len(BSON.encode(expanded))
+            report['sampled_compact_size'] += len(BSON.encode(compact_document(expanded)))
+        return report
+
+    def compact_documents(self, batch_size=500):
+        """
+        Rewrite documents in the original format to the compact format. Documents waiting for delivery are
+        left as they are, the outbox worker may update them at any time.
+
+        @param batch_size: Number of documents per bulk write
+        @type batch_size: int
+        @return: Number of rewritten documents
+        @rtype: int
+        """
+        spec = {'v': {'$exists': False}, 'delivery.status': {'$ne': DELIVERY_PENDING}}
+        count = 0
+        operations = []
+        for doc in self._coll.find(spec, batch_size=batch_size):
+            operations.append(ReplaceOne({'_id': doc['_id'], 'v': {'$exists': False}}, compact_document(doc)))
+            if len(operations) >= batch_size:
+                count += self._coll.bulk_write(operations, ordered=False).modified_count
+                operations = []
+        if operations:
+            count += self._coll.bulk_write(operations, ordered=False).modified_count
+        return count
+
+    def daily_counts(self, until=None):
+        """
+        Count proofings per day, verified_by and proofing_method with an aggregation over the whole log. Only the
+        saved count and the outcome of outbox deliveries are known from the log.
+
+        @param until: Only count proofings created before this day (UTC)
+        @type until: datetime.datetime | None
+        @return: Generator of ProofingStatsDB keys and counts
+        @rtype: collections.Iterable[(dict, dict)]
+        """
+        # Documents in both formats
+        created_ts = {'$ifNull': ['$created_ts', '$ts']}
+        pipeline = []
+        if until is not None:
+            pipeline.append({'$match': {'$or': [{'created_ts': {'$lt': until}}, {'ts': {'$lt': until}}]}})
+        pipeline.append({'$group': {
+            '_id': {
+                'day': {'$dateToString': {'format': STATS_DAY_FORMAT, 'date': created_ts}},
+                'verified_by': {'$ifNull': ['$verified_by', '$vb']},
+                'proofing_method': {'$ifNull': ['$proofing_method', '$m']},
+            },
+            STATS_SAVED: {'$sum': 1},
+            OUTCOME_SUCCESS: {'$sum': {'$cond': [{'$eq': ['$delivery.status', DELIVERY_SENT]}, 1, 0]}},
+            STATS_DELIVERY_FAILED: {'$sum': {'$cond': [{'$eq': ['$delivery.status', DELIVERY_FAILED]}, 1, 0]}},
+        }})
+        for doc in self._coll.aggregate(pipeline, allowDiskUse=True):
+            key = doc.pop('_id')
+            key['proofing_method'] = decode_value('proofing_method', key['proofing_method'])
+            yield key, {outcome: count for outcome, count in doc.items() if count}
+
+
+class ProofingStatsDB(BaseSeLegDB):
+    """
+    Proofing counts per day (UTC), verified_by, proofing_method and outcome, updated with $inc upserts when
+    proofings are saved and when the vetting endpoint has answered.
+
+    Outcomes: saved, success, invalid_qr and op_unreachable for proofings sent when saved, success and
+    delivery_failed for proofings delivered by the outbox worker.
+    """
+
+    INDEXES = {
+        'index-day-verified-by-method': {'key': [('day', 1), ('verified_by', 1), ('proofing_method', 1)],
+                                         'unique': True, 'background': True},
+        'index-verified-by-day': {'key': [('verified_by', 1), ('day', 1)], 'background': True},
+    }
+    INDEX_VERSION = 1
+
+    def __init__(self, db_uri, db_name='se_leg_ra', collection='proofing_stats', mongo_options=None):
+        """
+        :param mongo_options: Connection pool options, see mongo_uri
+        :type mongo_options: dict | None
+        """
+        super(ProofingStatsDB, self).__init__(mongo_uri(db_uri, mongo_options), db_name, collection)
+
+    @staticmethod
+    def key(doc):
+        """
+        @param doc: Proofing log document in the original format
+        @type doc: dict
+        @return: Counter document key
+        @rtype: dict
+        """
+        return {
+            'day': doc['created_ts'].strftime(STATS_DAY_FORMAT),
+            'verified_by': doc['verified_by'],
+            'proofing_method': doc['proofing_method'],
+        }
+
+    def _bulk_write(self, operations):
+        try:
+            self._coll.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # Concurrent upserts of a new counter document, the retry updates the document
+            retry = [operations[error['index']] for error in e.details.get('writeErrors', [])
+                     if error.get('code') == 11000]
+            if not retry or len(retry) < len(e.details.get('writeErrors', [])):
+                raise
+            self._coll.bulk_write(retry, ordered=False)
+
+    def increment(self, docs, outcome):
+        """
+        Statistics must never stop a proofing, errors are only counted.
+
+        @param docs: Proofing log documents in the original format
+        @type docs: list[dict]
+        @param outcome: Outcome to count the proofings as
+        @type outcome: six.string_types
+        @return: False if the counters could not be updated
+        @rtype: bool
+        """
+        counts = Counter(tuple(sorted(self.key(doc).items())) for doc in docs)
+        if not counts:
+            return True
+        operations = [UpdateOne(dict(key), {'$inc': {'counts.{}'.format(outcome): count}}, upsert=True)
+                      for key, count in counts.items()]
+        try:
+            self._bulk_write(operations)
+        except PyMongoError:
+            PROOFING_STATS_ERRORS_TOTAL.inc()
+            return False
+        return True
+
+    def set_counts(self, rows, batch_size=500):
+        """
+        Replace counts, used to build the statistics from the proofing log.
+
+        @param rows: Counter document keys and counts, see ProofingLog.daily_counts
+        @type rows: collections.Iterable[(dict, dict)]
+        @param batch_size: Number of documents per bulk write
+        @type batch_size: int
+        @return: Number of counter documents written
+        @rtype: int
+        """
+        count = 0
+        operations = []
+        for key, counts in rows:
+            update = {'counts.{}'.format(outcome): value for outcome, value in counts.items()}
+            operations.append(UpdateOne(key, {'$set': update}, upsert=True))
+            if len(operations) >= batch_size:
+                self._bulk_write(operations)
+                count += len(operations)
+                operations = []
+        if operations:
+            self._bulk_write(operations)
+            count += len(operations)
+        return count
+
+    def find_counts(self, first_day, last_day, verified_by=None, proofing_method=None):
+        """
+        @param first_day: First day, YYYY-MM-DD
+        @param last_day: Last day, YYYY-MM-DD
+        @param verified_by: Only counts for this RA user
+        @param proofing_method: Only counts for this proofing method
+
+        @type first_day: six.string_types
+        @type last_day: six.string_types
+        @type verified_by: six.string_types | None
+        @type proofing_method: six.string_types | None
+
+        @return: Counter documents ordered by day
+        @rtype: list[dict]
+        """
+        spec = {'day': {'$gte': first_day, '$lte': last_day}}
+        if verified_by is not None:
+            spec['verified_by'] = verified_by
+        if proofing_method is not None:
+            spec['proofing_method'] = proofing_method
+        sort = [('day', 1), ('verified_by', 1), ('proofing_method', 1)]
+        return list(self._coll.find(spec, projection={'_id': False}).sort(sort))
+
 
 class ProofingLogElement(LogElement):
 
@@ -333,3 +1182,28 @@ class NationalIdCardProofing(IdCardProofing):
         super(NationalIdCardProofing, self).__init__(created_by, verified_by, nin, card_number, opaque,
                                                      ocular_validation, expiry_date, proofing_version)
         self._data['proofing_method'] = 'national_id_card'
+
+
+PROOFING_ELEMENTS = {
+    'drivers_license': DriversLicenseProofing,
+    'passport': PassportProofing,
+    'id_card': IdCardProofing,
+    'national_id_card': NationalIdCardProofing,
+}
+
+
+def proofing_element_from_document(doc):
+    """
+    Recreate a proofing log element from a proofing log document.
+
+    :param doc: Proofing log document in any format
+    :type doc: dict
+    :return: Proofing log element
+    :rtype: ProofingLogElement
+    """
+    doc = expand_document(doc)
+    cls = PROOFING_ELEMENTS[doc['proofing_method']]
+    element = cls.__new__(cls)
+    LogElement.__init__(element, doc['created_by'])
+    element._data.update({key: value for key, value in doc.items() if key not in ('_id', 'delivery')})
+    return element
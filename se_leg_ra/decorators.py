@@ -3,6 +3,8 @@
 from functools import wraps
 from six import string_types
 from flask import request, current_app, abort, redirect
+from se_leg_ra.ratelimit import check_rate_limits, request_costs
+from se_leg_ra.metrics import render_template
 __author__ = 'lundberg'
 
 
@@ -20,29 +22,62 @@ def require_eppn(f):
         # Check if the assertion contains an AL2 assurance or if it
         # is coming from an IdP that is in the exceptions list
         if not is_al2():
-            current_app.logger.warning('{} not AL2'.format(eppn))
+            current_app.logger.warning('%s not AL2', eppn)
             abort(403)
 
         # If the logged in user is whitelisted then we
         # pass on the request to the decorated view
         # together with a dict of user attributes.
-        if current_app.user_db.is_whitelisted(eppn):
-            user = {
-                'eppn': eppn,
-                # Shibboleth apparently uses latin-1.
-                'given_name': bytes(request.environ.pop('HTTP_GIVENNAME', ''), 'latin-1').decode('utf-8'),
-                'surname': bytes(request.environ.pop('HTTP_SN', ''), 'latin-1').decode('utf-8'),
-                'display_name': bytes(request.environ.pop('HTTP_DISPLAYNAME', ''), 'latin-1').decode('utf-8'),
-            }
+        user = {
+            'eppn': eppn,
+            # Shibboleth apparently uses latin-1.
+            'given_name': bytes(request.environ.pop('HTTP_GIVENNAME', ''), 'latin-1').decode('utf-8'),
+            'surname': bytes(request.environ.pop('HTTP_SN', ''), 'latin-1').decode('utf-8'),
+            'display_name': bytes(request.environ.pop('HTTP_DISPLAYNAME', ''), 'latin-1').decode('utf-8'),
+        }
+        if current_app.user_db.check_and_update_user(user):
             kwargs['user'] = user
-            current_app.user_db.update_user(user)
             return f(*args, **kwargs)
         # Anything else is considered as an unauthorized request
-        current_app.logger.warning('{} not in whitelist'.format(eppn))
+        current_app.logger.warning('%s not in whitelist', eppn)
         abort(403)
     return require_eppn_decorator
 
 
+def rate_limited(f):
+    """
+    Limit proofing submissions per RA user, national identity number and client IP with the token buckets
+    in RATE_LIMITS. Use above require_eppn so that limited requests never reach the database.
+    """
+    @wraps(f)
+    def rate_limited_decorator(*args, **kwargs):
+        if request.method == 'POST':
+            costs = request_costs()
+            costs['nin'] = {request.form.get('nin'): 1}
+            retry_after = check_rate_limits(costs)
+            if retry_after is not None:
+                response = current_app.make_response((render_template('rate_limited.jinja2',
+                                                                      retry_after=retry_after), 429))
+                response.headers['Retry-After'] = str(retry_after)
+                return response
+        return f(*args, **kwargs)
+    return rate_limited_decorator
+
+
+def require_auditor(f):
+    """
+    Only let users in AUDIT_EPPNS through, use below require_eppn.
+    """
+    @wraps(f)
+    def require_auditor_decorator(*args, **kwargs):
+        eppn = kwargs['user']['eppn']
+        if eppn not in current_app.config['AUDIT_EPPNS']:
+            current_app.logger.warning('%s not an auditor', eppn)
+            abort(403)
+        return f(*args, **kwargs)
+    return require_auditor_decorator
+
+
 def is_al2():
     """
     Require AL2 assurance by default but with a list of exceptions.
@@ -52,7 +87,7 @@ def is_al2():
     """
     entity_id = request.environ.get('HTTP_SHIB_IDENTITY_PROVIDER', None)
     if entity_id in current_app.config['AL2_IDP_EXCEPTIONS']:
-        current_app.logger.warning('Not checking assurance from {}.'.format(entity_id))
+        current_app.logger.warning('Not checking assurance from %s.', entity_id)
         return True
     assurance = request.environ.pop('HTTP_ASSURANCE', None)
     if not assurance:
@@ -64,9 +99,9 @@ def is_al2():
         # Check allowed assurances against supplied ones
         for item in current_app.config['AL2_ASSURANCES']:
             if item in assurance:
-                current_app.logger.info('Assertion from {} asserted {} assurance'.format(entity_id, assurance))
+                current_app.logger.info('Assertion from %s asserted %s assurance', entity_id, assurance)
                 return True
-    current_app.logger.warning('Not accepted assurance ({}) from {}'.format(assurance, entity_id))
+    current_app.logger.warning('Not accepted assurance (%s) from %s', assurance, entity_id)
     return False
 
 
@@ -79,12 +114,11 @@ def is_mfa():
     """
     entity_id = request.environ.get('HTTP_SHIB_IDENTITY_PROVIDER', None)
     if entity_id in current_app.config['MFA_IDP_EXCEPTIONS']:
-        current_app.logger.info('Not checking authn context class from {}'.format(entity_id))
+        current_app.logger.info('Not checking authn context class from %s', entity_id)
         return True
     authn_context_class = request.environ.pop('HTTP_SHIB_AUTHNCONTEXT_CLASS', None)
     if authn_context_class in current_app.config['MFA_AUTHN_CONTEXT_CLASSES']:
-        current_app.logger.info('Assertion from {} asserted {} authn context class'.format(entity_id,
-                                                                                           authn_context_class))
+        current_app.logger.info('Assertion from %s asserted %s authn context class', entity_id, authn_context_class)
         return True
-    current_app.logger.warning('Not accepted authn context class ({}) from {}'.format(authn_context_class, entity_id))
+    current_app.logger.warning('Not accepted authn context class (%s) from %s', authn_context_class, entity_id)
     return False
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+"""
+Export of the proofing log as NDJSON or CSV, optionally gzip compressed.
+
+Documents are read in batches in insert order and written as they are read, memory use does not depend on
+the size of the export.
+
+An export to a file records its progress in OUTPUT.progress after every batch, an interrupted export is
+continued with resume=True. Every batch of a compressed export is a separate gzip member, the members of a
+gzip file are read as one stream by gzip, zcat and the gzip module.
+"""
+
+import io
+import os
+import csv
+import json
+import gzip
+import zlib
+from datetime import datetime
+from bson import ObjectId
+from se_leg_ra.db import proofing_element_from_document
+from se_leg_ra.utils import parse_datetime, DATETIME_FORMATS
+
+__author__ = 'lundberg'
+
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+EXPORT_FIELDS = ['id', 'created_ts', 'created_by', 'verified_by', 'nin', 'proofing_method', 'proofing_version',
+                 'document_identifier', 'expiry_date', 'ocular_validation', 'opaque', 'delivery_status']
+MASKABLE_FIELDS = ('verified_by', 'nin', 'document_identifier', 'opaque')
+MASK = '****'
+
+
+def mask_value(field, value):
+    """
+    :param field: Field name
+    :param value: Field value
+    :return: Masked value, the birth date part of a national identity number is kept
+
+    >>> mask_value('nin', '190102031234')
+    '19010203****'
+    >>> mask_value('opaque', '1{"token": "a_token", "nonce": "a_nonce"}')
+    '****'
+    """
+    if value is None:
+        return None
+    if field == 'nin':
+        return value[:8] + MASK
+    return MASK
+
+
+def export_row(doc, mask=()):
+    """
+    :param doc: Proofing log document in the original format
+    :param mask: Names of the fields to mask
+
+    :type doc: dict
+    :type mask: collections.Iterable
+
+    :return: Export fields of the proofing
+    :rtype: dict
+    """
+    element = proofing_element_from_document(doc)
+    data = element.to_dict()
+    row = {}
+    for field in EXPORT_FIELDS:
+        if field == 'id':
+            value = str(doc['_id'])
+        elif field == 'document_identifier':
+            value = element.document_identifier
+        elif field == 'delivery_status':
+            value = doc.get('delivery', {}).get('status')
+        else:
+            value = data.get(field)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        if field in mask:
+            value = mask_value(field, value)
+        row[field] = value
+    return row
+
+
+def format_rows(rows, fmt, header=False):
+    """
+    :param rows: Export rows
+    :param fmt: ndjson or csv
+    :param header: Start with a CSV header
+
+    :type rows: list
+    :type fmt: str
+    :type header: bool
+
+    :return: Formatted rows
+    :rtype: str
+    """
+    if fmt == 'ndjson':
+        return ''.join('{}\n'.format(json.dumps(row, ensure_ascii=False)) for row in rows)
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=EXPORT_FIELDS, lineterminator='\n')
+    if header:
+        writer.writeheader()
+    writer.writerows(rows)
+    return out.getvalue()
+
+
+def iter_export_batches(proofing_log, created_after=None, created_before=None, after_id=None, mask=(),
+                        batch_size=1000):
+    """
+    :param proofing_log: Proofing log
+    :param created_after: Only proofings created at or after this time (UTC)
+    :param created_before: Only proofings created before this time (UTC)
+    :param after_id: Continue after this document id
+    :param mask: Names of the fields to mask
+    :param batch_size: Number of documents read per query
+
+    :type proofing_log: se_leg_ra.db.ProofingLog
+    :type created_after: datetime.datetime | None
+    :type created_before: datetime.datetime | None
+    :type after_id: bson.ObjectId | None
+    :type mask: collections.Iterable
+    :type batch_size: int
+
+    :return: Generator of the last id read and the export rows for every batch
+    :rtype: collections.Iterable[(bson.ObjectId, list)]
+    """
+    for last_id, docs in proofing_log.iter_documents(created_after=created_after, created_before=created_before,
+                                                     after_id=after_id, batch_size=batch_size):
+        yield last_id, [export_row(doc, mask) for doc in docs]
+
+
+def export_stream(proofing_log, fmt='ndjson', compress=False, max_docs=None, **kwargs):
+    """
+    Export for a streamed HTTP response. Continue an export that was cut off with after_id set to the id of
+    the last exported proofing.
+
+    :param proofing_log: Proofing log
+    :param fmt: ndjson or csv
+    :param compress: Gzip compress the output
+    :param max_docs: Stop after at least this many proofings
+    :param kwargs: Arguments for iter_export_batches
+
+    :type proofing_log: se_leg_ra.db.ProofingLog
+    :type fmt: str
+    :type compress: bool
+    :type max_docs: int | None
+
+    :return: Generator of output chunks
+    :rtype: collections.Iterable[bytes]
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    header = fmt == 'csv'
+    count = 0
+    for _, rows in iter_export_batches(proofing_log, **kwargs):
+        if not rows:
+            continue
+        data = format_rows(rows, fmt, header=header).encode('utf-8')
+        header = False
+        if compressor is not None:
+            data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield data
+        count += len(rows)
+        if max_docs is not None and count >= max_docs:
+            break
+    if compressor is not None:
+        yield compressor.flush()
+
+
+def _get_datetime(options, name):
+    if options[name] is None:
+        return None
+    return parse_datetime(options[name])
+
+
+def _progress_path(path):
+    return '{}.progress'.format(path)
+
+
+def _write_progress(path, progress):
+    tmp_path = '{}.tmp'.format(_progress_path(path))
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, _progress_path(path))
+
+
+def export_to_file(proofing_log, path, fmt='ndjson', compress=False, created_after=None, created_before=None,
+                   mask=(), batch_size=1000, resume=False):
+    """
+    :param proofing_log: Proofing log
+    :param path: Output file
+    :param fmt: ndjson or csv
+    :param compress: Gzip compress the output
+    :param created_after: Only proofings created at or after this time (UTC)
+    :param created_before: Only proofings created before this time (UTC)
+    :param mask: Names of the fields to mask
+    :param batch_size: Number of documents read per query
+    :param resume: Continue an interrupted export to path, with the options of that export
+
+    :type proofing_log: se_leg_ra.db.ProofingLog
+    :type path: str
+    :type fmt: str
+    :type compress: bool
+    :type created_after: datetime.datetime | None
+    :type created_before: datetime.datetime | None
+    :type mask: collections.Iterable
+    :type batch_size: int
+    :type resume: bool
+
+    :return: Number of proofings written by this call
+    :rtype: int
+    """
+    if resume:
+        try:
+            with open(_progress_path(path)) as f:
+                progress = json.load(f)
+        except FileNotFoundError:
+            raise ValueError('No interrupted export to {}'.format(path))
+        options = progress['options']
+        try:
+            f = open(path, 'r+b')
+        except FileNotFoundError:
+            raise ValueError('Export file {} is missing, start a new export'.format(path))
+        # Anything written after the last recorded batch is incomplete
+        f.truncate(progress['size'])
+        f.seek(progress['size'])
+    else:
+        options = {
+            'fmt': fmt,
+            'compress': compress,
+            'created_after': created_after.strftime(DATETIME_FORMATS[0]) if created_after else None,
+            'created_before': created_before.strftime(DATETIME_FORMATS[0]) if created_before else None,
+            'mask': sorted(mask),
+        }
+        progress = {'options': options, 'last_id': None, 'size': 0, 'count': 0}
+        f = open(path, 'wb')
+        _write_progress(path, progress)
+
+    header = options['fmt'] == 'csv' and progress['size'] == 0
+    after_id = ObjectId(progress['last_id']) if progress['last_id'] else None
+    count = 0
+    with f:
+        batches = iter_export_batches(proofing_log, after_id=after_id, mask=options['mask'], batch_size=batch_size,
+                                      created_after=_get_datetime(options, 'created_after'),
+                                      created_before=_get_datetime(options, 'created_before'))
+        for last_id, rows in batches:
+            if rows:
+                data = format_rows(rows, options['fmt'], header=header).encode('utf-8')
+                header = False
+                if options['compress']:
+                    data = gzip.compress(data, mtime=0)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+                count += len(rows)
+            progress.update(last_id=str(last_id), size=f.tell(), count=progress['count'] + len(rows))
+            _write_progress(path, progress)
+    os.remove(_progress_path(path))
+    return count
@@ -2,11 +2,13 @@
 
 import re
 import json
+import uuid
 from flask import current_app
 from flask_wtf import FlaskForm
-from wtforms import StringField, TextAreaField, BooleanField, DateTimeField
+from wtforms import StringField, TextAreaField, BooleanField, DateTimeField, HiddenField
 from wtforms.widgets import Input
-from wtforms.validators import InputRequired, Regexp, ValidationError
+from wtforms.validators import InputRequired, Regexp, ValidationError, Length
+from se_leg_ra.nonce_cache import opaque_nonce
 
 __author__ = 'lundberg'
 
@@ -68,7 +70,7 @@ class OpaqueDataRequired(object):
         try:
             opaque_data_deserialized = json.loads(opaque_data[1:])
         except ValueError as e:
-            current_app.logger.info('Invalid formatted opaque data: {}'.format(e))
+            current_app.logger.info('Invalid formatted opaque data: %s', e)
             field.errors[:] = []
             raise ValidationError(message)
 
@@ -78,6 +80,27 @@ class OpaqueDataRequired(object):
             raise ValidationError(message)
 
 
+class UnusedNonce(object):
+    """
+    Validates that the QR code has not been used recently.
+    """
+    def __init__(self, message=None):
+        self.message = message
+
+    def __call__(self, form, field):
+        if self.message is None:
+            message = field.gettext('QR code already used')
+        else:
+            message = self.message
+
+        if current_app.nonce_cache is None:
+            return
+        nonce = opaque_nonce(field.data or '')
+        if nonce is not None and current_app.nonce_cache.seen(nonce):
+            current_app.logger.info('QR code nonce already used')
+            raise ValidationError(message)
+
+
 class LuhnValidator(object):
     def __init__(self, message=None):
         self.message = message
@@ -115,6 +138,7 @@ class NinValidator(Regexp):
 
 input_validator = InputRequired(message="Det här fältet är obligatoriskt")
 qr_validator = OpaqueDataRequired(message="Inläsning av QR-koden misslyckades")
+nonce_validator = UnusedNonce(message="Ogiltig QR-kod. Be användaren påbörja en ny verifiering.")
 nin_validator = NinValidator(message="Ange ett giltigt personnummer i formatet ÅÅÅÅMMDDNNNN")
 luhn_validator = LuhnValidator(message='Personnummret kunde inte valideras. Saknas någon siffra?')
 eight_digits_validator = NDigitValidator(8, message="Ange ett giltigt nummer i formatet NNNNNNNN (åtta siffror)")
@@ -122,12 +146,14 @@ nine_digits_validator = NDigitValidator(9, message="Ange ett giltigt nummer i fo
 
 
 class BaseForm(FlaskForm):
-    qr_code = OpaqueDataField('QR-kod', validators=[input_validator, qr_validator],
+    qr_code = OpaqueDataField('QR-kod', validators=[input_validator, qr_validator, nonce_validator],
                               widget=PlaceholderInput(placeholder='Klicka här och läs in QR-koden'))
     nin = StringField('Personnummer', validators=[input_validator, nin_validator, luhn_validator],
                       widget=PlaceholderInput(placeholder='ÅÅÅÅMMDDNNNN'))
     expiry_date = SEDateTimeField('Utgångsdatum', format='%Y-%m-%d', widget=PlaceholderInput(placeholder='YYYY-MM-DD'))
     ocular_validation = BooleanField(description='Ovanstående uppgifter är rätta och riktiga', default="checked")
+    # A new key for every rendered form, repeated submissions of the form have the same key
+    idempotency_key = HiddenField(default=lambda: uuid.uuid4().hex, validators=[Length(max=64)])
 
 
 class DriversLicenseForm(BaseForm):
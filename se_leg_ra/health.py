@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import time
+from datetime import datetime
+from threading import Thread, Event
+
+__author__ = 'lundberg'
+
+
+def _timed_check(app, name, check):
+    start = time.monotonic()
+    try:
+        ok = bool(check())
+        error = None
+    except Exception as exc:
+        app.logger.warning('%s health check failed: %s', name, exc)
+        ok = False
+        error = str(exc)
+    result = {'ok': ok, 'latency_ms': round((time.monotonic() - start) * 1000, 1)}
+    if error:
+        result['error'] = error
+    return result
+
+
+def _check_vetting_endpoint(app):
+    # Any answer from the OP, that is not a server error, means that it is reachable
+    r = app.vetting_client.session.head(app.vetting_client.endpoint, timeout=app.vetting_client.timeout)
+    return r.status_code < 500
+
+
+def check_health(app):
+    """
+    :param app: Flask app
+    :type app: flask.Flask
+
+    :return: Health status with the result and latency of every dependency check
+    :rtype: dict
+    """
+    checks = {
+        'mongodb': _timed_check(app, 'mongodb', app.user_db.is_healthy),
+    }
+    if app.config['HEALTH_CHECK_VETTING_ENDPOINT']:
+        checks['vetting_endpoint'] = _timed_check(app, 'vetting_endpoint', lambda: _check_vetting_endpoint(app))
+    if app.config['HEALTH_CHECK_PROOFING_LOG_WRITE']:
+        checks['proofing_log_write'] = _timed_check(app, 'proofing_log_write', app.proofing_log.probe_write)
+
+    res = {'status': 'STATUS_FAIL', 'checks': checks, 'checked_ts': datetime.utcnow().isoformat()}
+    # Only the database is required for the app to work, the other checks are informational
+    if not checks['mongodb']['ok']:
+        res['reason'] = 'mongodb check failed'
+        app.logger.warning('mongodb check failed')
+    else:
+        res['status'] = 'STATUS_OK'
+        res['reason'] = 'Databases tested OK'
+    return res
+
+
+class HealthProber(Thread):
+    """
+    Runs the health checks in the background so that health check requests never wait for dependencies.
+    """
+
+    def __init__(self, app, interval, max_age):
+        """
+        :param app: Flask app
+        :param interval: Seconds between checks
+        :param max_age: Seconds before a result is considered stale
+
+        :type app: flask.Flask
+        :type interval: int | float
+        :type max_age: int | float
+        """
+        super(HealthProber, self).__init__(name='health-prober', daemon=True)
+        self.app = app
+        self.interval = interval
+        self.max_age = max_age
+        self._result = None
+        self._result_ts = None
+        self._stop_event = Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def probe(self):
+        with self.app.app_context():
+            self._result = check_health(self.app)
+        self._result_ts = time.monotonic()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.probe()
+            except Exception as e:
+                self.app.logger.exception('Health probe failed: %s', e)
+            self._stop_event.wait(self.interval)
+
+    @property
+    def status(self):
+        """
+        :return: Latest health status
+        :rtype: dict
+        """
+        if self._result is None:
+            return {'status': 'STATUS_FAIL', 'reason': 'health check pending'}
+        res = dict(self._result)
+        res['age'] = round(time.monotonic() - self._result_ts, 1)
+        if res['age'] > self.max_age:
+            res['status'] = 'STATUS_FAIL'
+            res['reason'] = 'health check result is stale'
+        return res
+
+
+def init_health_prober(app):
+    interval = app.config['HEALTH_CHECK_INTERVAL']
+    app.health_prober = None
+    if interval:
+        app.health_prober = HealthProber(app, interval=interval, max_age=app.config['HEALTH_CHECK_MAX_AGE'])
+        app.health_prober.start()
+        app.logger.info('health_prober started')
+    return app
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+__author__ = 'lundberg'
+
+
+IN_PROGRESS = 'in_progress'
+DONE = 'done'
+
+
+class IdempotencyCache(object):
+    """
+    Outcomes of form submissions by idempotency key, a repeated submission gets the stored outcome
+    instead of being processed again.
+    """
+
+    def __init__(self, store, ttl=600, in_progress_ttl=60, wait=2, poll_interval=0.2):
+        """
+        :param store: Store shared by the workers, see se_leg_ra.store
+        :param ttl: Seconds an outcome is remembered
+        :param in_progress_ttl: Seconds a submission can be in progress, in case the processing worker dies
+        :param wait: Max seconds a repeated submission waits for the outcome of the first submission
+        :param poll_interval: Seconds between checks for the outcome
+
+        :type ttl: int
+        :type in_progress_ttl: int
+        :type wait: int | float
+        :type poll_interval: float
+        """
+        self.store = store
+        self.ttl = ttl
+        self.in_progress_ttl = in_progress_ttl
+        self.wait = wait
+        self.poll_interval = poll_interval
+
+    @staticmethod
+    def _key(eppn, idempotency_key):
+        return 'idempotency:{}:{}'.format(eppn, idempotency_key)
+
+    def begin(self, eppn, idempotency_key):
+        """
+        :param eppn: Eppn of the submitting user
+        :param idempotency_key: Idempotency key of the submitted form
+
+        :type eppn: six.string_types
+        :type idempotency_key: six.string_types
+
+        :return: True and None if the submission should be processed, else False and the stored outcome or
+                 None if the first submission still is in progress
+        :rtype: (bool, dict | None)
+        """
+        key = self._key(eppn, idempotency_key)
+        deadline = time.monotonic() + self.wait
+        while True:
+            # Fails while an earlier submission is in progress or done
+            if self.store.add(key, {'state': IN_PROGRESS}, self.in_progress_ttl):
+                return True, None
+            item = self.store.get(key)
+            if item is not None and item['state'] == DONE:
+                return False, item['outcome']
+            if time.monotonic() >= deadline:
+                return False, None
+            time.sleep(self.poll_interval)
+
+    def finish(self, eppn, idempotency_key, outcome):
+        """
+        :param eppn: Eppn of the submitting user
+        :param idempotency_key: Idempotency key of the submitted form
+        :param outcome: Outcome for repeated submissions
+
+        :type eppn: six.string_types
+        :type idempotency_key: six.string_types
+        :type outcome: dict
+        """
+        self.store.set(self._key(eppn, idempotency_key), {'state': DONE, 'outcome': outcome}, self.ttl)
+
+    def forget(self, eppn, idempotency_key):
+        """
+        Let a repeated submission be processed, for submissions that failed for a transient reason.
+
+        :param eppn: Eppn of the submitting user
+        :param idempotency_key: Idempotency key of the submitted form
+
+        :type eppn: six.string_types
+        :type idempotency_key: six.string_types
+        """
+        self.store.delete(self._key(eppn, idempotency_key))
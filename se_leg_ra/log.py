@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""
+Logging through a queue, the request threads only put records on the queue and a background thread formats
+and writes them.
+
+Log calls should pass their arguments separately, logger.info('Saved %s', x), so that messages are only
+formatted for records that are written. Records with mutable arguments are formatted before they are queued.
+"""
+
+import re
+import json
+import uuid
+import queue
+import atexit
+import random
+import logging
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from flask import has_request_context, request
+from se_leg_ra.metrics import LOG_RECORDS_DROPPED_TOTAL
+
+__author__ = 'lundberg'
+
+
+REQUEST_ID_HEADER = 'X-Request-Id'
+REQUEST_ID_ENVIRON_KEY = 'se_leg_ra.request_id'
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(request_id)s - %(message)s'
+
+# Swedish national identity numbers, the birth date part is kept
+NIN_RE = re.compile(r'\b(\d{8})\d{4}\b')
+
+
+def mask_nins(value):
+    """
+    :param value: Log message
+    :type value: str
+    :return: Message with the national identity numbers masked
+
+    >>> mask_nins("Form data: {'nin': '190102031234'}")
+    "Form data: {'nin': '19010203****'}"
+    """
+    return NIN_RE.sub(r'\1****', value)
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    Adds the id of the current request.
+    """
+
+    def filter(self, record):
+        record.request_id = None
+        if has_request_context():
+            record.request_id = request.environ.get(REQUEST_ID_ENVIRON_KEY)
+        return True
+
+
+class DebugSamplingFilter(logging.Filter):
+    """
+    Lets through a sample_rate fraction of the DEBUG records.
+    """
+
+    def __init__(self, sample_rate):
+        super(DebugSamplingFilter, self).__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.sample_rate >= 1:
+            return True
+        return random.random() < self.sample_rate
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread when the record can not change before it is
+    formatted, records are never pickled when using an in-process queue. Records are dropped when the queue
+    is full.
+    """
+
+    # Arguments that can be formatted later with the same result
+    IMMUTABLE_TYPES = (str, bytes, int, float, bool, type(None), datetime)
+
+    def _immutable(self, value):
+        if isinstance(value, tuple):
+            return all(self._immutable(item) for item in value)
+        return isinstance(value, self.IMMUTABLE_TYPES)
+
+    def prepare(self, record):
+        if record.args and not self._immutable(record.args):
+            # The arguments can be changed by the request before the listener formats the record
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # The traceback keeps the request frames alive until the record is formatted
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED_TOTAL.inc()
+
+
+class MaskingFormatter(logging.Formatter):
+
+    def format(self, record):
+        return mask_nins(super(MaskingFormatter, self).format(record))
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record.
+    """
+
+    def format(self, record):
+        data = {
+            'ts': datetime.utcfromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': mask_nins(record.getMessage()),
+            'request_id': getattr(record, 'request_id', None),
+            'module': record.module,
+            'line': record.lineno,
+        }
+        if record.exc_info:
+            data['exception'] = mask_nins(self.formatException(record.exc_info))
+        elif record.exc_text:
+            data['exception'] = mask_nins(record.exc_text)
+        return json.dumps(data, ensure_ascii=False)
+
+
+def init_request_id(app):
+
+    @app.before_request
+    def set_request_id():
+        request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+        request.environ[REQUEST_ID_ENVIRON_KEY] = request_id[:64]
+
+    @app.after_request
+    def add_request_id_header(response):
+        response.headers[REQUEST_ID_HEADER] = request.environ.get(REQUEST_ID_ENVIRON_KEY, '')
+        return response
+
+    return app
+
+
+def init_logging(app):
+    """
+    :param app: Flask app
+    :type app: flask.Flask
+    :return: Flask app
+    :rtype: flask.Flask
+    """
+    out_handler = logging.StreamHandler()
+    if app.config['LOG_FORMAT'] == 'json':
+        out_handler.setFormatter(JsonFormatter())
+    else:
+        out_handler.setFormatter(MaskingFormatter(TEXT_FORMAT))
+
+    log_queue = queue.Queue(maxsize=app.config['LOG_QUEUE_SIZE'])
+    queue_handler = LazyQueueHandler(log_queue)
+    # Filters run in the request thread, before the record is put on the queue
+    queue_handler.addFilter(DebugSamplingFilter(app.config['LOG_DEBUG_SAMPLE_RATE']))
+    queue_handler.addFilter(RequestIdFilter())
+    app.logger.addHandler(queue_handler)
+    app.logger.setLevel(app.config['LOG_LEVEL'])
+
+    app.log_listener = QueueListener(log_queue, out_handler)
+    app.log_listener.start()
+    # Write the queued records at exit
+    atexit.register(app.log_listener.stop)
+    return init_request_id(app)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+Prometheus metrics.
+
+When running several gunicorn workers the environment variable PROMETHEUS_MULTIPROC_DIR must point to an
+empty directory, writable by all workers, for the metrics to be aggregated over all workers.
+"""
+
+import os
+import flask
+from flask import request
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest
+from prometheus_client import CONTENT_TYPE_LATEST, multiprocess
+
+__author__ = 'lundberg'
+
+
+WHITELIST_LOOKUP_SECONDS = Histogram('se_leg_ra_whitelist_lookup_seconds', 'Whitelist lookup latency')
+WHITELIST_CACHE_TOTAL = Counter('se_leg_ra_whitelist_cache_total', 'Whitelist cache lookups', ['result'])
+USER_UPDATE_SECONDS = Histogram('se_leg_ra_user_update_seconds', 'User attribute update latency')
+PROOFING_LOG_SAVE_SECONDS = Histogram('se_leg_ra_proofing_log_save_seconds', 'Proofing log write latency')
+VETTING_REQUEST_SECONDS = Histogram('se_leg_ra_vetting_request_seconds', 'Vetting endpoint request latency')
+TEMPLATE_RENDER_SECONDS = Histogram('se_leg_ra_template_render_seconds', 'Template rendering latency',
+                                    ['template'])
+QR_NONCE_CACHE_TOTAL = Counter('se_leg_ra_qr_nonce_cache_total', 'QR code nonce lookups', ['result'])
+RATE_LIMITED_TOTAL = Counter('se_leg_ra_rate_limited_total', 'Rate limited requests', ['limit'])
+CIRCUIT_BREAKER_TRANSITIONS_TOTAL = Counter('se_leg_ra_circuit_breaker_transitions_total',
+                                            'Circuit breaker state changes', ['service', 'state'])
+LOG_RECORDS_DROPPED_TOTAL = Counter('se_leg_ra_log_records_dropped_total', 'Log records dropped on a full queue')
+MONGO_POOL_CHECKOUT_SECONDS = Histogram('se_leg_ra_mongo_pool_checkout_seconds',
+                                        'Time waiting for a MongoDB connection from the pool', ['address'])
+MONGO_POOL_CONNECTIONS_IN_USE = Gauge('se_leg_ra_mongo_pool_connections_in_use', 'MongoDB connections in use',
+                                      ['address'], multiprocess_mode='livesum')
+MONGO_POOL_CHECKOUT_FAILED_TOTAL = Counter('se_leg_ra_mongo_pool_checkout_failed_total',
+                                           'Failed MongoDB connection checkouts', ['address', 'reason'])
+PROOFING_STATS_ERRORS_TOTAL = Counter('se_leg_ra_proofing_stats_errors_total', 'Failed proofing statistics updates')
+PROOFINGS_TOTAL = Counter('se_leg_ra_proofings_total', 'Proofing attempts', ['method', 'outcome'])
+IN_FLIGHT_REQUESTS = Gauge('se_leg_ra_in_flight_requests', 'Requests being processed',
+                           multiprocess_mode='livesum')
+
+# Proofing outcomes
+OUTCOME_SUCCESS = 'success'
+OUTCOME_PENDING = 'pending'
+OUTCOME_INVALID_QR = 'invalid_qr'
+OUTCOME_OP_UNREACHABLE = 'op_unreachable'
+OUTCOME_SAVE_FAILURE = 'save_failure'
+OUTCOME_REPLAYED_QR = 'replayed_qr'
+OUTCOME_CIRCUIT_OPEN = 'circuit_open'
+
+
+def count_proofing(proofing_method, outcome):
+    PROOFINGS_TOTAL.labels(proofing_method, outcome).inc()
+
+
+def render_template(template_name, **context):
+    """
+    flask.render_template that records the rendering time.
+    """
+    with TEMPLATE_RENDER_SECONDS.labels(template_name).time():
+        return flask.render_template(template_name, **context)
+
+
+def generate_metrics():
+    """
+    :return: Metrics in the Prometheus text format and its content type
+    :rtype: tuple
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def init_metrics(app):
+
+    @app.before_request
+    def track_request_start():
+        IN_FLIGHT_REQUESTS.inc()
+        request.environ['se_leg_ra.in_flight'] = True
+
+    @app.teardown_request
+    def track_request_end(exc=None):
+        if request.environ.pop('se_leg_ra.in_flight', False):
+            IN_FLIGHT_REQUESTS.dec()
+
+    return app
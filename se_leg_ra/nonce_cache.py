@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import json
+from se_leg_ra.metrics import QR_NONCE_CACHE_TOTAL
+
+__author__ = 'lundberg'
+
+
+def opaque_nonce(opaque):
+    """
+    :param opaque: QR code data
+    :type opaque: six.string_types
+    :return: The nonce of the QR code or None if the data can not be read
+
+    >>> opaque_nonce('1{"token": "a_token", "nonce": "a_nonce"}')
+    'a_nonce'
+    >>> opaque_nonce('1{}') is None
+    True
+    """
+    try:
+        return json.loads(opaque[1:]).get('nonce')
+    except (ValueError, AttributeError):
+        return None
+
+
+class NonceCache(object):
+    """
+    Recently used QR code nonces, used to reject a rescanned QR code without writing to the proofing log
+    or calling the vetting endpoint.
+    """
+
+    def __init__(self, store, ttl=86400):
+        """
+        :param store: Store shared by the workers, see se_leg_ra.store
+        :param ttl: Seconds a nonce is remembered
+
+        :type ttl: int
+        """
+        self.store = store
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(nonce):
+        return 'nonce:{}'.format(nonce)
+
+    def seen(self, nonce):
+        """
+        :param nonce: QR code nonce
+        :type nonce: six.string_types
+        :return: True if the nonce has been used
+        :rtype: bool
+        """
+        if self.store.get(self._key(nonce)) is not None:
+            self.hits += 1
+            QR_NONCE_CACHE_TOTAL.labels('hit').inc()
+            return True
+        self.misses += 1
+        QR_NONCE_CACHE_TOTAL.labels('miss').inc()
+        return False
+
+    def claim(self, nonce):
+        """
+        :param nonce: QR code nonce
+        :type nonce: six.string_types
+        :return: True if the nonce was unused, False if it already has been claimed
+        :rtype: bool
+        """
+        claimed = self.store.add(self._key(nonce), True, self.ttl)
+        if not claimed:
+            self.hits += 1
+            QR_NONCE_CACHE_TOTAL.labels('hit').inc()
+        return claimed
+
+    def release(self, nonce):
+        """
+        Make a claimed nonce usable again, for proofings that could not be completed.
+
+        :param nonce: QR code nonce
+        :type nonce: six.string_types
+        """
+        self.store.delete(self._key(nonce))
+
+    @property
+    def stats(self):
+        """
+        :return: Nonce cache statistics for this process
+        :rtype: dict
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import time
+import requests
+from datetime import datetime, timedelta
+from threading import Thread, Event
+from se_leg_ra.db import DELIVERY_SENT, DELIVERY_FAILED, DELIVERY_PENDING, STATS_DELIVERY_FAILED
+from se_leg_ra.db import proofing_element_from_document
+from se_leg_ra.metrics import count_proofing, OUTCOME_SUCCESS, OUTCOME_INVALID_QR, OUTCOME_OP_UNREACHABLE
+
+__author__ = 'lundberg'
+
+
+def retry_delay(attempts, backoff, max_backoff):
+    """
+    :param attempts: Number of delivery attempts made
+    :param backoff: Seconds to wait after the first failed attempt
+    :param max_backoff: Max seconds to wait between attempts
+
+    :type attempts: int
+    :type backoff: int | float
+    :type max_backoff: int | float
+
+    :return: Seconds to wait before next attempt
+    :rtype: int | float
+
+    >>> retry_delay(1, 2, 300)
+    2
+    >>> retry_delay(4, 2, 300)
+    16
+    >>> retry_delay(20, 2, 300)
+    300
+    """
+    return min(backoff * 2 ** (attempts - 1), max_backoff)
+
+
+def _count_stats(app, proofing_element, outcome):
+    # The outcome in the proofing statistics matches the final delivery status, see ProofingLog.daily_counts
+    if app.proofing_stats is not None:
+        app.proofing_stats.increment([proofing_element.to_dict()], outcome)
+
+
+def deliver_pending(app):
+    """
+    Send one pending proofing to the vetting endpoint.
+
+    :param app: Flask app
+    :type app: flask.Flask
+
+    :return: True if a pending proofing was found
+    :rtype: bool
+    """
+    config = app.config
+    doc = app.proofing_log.claim_pending_delivery(lease_time=config['VETTING_OUTBOX_LEASE_TIME'])
+    if doc is None:
+        return False
+
+    attempts = doc['delivery']['attempts']
+    proofing_element = proofing_element_from_document(doc)
+    try:
+        r = app.vetting_client.send(proofing_element, proofing_element.identity)
+    except requests.RequestException as e:
+        app.logger.error('Could not reach the vetting endpoint: %s', e)
+        count_proofing(proofing_element.proofing_method, OUTCOME_OP_UNREACHABLE)
+        error = 'Could not reach the vetting endpoint'
+    else:
+        if r.status_code == 200:
+            app.logger.info('Delivered proofing %s', doc['_id'])
+            app.proofing_log.set_delivery_result(doc['_id'], DELIVERY_SENT)
+            count_proofing(proofing_element.proofing_method, OUTCOME_SUCCESS)
+            _count_stats(app, proofing_element, OUTCOME_SUCCESS)
+            return True
+        if r.status_code < 500:
+            # The nonce is invalid or expired, retrying will not help
+            app.logger.error('Bad request to vetting endpoint: %s', r.content)
+            app.proofing_log.set_delivery_result(doc['_id'], DELIVERY_FAILED, error='Rejected by the vetting endpoint')
+            count_proofing(proofing_element.proofing_method, OUTCOME_INVALID_QR)
+            _count_stats(app, proofing_element, STATS_DELIVERY_FAILED)
+            return True
+        app.logger.error('Vetting endpoint error %s: %s', r.status_code, r.content)
+        count_proofing(proofing_element.proofing_method, OUTCOME_OP_UNREACHABLE)
+        error = 'Vetting endpoint error'
+
+    if attempts >= config['VETTING_OUTBOX_MAX_ATTEMPTS']:
+        app.logger.error('Giving up delivery of proofing %s after %s attempts', doc['_id'], attempts)
+        app.proofing_log.set_delivery_result(doc['_id'], DELIVERY_FAILED, error=error)
+        _count_stats(app, proofing_element, STATS_DELIVERY_FAILED)
+        return True
+    delay = retry_delay(attempts, config['VETTING_OUTBOX_BACKOFF'], config['VETTING_OUTBOX_MAX_BACKOFF'])
+    next_attempt_ts = datetime.utcnow() + timedelta(seconds=delay)
+    app.proofing_log.set_delivery_result(doc['_id'], DELIVERY_PENDING, next_attempt_ts=next_attempt_ts, error=error)
+    return True
+
+
+class OutboxWorker(Thread):
+    """
+    Background thread delivering pending proofings. Several workers, in the same or in other processes,
+    can run at the same time as every delivery is claimed before it is sent.
+    """
+
+    def __init__(self, app):
+        super(OutboxWorker, self).__init__(name='outbox-worker', daemon=True)
+        self.app = app
+        self.poll_interval = app.config['VETTING_OUTBOX_POLL_INTERVAL']
+        self._stop_event = Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        self.app.logger.info('Outbox worker started')
+        while not self._stop_event.is_set():
+            try:
+                with self.app.app_context():
+                    found = deliver_pending(self.app)
+            except Exception as e:
+                self.app.logger.exception('Outbox delivery failed: %s', e)
+                found = False
+            if not found:
+                self._stop_event.wait(self.poll_interval)
+        self.app.logger.info('Outbox worker stopped')
+
+
+def run_outbox_worker(app):
+    """
+    Deliver pending proofings in the foreground until interrupted, uses the worker thread of the app if it
+    already has one.
+
+    :param app: Flask app
+    :type app: flask.Flask
+    """
+    worker = app.outbox_worker
+    if worker is None or not worker.is_alive():
+        worker = OutboxWorker(app)
+        worker.start()
+    try:
+        while worker.is_alive():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        worker.stop()
+        worker.join()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""
+Metrics for the MongoDB connection pools, pool checkout wait times and connections in use per server.
+"""
+
+import time
+import threading
+from pymongo import monitoring
+from se_leg_ra.metrics import MONGO_POOL_CHECKOUT_SECONDS, MONGO_POOL_CONNECTIONS_IN_USE
+from se_leg_ra.metrics import MONGO_POOL_CHECKOUT_FAILED_TOTAL
+
+__author__ = 'lundberg'
+
+
+def _address(event):
+    return '{}:{}'.format(*event.address)
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """
+    Checkouts are started and finished in the same thread, the start time is kept per thread and server.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _started(self):
+        started = getattr(self._local, 'started', None)
+        if started is None:
+            started = self._local.started = {}
+        return started
+
+    def connection_check_out_started(self, event):
+        self._started()[event.address] = time.monotonic()
+
+    def connection_checked_out(self, event):
+        start = self._started().pop(event.address, None)
+        if start is not None:
+            MONGO_POOL_CHECKOUT_SECONDS.labels(_address(event)).observe(time.monotonic() - start)
+        MONGO_POOL_CONNECTIONS_IN_USE.labels(_address(event)).inc()
+
+    def connection_check_out_failed(self, event):
+        self._started().pop(event.address, None)
+        MONGO_POOL_CHECKOUT_FAILED_TOTAL.labels(_address(event), event.reason).inc()
+
+    def connection_checked_in(self, event):
+        MONGO_POOL_CONNECTIONS_IN_USE.labels(_address(event)).dec()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+
+_listener = None
+_lock = threading.Lock()
+
+
+def init_pool_monitor(app):
+    """
+    Register the listener for all MongoDB clients created after this call, call before creating the databases.
+
+    :param app: Flask app
+    :type app: flask.Flask
+    :return: Flask app
+    :rtype: flask.Flask
+    """
+    global _listener
+    with _lock:
+        if _listener is None:
+            _listener = PoolMetricsListener()
+            monitoring.register(_listener)
+    return app
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import math
+import time
+import hashlib
+from flask import current_app, request
+from se_leg_ra.metrics import RATE_LIMITED_TOTAL
+
+__author__ = 'lundberg'
+
+
+def _available(state, capacity, rate, now):
+    if state is None:
+        return capacity
+    return min(capacity, state['tokens'] + (now - state['ts']) * rate)
+
+
+def take_token(store, key, capacity, period, cost=1, retries=5):
+    """
+    Take tokens from a token bucket kept in a shared store. The bucket holds at most capacity tokens and
+    is refilled with capacity tokens per period.
+
+    :param store: Store shared by the workers, see se_leg_ra.store
+    :param key: Bucket key
+    :param capacity: Max number of tokens
+    :param period: Seconds to refill an empty bucket
+    :param cost: Number of tokens to take
+    :param retries: Number of attempts to update the bucket when other requests update it at the same time
+
+    :type key: str
+    :type capacity: int
+    :type period: int | float
+    :type cost: int
+    :type retries: int
+
+    :return: True if the tokens were taken and the number of seconds until the tokens are available
+    :rtype: (bool, float)
+    """
+    rate = capacity / period
+    if cost > capacity:
+        # Never available, the caller should make smaller requests
+        return False, period
+    for _ in range(retries):
+        now = time.time()
+        state = store.get(key)
+        tokens = _available(state, capacity, rate, now)
+        if tokens < cost:
+            return False, (cost - tokens) / rate
+        # A full bucket is the same as a missing bucket, the state can expire after a period
+        if store.cas(key, state, {'tokens': tokens - cost, 'ts': now}, period):
+            return True, 0
+    # Too many concurrent requests for the same bucket
+    return False, cost / rate
+
+
+def wait_time(store, key, capacity, period, cost=1):
+    """
+    :return: Seconds until cost tokens are available in the bucket, 0 if they are available now
+    :rtype: float
+    """
+    rate = capacity / period
+    if cost > capacity:
+        return period
+    tokens = _available(store.get(key), capacity, rate, time.time())
+    return max(0, (cost - tokens) / rate)
+
+
+def bucket_key(limit, value):
+    """
+    :param limit: Name of the limit
+    :param value: Limited value, only a digest of it is stored
+
+    :type limit: str
+    :type value: str
+
+    :return: Bucket key
+    :rtype: str
+    """
+    return 'ratelimit:{}:{}'.format(limit, hashlib.sha256(value.encode('utf-8')).hexdigest())
+
+
+def take_limit_tokens(store, limits, costs):
+    """
+    Take tokens from the buckets of all limited values. Nothing is taken if any bucket has too few tokens,
+    apart from when concurrent requests empty a bucket between the check and the take.
+
+    :param store: Store shared by the workers, see se_leg_ra.store
+    :param limits: Limit name to (capacity, period), see RATE_LIMITS
+    :param costs: Limit name to limited value to number of tokens
+
+    :type limits: dict
+    :type costs: dict
+
+    :return: None and 0 if the tokens were taken, else the name of the exceeded limit and the seconds to wait
+    :rtype: (str | None, float)
+    """
+    buckets = []
+    for limit, (capacity, period) in sorted(limits.items()):
+        for value, cost in sorted(costs.get(limit, {}).items()):
+            if value:
+                buckets.append((limit, bucket_key(limit, value), capacity, period, cost))
+    for limit, key, capacity, period, cost in buckets:
+        wait = wait_time(store, key, capacity, period, cost)
+        if wait > 0:
+            return limit, wait
+    for limit, key, capacity, period, cost in buckets:
+        allowed, retry_after = take_token(store, key, capacity, period, cost)
+        if not allowed:
+            return limit, retry_after
+    return None, 0
+
+
+def over_capacity(limits, costs):
+    """
+    :param limits: Limit name to (capacity, period), see RATE_LIMITS
+    :param costs: Limit name to limited value to number of tokens
+
+    :type limits: dict
+    :type costs: dict
+
+    :return: Name of a limit with a capacity below the cost, such requests are never allowed, or None
+    :rtype: str | None
+    """
+    for limit, (capacity, period) in sorted(limits.items()):
+        for value, cost in costs.get(limit, {}).items():
+            if value and cost > capacity:
+                return limit
+    return None
+
+
+def request_costs(cost=1):
+    """
+    :param cost: Number of tokens the request costs for the RA user and the client IP
+    :type cost: int
+    :return: Costs for take_limit_tokens
+    :rtype: dict
+    """
+    # The same headers as require_eppn reads
+    eppn = request.environ.get('HTTP_EPPN') or request.environ.get('HTTP_PERSONALIDENTITYNUMBER')
+    return {
+        'eppn': {eppn: cost},
+        'ip': {request.remote_addr: cost},
+    }
+
+
+def check_rate_limits(costs):
+    """
+    :param costs: Limit name to limited value to number of tokens
+    :type costs: dict
+    :return: Seconds to wait if the request is rate limited, else None
+    :rtype: int | None
+    """
+    if not current_app.config['RATE_LIMIT_ENABLED']:
+        return None
+    limit, retry_after = take_limit_tokens(current_app.store, current_app.config['RATE_LIMITS'], costs)
+    if limit is None:
+        return None
+    current_app.logger.warning('Rate limited by %s limit: %s', limit, request.path)
+    RATE_LIMITED_TOTAL.labels(limit).inc()
+    return max(1, int(math.ceil(retry_after)))
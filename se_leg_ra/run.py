@@ -38,5 +38,5 @@ app = init_se_leg_ra_app(name, {})
 
 
 if __name__ == '__main__':
-    app.logger.info('Starting {} app...'.format(name))
+    app.logger.info('Starting %s app...', name)
     app.run()
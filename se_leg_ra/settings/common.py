@@ -14,15 +14,130 @@ DEBUG = False
 
 # Database URIs
 DB_URI = ''
+# MongoClient options per collection, added to DB_URI, e.g. maxPoolSize, minPoolSize, waitQueueTimeoutMS,
+# connectTimeoutMS, socketTimeoutMS and serverSelectionTimeoutMS. Pool waits are in the metrics.
+USER_DB_MONGO_OPTIONS = {
+    'maxPoolSize': 50,
+    'waitQueueTimeoutMS': 2000,
+}
+PROOFING_LOG_MONGO_OPTIONS = {
+    'maxPoolSize': 50,
+    'waitQueueTimeoutMS': 5000,
+}
+# Read preference for whitelist lookups, e.g. primary or secondaryPreferred. A lagging secondary can still
+# return an officer that was just removed, who is then cached as whitelisted for WHITELIST_CACHE_TTL seconds
+# after the whitelist cache was invalidated. Only use a secondary mode if that delay of revocations is
+# acceptable, and bound the lag with maxStalenessSeconds in USER_DB_MONGO_OPTIONS. The proofing log is always
+# read from and written to the primary.
+WHITELIST_READ_PREFERENCE = 'primary'
 REDIS_HOST = ''
 REDIS_PORT = 6379
 REDIS_DB = 0
+REDIS_PASSWORD = None
+REDIS_SOCKET_TIMEOUT = 1
+
+# Database index setup, 'background' (once per cluster and index version, without blocking start up),
+# 'startup' (before the app is created) or 'never' (use "flask setup-indexes")
+DB_INDEX_SETUP = 'background'
+
+# Whitelist cache, set WHITELIST_CACHE_SIZE to 0 to disable
+# Changes made by the application are seen by all workers within WHITELIST_CACHE_VERSION_CHECK_INTERVAL seconds,
+# manual changes to the users collection are seen when the cached entry expires.
+WHITELIST_CACHE_SIZE = 1000
+WHITELIST_CACHE_TTL = 300
+WHITELIST_CACHE_NEGATIVE_TTL = 30
+WHITELIST_CACHE_VERSION_CHECK_INTERVAL = 10
+
+# Store for QR code nonces and submitted forms
+# 'memory': every worker process has its own store
+# 'file': shared by the workers on the host through the database file CACHE_PATH, put it on a local file
+#         system like /dev/shm
+# 'redis': shared by all nodes through the Redis server at REDIS_HOST
+CACHE_BACKEND = 'memory'
+CACHE_PATH = None
+# Max number of keys for the memory and file stores
+CACHE_MAX_SIZE = 100000
+CACHE_KEY_PREFIX = 'se_leg_ra:'
+
+# Rescanned QR codes are rejected without writing to the proofing log or calling the vetting endpoint.
+# With the default 'memory' CACHE_BACKEND every worker process only knows the nonces it has seen itself, so a
+# rescan handled by another worker is sent to the vetting endpoint. Use 'file' or 'redis' with several workers.
+QR_NONCE_CACHE_ENABLED = True
+QR_NONCE_CACHE_TTL = 86400
+
+# Repeated submissions of a form get the outcome of the first submission
+IDEMPOTENCY_ENABLED = True
+IDEMPOTENCY_TTL = 600
+# Seconds a submission can be in progress
+IDEMPOTENCY_IN_PROGRESS_TTL = 60
+# Seconds a repeated submission waits for the outcome before it is told that the first one still is processed,
+# keep it short as the waiting request holds a worker
+IDEMPOTENCY_WAIT = 2
+
+# JSON batch API, max proofings per request and max concurrent calls to the vetting endpoint per request.
+# VETTING_POOL_MAXSIZE should be at least API_DELIVERY_CONCURRENCY. Every proofing costs one token from each
+# RATE_LIMITS bucket, batches costing more than a bucket capacity are rejected with 413.
+API_MAX_BATCH_SIZE = 100
+API_DELIVERY_CONCURRENCY = 5
+# Seconds a batch waits for the vetting endpoint, proofings not sent by then get status op_unreachable. Keep it
+# well below the gunicorn worker timeout, 30 seconds in docker/start.sh.
+API_DELIVERY_DEADLINE = 20
+
+# Token buckets for proofing submissions, limit name to (capacity, seconds to refill an empty bucket).
+# Limits: 'eppn' per RA user, 'nin' per national identity number and 'ip' per client IP. Shared by the
+# workers through the CACHE_BACKEND store.
+RATE_LIMIT_ENABLED = True
+RATE_LIMITS = {
+    'eppn': (30, 60),
+    'nin': (5, 300),
+    'ip': (60, 60),
+}
+
+# Group commit of proofing log writes, only useful with threaded workers (worker_threads > 1)
+PROOFING_LOG_GROUP_COMMIT = False
+# Max seconds a write waits for writes from other threads
+PROOFING_LOG_GROUP_COMMIT_WINDOW = 0.003
+PROOFING_LOG_GROUP_COMMIT_MAX_DOCS = 50
+
+# Write new proofing log documents with short keys and compressed QR data, old documents are read as before.
+# Rewrite old documents with "flask compact-proofing-log" and compare sizes with "flask proofing-log-size-report".
+# The indexes for the new format are set up at the next start.
+PROOFING_LOG_COMPACT = False
+# With PROOFING_LOG_COMPACT, documents in the original format can remain. They are indexed and matched by audit
+# queries next to the compact documents. Turn it off when compact-proofing-log has rewritten all documents, which
+# drops the original format indexes.
+PROOFING_LOG_LEGACY_DOCUMENTS = True
 
 # Secret key
 SECRET_KEY = None
 
+# Health checks, run every HEALTH_CHECK_INTERVAL seconds in the background (0 runs them in the request)
+HEALTH_CHECK_INTERVAL = 5
+# Seconds before a health check result is considered stale
+HEALTH_CHECK_MAX_AGE = 30
+# Optional informational checks
+HEALTH_CHECK_VETTING_ENDPOINT = False
+HEALTH_CHECK_PROOFING_LOG_WRITE = False
+
+# Static files
+# Path to the manifest.json written by "python -m se_leg_ra.static_assets", static_url_for then
+# returns the content hashed file names
+STATIC_MANIFEST = None
+
+# Template caches
+# Compiled templates are written to this directory and shared by all workers, None disables the cache
+TEMPLATE_BYTECODE_CACHE_DIR = None
+# Cache the parts of the pages that are the same for all users
+TEMPLATE_FRAGMENT_CACHE = True
+
 # Logging
 LOG_LEVEL = 'INFO'
+# json or text
+LOG_FORMAT = 'json'
+# Records waiting to be written, records are dropped when the queue is full
+LOG_QUEUE_SIZE = 10000
+# Fraction of the DEBUG records that are written
+LOG_DEBUG_SAMPLE_RATE = 1.0
 
 # App settings
 LOGIN_URL = '/login/'
@@ -37,6 +152,54 @@ AL2_IDP_EXCEPTIONS = []
 MFA_AUTHN_CONTEXT_CLASSES = []
 MFA_IDP_EXCEPTIONS = []
 
+# Users allowed to query the proofing log under /audit
+AUDIT_EPPNS = []
+AUDIT_PAGE_SIZE = 100
+AUDIT_MAX_PAGE_SIZE = 1000
+# Max proofings per /audit/export response, continue with after_id or use "flask export-proofings"
+AUDIT_EXPORT_MAX_DOCS = 100000
+AUDIT_EXPORT_BATCH_SIZE = 1000
+# Max days per /audit/stats response
+AUDIT_STATS_MAX_DAYS = 366
+
+# Daily proofing counts per RA user, proofing method and outcome, see se_leg_ra.db.ProofingStatsDB.
+# Build the counts for proofings saved before enabling with "flask backfill-proofing-stats".
+PROOFING_STATS_ENABLED = True
+
 # Authentication info for OP
 RA_APP_ID = ''
 RA_APP_SECRET = ''
+
+# OP vetting endpoint
+VETTING_ENDPOINT = ''
+# Timeouts in seconds
+VETTING_CONNECT_TIMEOUT = 3.05
+VETTING_READ_TIMEOUT = 10
+# Only failed connection attempts are retried
+VETTING_RETRIES = 2
+VETTING_RETRY_BACKOFF_FACTOR = 0.2
+# Connections kept open per worker process, should be at least the number of worker threads
+# or worker connections when using the gevent worker class
+VETTING_POOL_CONNECTIONS = 1
+VETTING_POOL_MAXSIZE = 10
+# Circuit breaker, proofings fail fast without being saved while the OP is failing. The circuit opens after
+# VETTING_CIRCUIT_FAILURE_THRESHOLD failed calls, or calls slower than VETTING_CIRCUIT_SLOW_CALL_TIME seconds,
+# within VETTING_CIRCUIT_FAILURE_WINDOW seconds. After VETTING_CIRCUIT_RESET_TIMEOUT seconds one call at a
+# time is let through until a call succeeds. The state is shared by the workers through the CACHE_BACKEND store.
+VETTING_CIRCUIT_BREAKER_ENABLED = True
+VETTING_CIRCUIT_FAILURE_THRESHOLD = 5
+VETTING_CIRCUIT_FAILURE_WINDOW = 60
+VETTING_CIRCUIT_SLOW_CALL_TIME = 5
+VETTING_CIRCUIT_RESET_TIMEOUT = 30
+
+# Outbox mode, proofings are saved as pending and delivered to the vetting endpoint in the background
+VETTING_OUTBOX_ENABLED = False
+# Run a delivery thread in every worker process, disable if deliveries are made by "flask outbox-worker"
+VETTING_OUTBOX_WORKER_THREAD = True
+VETTING_OUTBOX_POLL_INTERVAL = 1
+# Seconds a claimed delivery is reserved for a worker
+VETTING_OUTBOX_LEASE_TIME = 60
+VETTING_OUTBOX_MAX_ATTEMPTS = 10
+# Seconds between attempts, doubled after each failed attempt
+VETTING_OUTBOX_BACKOFF = 2
+VETTING_OUTBOX_MAX_BACKOFF = 300
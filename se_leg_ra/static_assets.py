@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+Build of the static files for production.
+
+Every file is copied with a content hash in its name, together with gzip and, if the brotli package is
+installed, brotli compressed variants. Source maps are left out. The files are also copied with their
+original names for clients of older pages. A manifest mapping the original names to the hashed names is
+written to manifest.json, point STATIC_MANIFEST to it to make static_url_for use the hashed names.
+
+Usage:
+    python -m se_leg_ra.static_assets SOURCE_DIR DESTINATION_DIR
+
+The hashed files never change and can be served with "Cache-Control: public, max-age=31536000, immutable",
+for nginx something like:
+
+    location ~* \\.[0-9a-f]{12}\\.\\w+$ {
+        gzip_static on;
+        brotli_static on;
+        add_header Cache-Control "public, max-age=31536000, immutable";
+    }
+"""
+
+import os
+import re
+import sys
+import json
+import gzip
+import hashlib
+import posixpath
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+__author__ = 'lundberg'
+
+
+HASH_LENGTH = 12
+MANIFEST_NAME = 'manifest.json'
+COMPRESSED_EXTENSIONS = ('.css', '.js', '.svg', '.eot', '.ttf')
+EXCLUDED_EXTENSIONS = ('.map',)
+
+CSS_URL_RE = re.compile(r'url\((?P<quote>[\'"]?)(?P<url>[^\'")?#]+)(?P<suffix>[^\'")]*)(?P=quote)\)')
+SOURCE_MAP_RE = re.compile(r'(/\*# sourceMappingURL=[^*]*\*/|//# sourceMappingURL=\S*)')
+
+
+def hashed_name(name, content):
+    """
+    >>> hashed_name('css/bootstrap.min.css', b'')
+    'css/bootstrap.min.e3b0c44298fc.css'
+    """
+    root, ext = posixpath.splitext(name)
+    return '{}.{}{}'.format(root, hashlib.sha256(content).hexdigest()[:HASH_LENGTH], ext)
+
+
+def rewrite_css_urls(name, css, manifest):
+    """
+    Point relative url() references in a stylesheet to the hashed file names.
+
+    >>> rewrite_css_urls('css/a.css', 'url(../fonts/f.eot?#iefix)', {'fonts/f.eot': 'fonts/f.123.eot'})
+    'url(../fonts/f.123.eot?#iefix)'
+    """
+    base = posixpath.dirname(name)
+
+    def replace(match):
+        url = match.group('url')
+        target = posixpath.normpath(posixpath.join(base, url))
+        if target not in manifest:
+            return match.group(0)
+        hashed_url = posixpath.relpath(manifest[target], base)
+        return 'url({quote}{url}{suffix}{quote})'.format(quote=match.group('quote'), url=hashed_url,
+                                                         suffix=match.group('suffix'))
+
+    return CSS_URL_RE.sub(replace, css)
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def _write_compressed(path, content):
+    # mtime=0 gives the same output for the same input
+    _write('{}.gz'.format(path), gzip.compress(content, compresslevel=9, mtime=0))
+    if brotli is not None:
+        _write('{}.br'.format(path), brotli.compress(content))
+
+
+def build_static(source_dir, destination_dir):
+    """
+    :param source_dir: Directory with the static files
+    :param destination_dir: Directory to write the built files to
+
+    :type source_dir: str
+    :type destination_dir: str
+
+    :return: Manifest of original name to hashed name
+    :rtype: dict
+    """
+    names = []
+    for root, _, files in os.walk(source_dir):
+        for filename in files:
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, source_dir).replace(os.sep, '/')
+            if not name.endswith(EXCLUDED_EXTENSIONS) and name != MANIFEST_NAME:
+                names.append(name)
+    # Stylesheets refer to other files and are built last
+    names.sort(key=lambda n: (n.endswith('.css'), n))
+
+    manifest = {}
+    for name in names:
+        with open(os.path.join(source_dir, name), 'rb') as f:
+            content = f.read()
+        if name.endswith(('.css', '.js')):
+            text = SOURCE_MAP_RE.sub('', content.decode('utf-8'))
+            if name.endswith('.css'):
+                text = rewrite_css_urls(name, text, manifest)
+            content = text.encode('utf-8')
+        manifest[name] = hashed_name(name, content)
+        for output_name in {name, manifest[name]}:
+            output_path = os.path.join(destination_dir, output_name)
+            _write(output_path, content)
+            if name.endswith(COMPRESSED_EXTENSIONS):
+                _write_compressed(output_path, content)
+
+    _write(os.path.join(destination_dir, MANIFEST_NAME), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+
+def load_manifest(path):
+    """
+    :param path: Path to manifest.json
+    :type path: str
+    :return: Manifest of original name to hashed name
+    :rtype: dict
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    if len(sys.argv) != 3:
+        print('Usage: python -m se_leg_ra.static_assets SOURCE_DIR DESTINATION_DIR')
+        sys.exit(1)
+    source_dir, destination_dir = sys.argv[1:]
+    manifest = build_static(source_dir, destination_dir)
+    print('Built {} static files in {}'.format(len(manifest), destination_dir))
+
+
+if __name__ == '__main__':
+    main()
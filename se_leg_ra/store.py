@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+
+"""
+Expiring key value stores for state shared by the requests of a worker process, by all workers on a host or
+by all nodes. Values must be JSON serializable.
+
+CACHE_BACKEND selects the store:
+    memory: MemoryStore, every worker process has its own store
+    file: SqliteStore, shared by the workers on the host through the database file CACHE_PATH
+    redis: RedisStore, shared by all nodes using the Redis server at REDIS_HOST
+"""
+
+import os
+import json
+import time
+import sqlite3
+from collections import OrderedDict
+from threading import Lock, local
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+__author__ = 'lundberg'
+
+
+class MemoryStore(object):
+    """
+    Store for this process only, the least recently used key is evicted when the store is full.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def size(self):
+        return len(self)
+
+    def _get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return item
+
+    def _set(self, key, value, expires):
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def get(self, key):
+        """
+        :param key: Key
+        :type key: str
+        :return: Value or None if not found
+        """
+        with self._lock:
+            item = self._get(key)
+        return item[0] if item else None
+
+    def set(self, key, value, ttl):
+        """
+        :param key: Key
+        :param value: Value
+        :param ttl: Seconds until the key expires
+
+        :type key: str
+        :type ttl: int | float
+        """
+        with self._lock:
+            self._set(key, value, time.monotonic() + ttl)
+
+    def add(self, key, value, ttl):
+        """
+        :param key: Key
+        :param value: Value
+        :param ttl: Seconds until the key expires
+
+        :type key: str
+        :type ttl: int | float
+
+        :return: True if the key was set, False if it already was set
+        :rtype: bool
+        """
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            self._set(key, value, time.monotonic() + ttl)
+            return True
+
+    def delete(self, key):
+        """
+        :param key: Key
+        :type key: str
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key, amount, ttl):
+        """
+        :param key: Key
+        :param amount: Amount to add to the value
+        :param ttl: Seconds until the key expires, if the key is created
+
+        :type key: str
+        :type amount: int
+        :type ttl: int | float
+
+        :return: New value
+        :rtype: int
+        """
+        with self._lock:
+            item = self._get(key)
+            if item is None:
+                item = (0, time.monotonic() + ttl)
+            value = item[0] + amount
+            self._set(key, value, item[1])
+            return value
+
+    def cas(self, key, expected, value, ttl):
+        """
+        Compare and set.
+
+        :param key: Key
+        :param expected: Current value, None if the key should not exist
+        :param value: New value
+        :param ttl: Seconds until the key expires
+
+        :type key: str
+        :type ttl: int | float
+
+        :return: True if the key had the expected value and was set
+        :rtype: bool
+        """
+        with self._lock:
+            item = self._get(key)
+            if (item[0] if item else None) != expected:
+                return False
+            self._set(key, value, time.monotonic() + ttl)
+            return True
+
+
+class SqliteStore(object):
+    """
+    Store shared by all processes using the same database file. Put the file on a local file system,
+    preferably /dev/shm.
+    """
+    # Expired keys are removed, and the size is enforced, every PRUNE_INTERVAL writes
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, path, max_size=100000):
+        self.path = path
+        self.max_size = max_size
+        self._local = local()
+        self._writes = 0
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, value TEXT, expires REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS store_expires ON store (expires)')
+
+    def _connection(self):
+        # One connection per thread and process, connections can not be shared by forked workers
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self, f):
+        now = time.time()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = f(conn, now)
+            self._writes += 1
+            if self._writes % self.PRUNE_INTERVAL == 0:
+                self._prune(conn, now)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return result
+
+    def _prune(self, conn, now):
+        conn.execute('DELETE FROM store WHERE expires <= ?', (now,))
+        conn.execute('DELETE FROM store WHERE key IN (SELECT key FROM store ORDER BY expires DESC LIMIT -1 OFFSET ?)',
+                     (self.max_size,))
+
+    @staticmethod
+    def _get(conn, key, now):
+        row = conn.execute('SELECT value, expires FROM store WHERE key = ? AND expires > ?', (key, now)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    @staticmethod
+    def _set(conn, key, value, expires):
+        conn.execute('INSERT OR REPLACE INTO store (key, value, expires) VALUES (?, ?, ?)',
+                     (key, json.dumps(value), expires))
+
+    def __len__(self):
+        return self._connection().execute('SELECT count(*) FROM store WHERE expires > ?',
+                                          (time.time(),)).fetchone()[0]
+
+    @property
+    def size(self):
+        return len(self)
+
+    def get(self, key):
+        item = self._get(self._connection(), key, time.time())
+        return item[0] if item else None
+
+    def set(self, key, value, ttl):
+        self._transaction(lambda conn, now: self._set(conn, key, value, now + ttl))
+
+    def add(self, key, value, ttl):
+        def add(conn, now):
+            if self._get(conn, key, now) is not None:
+                return False
+            self._set(conn, key, value, now + ttl)
+            return True
+        return self._transaction(add)
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM store WHERE key = ?', (key,))
+
+    def incr(self, key, amount, ttl):
+        def incr(conn, now):
+            item = self._get(conn, key, now) or (0, now + ttl)
+            value = item[0] + amount
+            self._set(conn, key, value, item[1])
+            return value
+        return self._transaction(incr)
+
+    def cas(self, key, expected, value, ttl):
+        def cas(conn, now):
+            item = self._get(conn, key, now)
+            if (item[0] if item else None) != expected:
+                return False
+            self._set(conn, key, value, now + ttl)
+            return True
+        return self._transaction(cas)
+
+
+class RedisStore(object):
+    """
+    Store shared by all nodes using the same Redis server, Redis evicts keys according to its maxmemory-policy.
+    """
+
+    def __init__(self, client, prefix=''):
+        """
+        :param client: Redis client
+        :param prefix: Prefix for all keys
+
+        :type client: redis.StrictRedis
+        :type prefix: str
+        """
+        self.max_size = None
+        self.prefix = prefix
+        self._redis = client
+
+    def _key(self, key):
+        return '{}{}'.format(self.prefix, key)
+
+    @staticmethod
+    def _ms(ttl):
+        return max(int(ttl * 1000), 1)
+
+    @property
+    def size(self):
+        # The database can be shared with other applications, its size is not the size of this store
+        return None
+
+    def get(self, key):
+        value = self._redis.get(self._key(key))
+        if value is None:
+            return None
+        return json.loads(value.decode('utf-8'))
+
+    def set(self, key, value, ttl):
+        self._redis.set(self._key(key), json.dumps(value), px=self._ms(ttl))
+
+    def add(self, key, value, ttl):
+        return bool(self._redis.set(self._key(key), json.dumps(value), px=self._ms(ttl), nx=True))
+
+    def delete(self, key):
+        self._redis.delete(self._key(key))
+
+    def incr(self, key, amount, ttl):
+        key = self._key(key)
+        value, pttl = self._redis.pipeline().incrby(key, amount).pttl(key).execute()
+        if pttl < 0:
+            # The key was created by this or by a concurrent call
+            self._redis.pexpire(key, self._ms(ttl))
+        return value
+
+    def cas(self, key, expected, value, ttl):
+        key = self._key(key)
+        with self._redis.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                current = pipe.get(key)
+                if (json.loads(current.decode('utf-8')) if current is not None else None) != expected:
+                    return False
+                pipe.multi()
+                pipe.set(key, json.dumps(value), px=self._ms(ttl))
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+
+def init_store(app):
+    backend = app.config['CACHE_BACKEND']
+    if backend == 'memory':
+        app.store = MemoryStore(max_size=app.config['CACHE_MAX_SIZE'])
+    elif backend == 'file':
+        app.store = SqliteStore(app.config['CACHE_PATH'], max_size=app.config['CACHE_MAX_SIZE'])
+    elif backend == 'redis':
+        if redis is None:
+            raise RuntimeError('CACHE_BACKEND redis requires the redis package')
+        client = redis.StrictRedis(host=app.config['REDIS_HOST'], port=app.config['REDIS_PORT'],
+                                   db=app.config['REDIS_DB'], password=app.config['REDIS_PASSWORD'],
+                                   socket_timeout=app.config['REDIS_SOCKET_TIMEOUT'],
+                                   socket_connect_timeout=app.config['REDIS_SOCKET_TIMEOUT'])
+        app.store = RedisStore(client, prefix=app.config['CACHE_KEY_PREFIX'])
+    else:
+        raise ValueError('Unknown CACHE_BACKEND: {}'.format(backend))
+    app.logger.info('%s store initialized', backend)
+    return app
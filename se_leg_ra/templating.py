@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+from threading import Lock
+from jinja2 import nodes, FileSystemBytecodeCache
+from jinja2.ext import Extension
+
+__author__ = 'lundberg'
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Caches the rendered output of a template block for the lifetime of the process.
+
+        {% cache key %}...{% endcache %}
+
+    Nothing is cached if key is None. The block must not depend on anything that is specific to the request.
+    """
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=dict(), fragment_cache_lock=Lock(), fragment_cache_prefix=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [nodes.Const(parser.name), parser.parse_expression()]
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache_support', args), [], [], body).set_lineno(lineno)
+
+    def _cache_support(self, template_name, key, caller):
+        prefix = self.environment.fragment_cache_prefix
+        if key is None or prefix is None:
+            return caller()
+        cache_key = (prefix, template_name, key)
+        rv = self.environment.fragment_cache.get(cache_key)
+        if rv is None:
+            rv = caller()
+            with self.environment.fragment_cache_lock:
+                self.environment.fragment_cache[cache_key] = rv
+        return rv
+
+
+def templates_digest(app):
+    """
+    :param app: Flask app
+    :type app: flask.Flask
+
+    :return: Digest of all template sources and the app configuration
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    for name in sorted(app.jinja_env.list_templates()):
+        source, _, _ = app.jinja_env.loader.get_source(app.jinja_env, name)
+        digest.update(name.encode('utf-8'))
+        digest.update(source.encode('utf-8'))
+    digest.update(json.dumps(app.config, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def init_template_cache(app):
+    bytecode_cache_dir = app.config['TEMPLATE_BYTECODE_CACHE_DIR']
+    if bytecode_cache_dir:
+        # Compiled templates are shared by all workers, a changed template gets a new checksum and is recompiled
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    auto_reload = app.config.get('TEMPLATES_AUTO_RELOAD') or app.debug
+    if app.config['TEMPLATE_FRAGMENT_CACHE'] and not auto_reload:
+        # Templates and configuration can only change with a restart unless templates are auto reloaded
+        app.jinja_env.fragment_cache_prefix = templates_digest(app)
+    return app
@@ -1,2 +1,10 @@
 # -*- coding: utf-8 -*-
 __author__ = 'lundberg'
+
+import os
+
+# Run the test suite with cooperative I/O, as under the gevent worker class, with SE_LEG_RA_TEST_GEVENT=1.
+# Patching has to be done before anything else is imported.
+if os.environ.get('SE_LEG_RA_TEST_GEVENT'):
+    from gevent import monkey
+    monkey.patch_all()
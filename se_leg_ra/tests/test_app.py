@@ -2,11 +2,28 @@
 
 from __future__ import absolute_import
 
-from unittest import TestCase
+import json
+import logging
+import os
+import gzip
+import time
+import tempfile
+import requests
+from unittest import TestCase, skipUnless
+from threading import Thread
 from mock import patch
-from datetime import datetime
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import ReadPreference
+from pymongo.errors import WriteError
 from eduid_userdb.testing import MongoTemporaryInstance
 from se_leg_ra.app import init_se_leg_ra_app
+from se_leg_ra.db import ProofingLog, proofing_element_from_document
+from se_leg_ra.outbox import deliver_pending, run_outbox_worker, OutboxWorker
+from se_leg_ra.export import export_to_file
+from se_leg_ra.utils import load_whitelist
+from se_leg_ra.health import HealthProber
+from se_leg_ra.log import JsonFormatter, REQUEST_ID_ENVIRON_KEY
 from se_leg_ra.forms import input_validator, qr_validator, nin_validator, eight_digits_validator, nine_digits_validator
 
 __author__ = 'lundberg'
@@ -15,6 +32,7 @@ __author__ = 'lundberg'
 class MockResponse:
     def __init__(self, status_code):
         self.status_code = status_code
+        self.content = b''
 
 
 class SeLegRATests(TestCase):
@@ -26,11 +44,15 @@ class SeLegRATests(TestCase):
         cls.mongo_instance = MongoTemporaryInstance()
 
     def setUp(self):
-        config = {
+        self.config = {
             'SERVER_NAME': 'localhost',
             'SECRET_KEY': 'testing',
             'TESTING': True,
             'DB_URI': self.mongo_instance.uri,
+            'DB_INDEX_SETUP': 'startup',
+            'HEALTH_CHECK_INTERVAL': 0,
+            'QR_NONCE_CACHE_ENABLED': False,
+            'RATE_LIMIT_ENABLED': False,
             'RA_APP_ID': 'test_ra_app',
             'VETTING_ENDPOINT': 'http://op/vetting-result',
             'WTF_CSRF_ENABLED': False,
@@ -47,7 +69,7 @@ class SeLegRATests(TestCase):
         self.test_nin = '190102031234'  # Needs to pass the Luhn validation
         self.test_qr_code = '1{"token": "a_token", "nonce": "a_nonce"}'
 
-        self.app = init_se_leg_ra_app('testing', config)
+        self.app = init_se_leg_ra_app('testing', self.config)
 
         # Add test user to whitelist
         with self.app.app_context():
@@ -66,6 +88,7 @@ class SeLegRATests(TestCase):
         with self.app.app_context():
             self.app.user_db._drop_whole_collection()
             self.app.proofing_log._drop_whole_collection()
+            self.app.proofing_stats._drop_whole_collection()
 
     @classmethod
     def tearDownClass(cls):
@@ -141,7 +164,167 @@ class SeLegRATests(TestCase):
         rv = self.client.get('/', environ_base=auth_env)
         self.assertEqual(rv.status_code, 403)
 
-    @patch('requests.post')
+    def test_whitelist_cache(self):
+        auth_env = dict(self.auth_env, HTTP_EPPN='new-user@localhost')
+        rv = self.client.get('/', environ_base=auth_env)
+        self.assertEqual(rv.status_code, 403)
+
+        # Negative answer is cached until the whitelist is invalidated
+        with self.app.app_context():
+            self.app.user_db._coll.insert_one({'eppn': 'new-user@localhost'})
+        rv = self.client.get('/', environ_base=auth_env)
+        self.assertEqual(rv.status_code, 403)
+
+        self.app.user_db.invalidate_whitelist()
+        rv = self.client.get('/', environ_base=auth_env)
+        self.assertEqual(rv.status_code, 200)
+        stats = self.app.user_db.whitelist_cache.stats
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+
+    def test_health_check(self):
+        rv = self.client.get('/status/healthy')
+        res = json.loads(rv.data.decode('utf-8'))
+        self.assertEqual(res['status'], 'STATUS_OK')
+        self.assertTrue(res['checks']['mongodb']['ok'])
+
+        rv = self.client.get('/status/alive')
+        self.assertEqual(json.loads(rv.data.decode('utf-8'))['status'], 'STATUS_OK')
+
+    def test_health_prober(self):
+        config = dict(self.config, HEALTH_CHECK_PROOFING_LOG_WRITE=True)
+        app = init_se_leg_ra_app('testing', config)
+        prober = HealthProber(app, interval=10, max_age=10)
+        self.assertEqual(prober.status['reason'], 'health check pending')
+        prober.probe()
+        status = prober.status
+        self.assertEqual(status['status'], 'STATUS_OK')
+        self.assertTrue(status['checks']['proofing_log_write']['ok'])
+        self.assertIn('checked_ts', status)
+        # Only proofings are written to the proofing log
+        self.assertEqual(app.proofing_log.db_count(), 0)
+
+    def test_logging(self):
+        records = []
+
+        class ListHandler(logging.Handler):
+            def emit(self, record):
+                records.append(json.loads(self.format(record)))
+
+        handler = ListHandler()
+        handler.setFormatter(JsonFormatter())
+        self.app.log_listener.handlers = (handler,)
+
+        rv = self.client.get('/status/alive', headers={'X-Request-Id': 'a_request_id'})
+        self.assertEqual(rv.headers['X-Request-Id'], 'a_request_id')
+        with self.app.test_request_context(environ_base={REQUEST_ID_ENVIRON_KEY: 'a_request_id'}):
+            form_data = {'nin': self.test_nin}
+            self.app.logger.info('Form data: %s', form_data)
+            # Logged with the value it had when it was logged
+            form_data['nin'] = None
+            try:
+                raise ValueError('bad value')
+            except ValueError:
+                self.app.logger.exception('Failed')
+        self.app.log_listener.queue.join()
+        self.assertEqual(records[-2]['request_id'], 'a_request_id')
+        self.assertEqual(records[-2]['level'], 'INFO')
+        # National identity numbers are masked
+        self.assertEqual(records[-2]['message'], "Form data: {'nin': '19010203****'}")
+        self.assertIn('ValueError: bad value', records[-1]['exception'])
+
+    def test_template_fragment_cache(self):
+        rv = self.client.get('/passport', environ_base=self.auth_env)
+        self.assertEqual(rv.status_code, 200)
+        cached_rv = self.client.get('/passport', environ_base=self.auth_env)
+        self.assertEqual(rv.data, cached_rv.data)
+        self.assertEqual(len(self.app.jinja_env.fragment_cache), 1)
+
+        # Submitted forms are not cached
+        rv = self.client.post('/passport', environ_base=self.auth_env, data={'csrf_token': 'bogus token'})
+        self.assertIn(str.encode(input_validator.message), rv.data)
+        self.assertEqual(len(self.app.jinja_env.fragment_cache), 1)
+
+    def test_static_manifest(self):
+        with self.app.test_request_context():
+            static_url_for = self.app.jinja_env.globals['static_url_for']
+            self.assertEqual(static_url_for('js/jquery.min.js'), '/static/js/jquery.min.js')
+            self.app.static_manifest = {'js/jquery.min.js': 'js/jquery.min.0123456789ab.js'}
+            self.assertEqual(static_url_for('js/jquery.min.js'), '/static/js/jquery.min.0123456789ab.js')
+
+    def test_ensure_indexes(self):
+        with self.app.app_context():
+            self.app.user_db._drop_whole_collection()
+            self.assertTrue(self.app.user_db.ensure_indexes())
+            self.assertIn('index-eppn', self.app.user_db._coll.index_information())
+            # Already at the current index version
+            self.assertFalse(self.app.user_db.ensure_indexes())
+            self.assertTrue(self.app.user_db.ensure_indexes(force=True))
+
+            # Changing the proofing log format sets up the indexes again
+            self.assertFalse(self.app.proofing_log.ensure_indexes())
+            compact_log = ProofingLog(self.mongo_instance.uri, compact=True)
+            self.assertTrue(compact_log.ensure_indexes())
+            self.assertIn('index-nin-compact', self.app.proofing_log._coll.index_information())
+            self.assertNotIn('index-nin', self.app.proofing_log._coll.index_information())
+            self.assertFalse(compact_log.ensure_indexes())
+            self.assertTrue(self.app.proofing_log.ensure_indexes())
+
+    def test_sync_whitelist(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'whitelist.csv')
+            with open(path, 'w') as f:
+                f.write('name,eppn\nTest,{}\nNew,new-user@localhost\n'.format(self.test_user_eppn))
+            eppns = load_whitelist(path)
+        self.assertEqual(eppns, {self.test_user_eppn, 'new-user@localhost'})
+
+        # Rows with an empty first column are kept, rows without an eppn column are skipped
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'whitelist.csv')
+            with open(path, 'w') as f:
+                f.write('name,eppn\n,{}\nShort\nNew,\n'.format(self.test_user_eppn))
+            self.assertEqual(load_whitelist(path), {self.test_user_eppn})
+
+        with self.app.app_context():
+            self.app.user_db._coll.insert_one({'eppn': 'old-user@localhost'})
+            result = self.app.user_db.sync_whitelist(eppns, dry_run=True)
+            self.assertEqual(result, {'added': ['new-user@localhost'], 'removed': ['old-user@localhost'],
+                                      'unchanged': 1})
+            self.assertTrue(self.app.user_db.is_whitelisted('old-user@localhost'))
+
+            self.assertEqual(self.app.user_db.sync_whitelist(eppns, batch_size=1), result)
+            self.assertTrue(self.app.user_db.is_whitelisted('new-user@localhost'))
+            self.assertFalse(self.app.user_db.is_whitelisted('old-user@localhost'))
+
+            # Nothing to change
+            with patch.object(self.app.user_db._coll, 'bulk_write') as mock_bulk_write:
+                result = self.app.user_db.sync_whitelist(eppns)
+            self.assertFalse(mock_bulk_write.called)
+            self.assertEqual(result, {'added': [], 'removed': [], 'unchanged': 2})
+
+    def test_user_attributes_update(self):
+        auth_env = dict(self.auth_env, HTTP_GIVENNAME='Test', HTTP_SN='Testsson')
+        rv = self.client.get('/', environ_base=auth_env)
+        self.assertEqual(rv.status_code, 200)
+        with self.app.app_context():
+            doc = self.app.user_db._coll.find_one({'eppn': self.test_user_eppn})
+        self.assertEqual(doc['given_name'], 'Test')
+        self.assertEqual(doc['surname'], 'Testsson')
+
+        # Unchanged attributes should not result in a write
+        with patch.object(self.app.user_db._coll, 'update_one') as mock_update_one:
+            rv = self.client.get('/', environ_base=auth_env)
+            self.assertEqual(rv.status_code, 200)
+            self.assertFalse(mock_update_one.called)
+
+        auth_env['HTTP_GIVENNAME'] = 'Other'
+        rv = self.client.get('/', environ_base=auth_env)
+        self.assertEqual(rv.status_code, 200)
+        with self.app.app_context():
+            doc = self.app.user_db._coll.find_one({'eppn': self.test_user_eppn})
+        self.assertEqual(doc['given_name'], 'Other')
+
+    @patch('requests.Session.post')
     def test_id_card(self, mock_requests_post):
         mock_requests_post.return_value = MockResponse(200)
 
@@ -173,7 +356,7 @@ class SeLegRATests(TestCase):
         self.assertIn(str.encode('Verifiering mottagen'), rv.data)
         self.assertEqual(self.app.proofing_log.db_count(), 1)
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_drivers_license(self, mock_requests_post):
         mock_requests_post.return_value = MockResponse(200)
 
@@ -206,7 +389,7 @@ class SeLegRATests(TestCase):
         self.assertIn(str.encode('Verifiering mottagen'), rv.data)
         self.assertEqual(self.app.proofing_log.db_count(), 1)
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_passport(self, mock_requests_post):
         mock_requests_post.return_value = MockResponse(200)
         end_point = '/passport'
@@ -238,8 +421,10 @@ class SeLegRATests(TestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertIn(str.encode('Verifiering mottagen'), rv.data)
         self.assertEqual(self.app.proofing_log.db_count(), 1)
+        # The vetting endpoint should always be called with a timeout
+        self.assertEqual(mock_requests_post.call_args[1]['timeout'], (3.05, 10))
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_national_id_card(self, mock_requests_post):
         mock_requests_post.return_value = MockResponse(200)
 
@@ -273,3 +458,527 @@ class SeLegRATests(TestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertIn(str.encode('Verifiering mottagen'), rv.data)
         self.assertEqual(self.app.proofing_log.db_count(), 1)
+
+    @patch('requests.Session.post')
+    def test_metrics(self, mock_requests_post):
+        mock_requests_post.return_value = MockResponse(200)
+        self.client.post('/passport', environ_base=self.auth_env, data={'qr_code': self.test_qr_code,
+                                                                        'nin': self.test_nin,
+                                                                        'expiry_date': str(self.todays_date),
+                                                                        'passport_number': '12345678',
+                                                                        'ocular_validation': True,
+                                                                        'csrf_token': 'bogus token'})
+        rv = self.client.get('/status/metrics')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(b'se_leg_ra_proofings_total{method="passport",outcome="success"}', rv.data)
+        self.assertIn(b'se_leg_ra_vetting_request_seconds_count', rv.data)
+        self.assertIn(b'se_leg_ra_template_render_seconds_count{template="passport.jinja2"}', rv.data)
+        self.assertIn(b'se_leg_ra_mongo_pool_checkout_seconds_count', rv.data)
+        self.assertIn(b'se_leg_ra_mongo_pool_connections_in_use', rv.data)
+
+    def test_read_routing(self):
+        self.assertEqual(self.app.user_db._whitelist_coll.read_preference, ReadPreference.PRIMARY)
+        config = dict(self.config, USER_DB_MONGO_OPTIONS={'maxPoolSize': 7},
+                      WHITELIST_READ_PREFERENCE='secondaryPreferred')
+        app = init_se_leg_ra_app('testing', config)
+        self.assertEqual(app.user_db._whitelist_coll.read_preference, ReadPreference.SECONDARY_PREFERRED)
+        self.assertEqual(app.user_db._coll.read_preference, ReadPreference.PRIMARY)
+        self.assertEqual(app.proofing_log._coll.read_preference, ReadPreference.PRIMARY)
+        self.assertEqual(app.user_db._coll.database.client.max_pool_size, 7)
+        self.assertTrue(app.user_db.is_whitelisted(self.test_user_eppn))
+
+    @patch('requests.Session.post')
+    def test_outbox_delivery(self, mock_requests_post):
+        mock_requests_post.return_value = MockResponse(200)
+        config = dict(self.config, VETTING_OUTBOX_ENABLED=True, VETTING_OUTBOX_WORKER_THREAD=False)
+        app = init_se_leg_ra_app('testing', config)
+        client = app.test_client()
+
+        rv = client.post('/passport', environ_base=self.auth_env, data={'qr_code': self.test_qr_code,
+                                                                        'nin': self.test_nin,
+                                                                        'expiry_date': str(self.todays_date),
+                                                                        'passport_number': '12345678',
+                                                                        'ocular_validation': True,
+                                                                        'csrf_token': 'bogus token'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(str.encode('Verifiering sparad'), rv.data)
+        self.assertFalse(mock_requests_post.called)
+
+        with app.app_context():
+            doc = app.proofing_log._coll.find_one()
+        status_url = '/delivery-status/{}'.format(doc['_id'])
+        rv = client.get(status_url, environ_base=self.auth_env)
+        self.assertEqual(json.loads(rv.data.decode('utf-8'))['status'], 'pending')
+
+        with app.app_context():
+            self.assertTrue(deliver_pending(app))
+            self.assertFalse(deliver_pending(app))
+        self.assertEqual(mock_requests_post.call_args[1]['json']['identity'], self.test_nin)
+        rv = client.get(status_url, environ_base=self.auth_env)
+        self.assertEqual(json.loads(rv.data.decode('utf-8'))['status'], 'sent')
+        self.assertEqual(json.loads(rv.data.decode('utf-8'))['attempts'], 1)
+
+    @patch('requests.Session.post')
+    def test_outbox_retry(self, mock_requests_post):
+        mock_requests_post.return_value = MockResponse(503)
+        config = dict(self.config, VETTING_OUTBOX_ENABLED=True, VETTING_OUTBOX_WORKER_THREAD=False,
+                      VETTING_OUTBOX_MAX_ATTEMPTS=2, VETTING_OUTBOX_BACKOFF=0)
+        app = init_se_leg_ra_app('testing', config)
+        client = app.test_client()
+
+        client.post('/passport', environ_base=self.auth_env, data={'qr_code': self.test_qr_code,
+                                                                   'nin': self.test_nin,
+                                                                   'expiry_date': str(self.todays_date),
+                                                                   'passport_number': '12345678',
+                                                                   'ocular_validation': True,
+                                                                   'csrf_token': 'bogus token'})
+        with app.app_context():
+            self.assertTrue(deliver_pending(app))
+            doc = app.proofing_log._coll.find_one()
+            self.assertEqual(doc['delivery']['status'], 'pending')
+            self.assertTrue(deliver_pending(app))
+            doc = app.proofing_log._coll.find_one()
+            self.assertEqual(doc['delivery']['status'], 'failed')
+            self.assertEqual(doc['delivery']['attempts'], 2)
+
+    def test_outbox_worker_command(self):
+        app = init_se_leg_ra_app('testing', dict(self.config, VETTING_OUTBOX_ENABLED=True))
+        self.assertTrue(app.outbox_worker.is_alive())
+        # The command uses the worker thread started by the app
+        with patch.object(OutboxWorker, 'start') as mock_start, \
+                patch('se_leg_ra.outbox.time.sleep', side_effect=KeyboardInterrupt()):
+            run_outbox_worker(app)
+        mock_start.assert_not_called()
+        self.assertFalse(app.outbox_worker.is_alive())
+
+    def test_proofing_log_group_commit(self):
+        proofing_log = ProofingLog(self.mongo_instance.uri, group_commit=True, group_commit_window=1,
+                                   group_commit_max_docs=5)
+        proofing_log._insert({'_id': 'duplicate'})
+        errors = []
+
+        def insert(doc_id):
+            try:
+                proofing_log._insert({'_id': doc_id})
+            except WriteError:
+                errors.append(doc_id)
+
+        threads = [Thread(target=insert, args=(doc_id,)) for doc_id in ['duplicate', 'a', 'b', 'c', 'd']]
+        with patch.object(proofing_log._coll, 'insert_many', wraps=proofing_log._coll.insert_many) as mock_insert_many:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # All five documents are written in one batch and only the duplicate fails
+        self.assertEqual(mock_insert_many.call_count, 1)
+        self.assertEqual(errors, ['duplicate'])
+        self.assertEqual(proofing_log.db_count(), 5)
+
+    @patch('requests.Session.post')
+    def test_proofing_log_compact(self, mock_requests_post):
+        mock_requests_post.return_value = MockResponse(200)
+        data = {'qr_code': self.test_qr_code, 'nin': self.test_nin, 'expiry_date': str(self.todays_date),
+                'passport_number': '12345678', 'ocular_validation': True, 'csrf_token': 'bogus token'}
+        rv = self.app.test_client().post('/passport', environ_base=self.auth_env, data=data)
+        self.assertEqual(rv.status_code, 200)
+
+        app = init_se_leg_ra_app('testing', dict(self.config, PROOFING_LOG_COMPACT=True))
+        rv = app.test_client().post('/passport', environ_base=self.auth_env, data=data)
+        self.assertEqual(rv.status_code, 200)
+
+        with app.app_context():
+            original, compact = list(app.proofing_log._coll.find().sort('_id', 1))
+            self.assertEqual(compact['v'], 2)
+            self.assertEqual(compact['di'], '12345678')
+            self.assertNotIn('opaque', compact)
+            # Both formats are read as the same element
+            original_element = proofing_element_from_document(original)
+            compact_element = proofing_element_from_document(compact)
+            self.assertEqual(compact_element.opaque, original_element.opaque)
+            self.assertEqual(compact_element.expiry_date, original_element.expiry_date)
+            self.assertEqual(compact_element.document_identifier, '12345678')
+
+            # Documents in the original format are found before they are compacted
+            docs, _ = app.proofing_log.find_proofings(proofing_method='passport', nin=self.test_nin,
+                                                      created_after=datetime.utcnow() - timedelta(hours=1))
+            self.assertEqual(len(docs), 2)
+            self.assertNotIn('opaque', docs[0])
+
+            report = app.proofing_log.size_report()
+            self.assertEqual(report['sampled'], 2)
+            self.assertEqual(report['sampled_compact'], 1)
+            self.assertLess(report['sampled_compact_size'], report['sampled_original_size'])
+
+            self.assertEqual(app.proofing_log.compact_documents(), 1)
+            self.assertEqual(app.proofing_log.compact_documents(), 0)
+            self.assertEqual(len(list(app.proofing_log._coll.find({'v': 2}))), 2)
+            self.assertEqual(app.proofing_log.INDEXES['index-nin-compact']['key'], [('n', 1), ('_id', 1)])
+            self.assertEqual(app.proofing_log.INDEXES['index-nin']['key'], [('nin', 1), ('_id', 1)])
+            docs, _ = app.proofing_log.find_proofings(proofing_method='passport', verified_by=self.test_user_eppn)
+            self.assertEqual(len(docs), 2)
+
+        # Without legacy documents only the compact format is indexed and queried
+        app = init_se_leg_ra_app('testing', dict(self.config, PROOFING_LOG_COMPACT=True,
+                                                 PROOFING_LOG_LEGACY_DOCUMENTS=False))
+        self.assertNotIn('index-nin', app.proofing_log._coll.index_information())
+        docs, _ = app.proofing_log.find_proofings(proofing_method='passport', verified_by=self.test_user_eppn)
+        self.assertEqual(len(docs), 2)
+
+    @patch('requests.Session.post')
+    def test_audit_proofings(self, mock_requests_post):
+        mock_requests_post.return_value = MockResponse(200)
+        app = init_se_leg_ra_app('testing', dict(self.config, AUDIT_EPPNS=[self.test_user_eppn]))
+        client = app.test_client()
+        for n in range(3):
+            client.post('/passport', environ_base=self.auth_env, data={'qr_code': self.test_qr_code,
+                                                                       'nin': self.test_nin,
+                                                                       'expiry_date': str(self.todays_date),
+                                                                       'passport_number': '1234567{}'.format(n),
+                                                                       'ocular_validation': n != 1,
+                                                                       'csrf_token': 'bogus token'})
+
+        rv = client.get('/audit/proofings?ocular_validation=false', environ_base=self.auth_env)
+        proofings = json.loads(rv.data.decode('utf-8'))['proofings']
+        self.assertEqual([proofing['passport_number'] for proofing in proofings], ['12345671'])
+        self.assertNotIn('opaque', proofings[0])
+
+        # Newest first, two per page
+        rv = client.get('/audit/proofings?nin={}&limit=2'.format(self.test_nin), environ_base=self.auth_env)
+        page = json.loads(rv.data.decode('utf-8'))
+        self.assertEqual([proofing['passport_number'] for proofing in page['proofings']], ['12345672', '12345671'])
+        rv = client.get('/audit/proofings?nin={}&limit=2&cursor={}'.format(self.test_nin, page['next_cursor']),
+                        environ_base=self.auth_env)
+        page = json.loads(rv.data.decode('utf-8'))
+        self.assertEqual([proofing['passport_number'] for proofing in page['proofings']], ['12345670'])
+        self.assertIsNone(page['next_cursor'])
+
+        rv = client.get('/audit/proofings?created_after={}'.format(self.todays_date), environ_base=self.auth_env)
+        self.assertEqual(len(json.loads(rv.data.decode('utf-8'))['proofings']), 3)
+        rv = client.get('/audit/proofings?created_before={}'.format(self.todays_date), environ_base=self.auth_env)
+        self.assertEqual(len(json.loads(rv.data.decode('utf-8'))['proofings']), 0)
+        rv = client.get('/audit/proofings?created_after=yesterday', environ_base=self.auth_env)
+        self.assertEqual(rv.status_code, 400)
+
+        # Not an auditor
+        rv = self.client.get('/audit/proofings', environ_base=self.auth_env)
+        self.assertEqual(rv.status_code, 403)
+
+    @patch('requests.Session.post')
+    def test_export(self, mock_requests_post):
+        mock_requests_post.return_value = MockResponse(200)
+        app = init_se_leg_ra_app('testing', dict(self.config, AUDIT_EPPNS=[self.test_user_eppn]))
+        client = app.test_client()
+        for n in range(3):
+            client.post('/passport', environ_base=self.auth_env, data={'qr_code': self.test_qr_code,
+                                                                       'nin': self.test_nin,
+                                                                       'expiry_date': str(self.todays_date),
+                                                                       'passport_number': '1234567{}'.format(n),
+                                                                       'ocular_validation': True,
+                                                                       'csrf_token': 'bogus token'})
+
+        rv = client.get('/audit/export?format=csv&mask=nin', environ_base=self.auth_env)
+        self.assertEqual(rv.status_code, 200)
+        lines = rv.data.decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith('id,created_ts'))
+        self.assertIn('19010203****', lines[1])
+        self.assertNotIn(self.test_nin, rv.data.decode('utf-8'))
+
+        with tempfile.TemporaryDirectory() as tmp_dir, app.app_context():
+            path = os.path.join(tmp_dir, 'export.ndjson.gz')
+            # Interrupt the export after the second batch
+            with patch('se_leg_ra.export.os.fsync', side_effect=[None, None, RuntimeError()]):
+                with self.assertRaises(RuntimeError):
+                    export_to_file(app.proofing_log, path, compress=True, mask=['opaque'], batch_size=1)
+            self.assertEqual(export_to_file(app.proofing_log, path, resume=True, batch_size=1), 1)
+            self.assertFalse(os.path.exists('{}.progress'.format(path)))
+            with gzip.open(path, 'rt') as f:
+                rows = [json.loads(line) for line in f]
+
+            # The progress file is left but the export file is gone
+            other_path = os.path.join(tmp_dir, 'other.ndjson')
+            with patch('se_leg_ra.export.os.fsync', side_effect=RuntimeError()):
+                with self.assertRaises(RuntimeError):
+                    export_to_file(app.proofing_log, other_path, batch_size=1)
+            os.remove(other_path)
+            with self.assertRaises(ValueError):
+                export_to_file(app.proofing_log, other_path, resume=True)
+        self.assertEqual([row['document_identifier'] for row in rows], ['12345670', '12345671', '12345672'])
+        self.assertEqual(rows[0]['opaque'], '****')
+
+    @patch('requests.Session.post')
+    def test_qr_nonce_replay(self, mock_requests_post):
+        mock_requests_post.return_value = MockResponse(200)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'nonces.sqlite')
+            config = dict(self.config, QR_NONCE_CACHE_ENABLED=True, CACHE_BACKEND='file', CACHE_PATH=path)
+            app = init_se_leg_ra_app('testing', config)
+            client = app.test_client()
+            data = {'qr_code': self.test_qr_code, 'nin': self.test_nin, 'expiry_date': str(self.todays_date),
+                    'passport_number': '12345678', 'ocular_validation': True, 'csrf_token': 'bogus token'}
+
+            rv = client.post('/passport', environ_base=self.auth_env, data=data)
+            self.assertIn(str.encode('Verifiering mottagen'), rv.data)
+            # A rescanned QR code is rejected by the form validation
+            rv = client.post('/passport', environ_base=self.auth_env, data=data)
+            self.assertIn(str.encode('Ogiltig QR-kod'), rv.data)
+            self.assertEqual(mock_requests_post.call_count, 1)
+            self.assertEqual(app.proofing_log.db_count(), 1)
+            self.assertEqual(app.nonce_cache.stats['hits'], 1)
+
+            # Other workers share the nonces
+            other_app = init_se_leg_ra_app('testing', config)
+            with patch.object(other_app.nonce_cache, 'seen', return_value=False):
+                rv = other_app.test_client().post('/passport', environ_base=self.auth_env, data=data)
+            self.assertIn(str.encode('Ogiltig QR-kod'), rv.data)
+            self.assertEqual(mock_requests_post.call_count, 1)
+            self.assertEqual(app.proofing_log.db_count(), 1)
+
+            # A QR code can be used again if the vetting endpoint could not be reached
+            data['qr_code'] = '1{"token": "a_token", "nonce": "another_nonce"}'
+            mock_requests_post.side_effect = requests.ConnectionError()
+            rv = client.post('/passport', environ_base=self.auth_env, data=data)
+            self.assertIn(str.encode('Ingen kontakt'), rv.data)
+            mock_requests_post.side_effect = None
+            rv = client.post('/passport', environ_base=self.auth_env, data=data)
+            self.assertIn(str.encode('Verifiering mottagen'), rv.data)
+
+    @patch('requests.Session.post')
+    def test_idempotent_submission(self, mock_requests_post):
+        mock_requests_post.return_value = MockResponse(200)
+        data = {'qr_code': self.test_qr_code, 'nin': self.test_nin, 'expiry_date': str(self.todays_date),
+                'passport_number': '12345678', 'ocular_validation': True, 'csrf_token': 'bogus token',
+                'idempotency_key': 'a_key'}
+        for _ in range(2):
+            rv = self.client.post('/passport', environ_base=self.auth_env, data=data)
+            self.assertIn(str.encode('Verifiering mottagen'), rv.data)
+        self.assertEqual(mock_requests_post.call_count, 1)
+        self.assertEqual(self.app.proofing_log.db_count(), 1)
+
+        # Submissions that failed for a transient reason are processed again
+        data['idempotency_key'] = 'another_key'
+        mock_requests_post.side_effect = requests.ConnectionError()
+        rv = self.client.post('/passport', environ_base=self.auth_env, data=data)
+        self.assertIn(str.encode('Ingen kontakt'), rv.data)
+        mock_requests_post.side_effect = None
+        rv = self.client.post('/passport', environ_base=self.auth_env, data=data)
+        self.assertIn(str.encode('Verifiering mottagen'), rv.data)
+        self.assertEqual(mock_requests_post.call_count, 3)
+
+        # Every rendered form gets a new key
+        rv = self.client.get('/passport', environ_base=self.auth_env)
+        self.assertIn(str.encode('name="idempotency_key"'), rv.data)
+
+    @patch('requests.Session.post')
+    def test_rate_limit(self, mock_requests_post):
+        mock_requests_post.return_value = MockResponse(200)
+        config = dict(self.config, RATE_LIMIT_ENABLED=True, RATE_LIMITS={'nin': (2, 300), 'eppn': (100, 60)})
+        app = init_se_leg_ra_app('testing', config)
+        client = app.test_client()
+        data = {'qr_code': self.test_qr_code, 'nin': self.test_nin, 'expiry_date': str(self.todays_date),
+                'passport_number': '12345678', 'ocular_validation': True, 'csrf_token': 'bogus token'}
+        for _ in range(2):
+            rv = client.post('/passport', environ_base=self.auth_env, data=data)
+            self.assertEqual(rv.status_code, 200)
+        rv = client.post('/passport', environ_base=self.auth_env, data=data)
+        self.assertEqual(rv.status_code, 429)
+        self.assertIn('För många verifieringar', rv.data.decode('utf-8'))
+        self.assertGreater(int(rv.headers['Retry-After']), 0)
+        self.assertEqual(mock_requests_post.call_count, 2)
+
+        # Other identity numbers and GET requests are not limited by the nin limit
+        data['nin'] = '200001019876'
+        rv = client.post('/passport', environ_base=self.auth_env, data=data)
+        self.assertEqual(rv.status_code, 200)
+        rv = client.get('/passport', environ_base=self.auth_env)
+        self.assertEqual(rv.status_code, 200)
+
+    @patch('requests.Session.post')
+    def test_vetting_circuit_breaker(self, mock_requests_post):
+        mock_requests_post.side_effect = requests.ConnectionError()
+        app = init_se_leg_ra_app('testing', dict(self.config, VETTING_CIRCUIT_FAILURE_THRESHOLD=2))
+        client = app.test_client()
+        data = {'qr_code': self.test_qr_code, 'nin': self.test_nin, 'expiry_date': str(self.todays_date),
+                'passport_number': '12345678', 'ocular_validation': True, 'csrf_token': 'bogus token'}
+        for _ in range(3):
+            rv = client.post('/passport', environ_base=self.auth_env, data=data)
+            self.assertIn(str.encode('Ingen kontakt'), rv.data)
+        # The third proofing failed fast without being saved
+        self.assertEqual(mock_requests_post.call_count, 2)
+        self.assertEqual(app.proofing_log.db_count(), 2)
+        rv = client.get('/status/circuit-breaker')
+        self.assertEqual(json.loads(rv.data.decode('utf-8'))['vetting']['state'], 'open')
+
+        # A probe that could not be saved lets the next proofing through as the probe
+        app.store.delete('circuit:vetting:open')
+        with patch.object(app.proofing_log, 'save', return_value=False):
+            rv = client.post('/passport', environ_base=self.auth_env, data=data)
+        self.assertIn(str.encode('Tillfälligt tekniskt fel'), rv.data)
+
+        # A successful probe closes the circuit
+        mock_requests_post.side_effect = None
+        mock_requests_post.return_value = MockResponse(200)
+        rv = client.post('/passport', environ_base=self.auth_env, data=data)
+        self.assertIn(str.encode('Verifiering mottagen'), rv.data)
+        rv = client.get('/status/circuit-breaker')
+        self.assertEqual(json.loads(rv.data.decode('utf-8'))['vetting']['state'], 'closed')
+
+    @patch('requests.Session.post')
+    def test_api_proofings(self, mock_requests_post):
+        def op(*args, **kwargs):
+            # The proofings are sent concurrently, answer by nonce instead of call order
+            return MockResponse(200 if 'nonce_1' in kwargs['json']['qrcode'] else 400)
+        mock_requests_post.side_effect = op
+        proofings = [
+            {'proofing_method': 'passport', 'qr_code': '1{"token": "a_token", "nonce": "nonce_1"}',
+             'nin': self.test_nin, 'expiry_date': str(self.todays_date), 'passport_number': '12345678',
+             'ocular_validation': True},
+            {'proofing_method': 'drivers_license', 'qr_code': '1{"token": "a_token", "nonce": "nonce_2"}',
+             'nin': self.test_nin, 'expiry_date': str(self.todays_date), 'reference_number': '123456789',
+             'ocular_validation': True},
+            {'proofing_method': 'id_card', 'qr_code': self.test_qr_code, 'nin': '190102031235',
+             'expiry_date': str(self.todays_date), 'card_number': 'abc123', 'ocular_validation': True},
+            {'proofing_method': 'unknown'},
+        ]
+        rv = self.client.post('/api/v1/proofings', environ_base=self.auth_env, data=json.dumps(proofings),
+                              content_type='application/json')
+        self.assertEqual(rv.status_code, 200)
+        results = json.loads(rv.data.decode('utf-8'))['results']
+        self.assertEqual([result['status'] for result in results], ['sent', 'rejected', 'invalid', 'invalid'])
+        self.assertIn('nin', results[2]['errors'])
+        self.assertEqual(mock_requests_post.call_count, 2)
+        self.assertEqual(self.app.proofing_log.db_count(), 2)
+        doc = self.app.proofing_log._coll.find_one({'_id': ObjectId(results[0]['id'])})
+        self.assertEqual(doc['proofing_method'], 'passport')
+        self.assertEqual(doc['verified_by'], self.auth_env['HTTP_EPPN'])
+
+        # Only JSON is accepted
+        rv = self.client.post('/api/v1/proofings', environ_base=self.auth_env, data={'proofings': 'x'})
+        self.assertEqual(rv.status_code, 415)
+        rv = self.client.post('/api/v1/proofings', environ_base=self.auth_env, data='[]',
+                              content_type='application/json')
+        self.assertEqual(rv.status_code, 400)
+
+    @patch('requests.Session.post')
+    def test_api_proofings_deadline(self, mock_requests_post):
+        def slow_op(*args, **kwargs):
+            time.sleep(0.5)
+            return MockResponse(200)
+        mock_requests_post.side_effect = slow_op
+        config = dict(self.config, API_DELIVERY_CONCURRENCY=1, API_DELIVERY_DEADLINE=0.1)
+        app = init_se_leg_ra_app('testing', config)
+        qr_code = '1{{"token": "a_token", "nonce": "nonce_{}"}}'
+        proofings = [{'proofing_method': 'passport', 'qr_code': qr_code.format(n), 'nin': self.test_nin,
+                      'expiry_date': str(self.todays_date), 'passport_number': '12345678',
+                      'ocular_validation': True} for n in range(2)]
+        start = time.monotonic()
+        rv = app.test_client().post('/api/v1/proofings', environ_base=self.auth_env, data=json.dumps(proofings),
+                                    content_type='application/json')
+        self.assertLess(time.monotonic() - start, 0.5)
+        results = json.loads(rv.data.decode('utf-8'))['results']
+        # The first proofing was still being sent and the second was never sent
+        self.assertEqual([result['status'] for result in results], ['op_unreachable', 'op_unreachable'])
+        self.assertEqual(mock_requests_post.call_count, 1)
+
+    @patch('requests.Session.post')
+    def test_api_proofings_outbox(self, mock_requests_post):
+        config = dict(self.config, VETTING_OUTBOX_ENABLED=True, VETTING_OUTBOX_WORKER_THREAD=False)
+        app = init_se_leg_ra_app('testing', config)
+        proofings = [{'proofing_method': 'national_id_card', 'qr_code': self.test_qr_code, 'nin': self.test_nin,
+                      'expiry_date': str(self.todays_date), 'card_number': '12345678', 'ocular_validation': True}]
+        rv = app.test_client().post('/api/v1/proofings', environ_base=self.auth_env, data=json.dumps(proofings),
+                                    content_type='application/json')
+        result = json.loads(rv.data.decode('utf-8'))['results'][0]
+        self.assertEqual(result['status'], 'pending')
+        self.assertIn(result['id'], result['delivery_status_url'])
+        self.assertEqual(mock_requests_post.call_count, 0)
+        self.assertEqual(app.proofing_log.db_count(), 1)
+
+    @patch('requests.Session.post')
+    def test_api_proofings_over_capacity(self, mock_requests_post):
+        # The default RATE_LIMITS allow 30 proofings per RA user
+        client = init_se_leg_ra_app('testing', dict(self.config, RATE_LIMIT_ENABLED=True)).test_client()
+        proofings = [{'proofing_method': 'passport', 'nin': '19010203{:04d}'.format(n)} for n in range(31)]
+        rv = client.post('/api/v1/proofings', environ_base=self.auth_env, data=json.dumps(proofings),
+                         content_type='application/json')
+        self.assertEqual(rv.status_code, 413)
+        self.assertNotIn('Retry-After', rv.headers)
+        rv = client.post('/api/v1/proofings', environ_base=self.auth_env, data=json.dumps(proofings[:30]),
+                         content_type='application/json')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(mock_requests_post.call_count, 0)
+
+    @patch('requests.Session.post')
+    def test_api_proofings_rate_limit(self, mock_requests_post):
+        mock_requests_post.return_value = MockResponse(200)
+        config = dict(self.config, RATE_LIMIT_ENABLED=True, RATE_LIMITS={'nin': (2, 300), 'eppn': (100, 60)})
+        client = init_se_leg_ra_app('testing', config).test_client()
+        proofing = {'proofing_method': 'passport', 'qr_code': self.test_qr_code, 'nin': self.test_nin,
+                    'expiry_date': str(self.todays_date), 'passport_number': '12345678', 'ocular_validation': True}
+        # One batch can not get around the per identity number limit
+        rv = client.post('/api/v1/proofings', environ_base=self.auth_env, data=json.dumps([proofing] * 3),
+                         content_type='application/json')
+        self.assertEqual(rv.status_code, 429)
+        self.assertEqual(json.loads(rv.data.decode('utf-8'))['error'], 'rate_limited')
+        self.assertGreater(int(rv.headers['Retry-After']), 0)
+        self.assertEqual(mock_requests_post.call_count, 0)
+
+        # The rejected batch took no tokens
+        rv = client.post('/api/v1/proofings', environ_base=self.auth_env, data=json.dumps([proofing] * 2),
+                         content_type='application/json')
+        self.assertEqual(rv.status_code, 200)
+
+    @patch('requests.Session.post')
+    def test_proofing_stats(self, mock_requests_post):
+        mock_requests_post.side_effect = [MockResponse(200), MockResponse(400)]
+        app = init_se_leg_ra_app('testing', dict(self.config, AUDIT_EPPNS=[self.test_user_eppn]))
+        client = app.test_client()
+        for n in range(2):
+            client.post('/passport', environ_base=self.auth_env, data={'qr_code': self.test_qr_code,
+                                                                       'nin': self.test_nin,
+                                                                       'expiry_date': str(self.todays_date),
+                                                                       'passport_number': '12345678',
+                                                                       'ocular_validation': True,
+                                                                       'csrf_token': 'bogus token'})
+        today = datetime.utcnow().strftime('%Y-%m-%d')
+        rv = client.get('/audit/stats', environ_base=self.auth_env)
+        res = json.loads(rv.data.decode('utf-8'))
+        self.assertEqual(res['last_day'], today)
+        self.assertEqual(res['counts'], [{'day': today, 'verified_by': self.test_user_eppn,
+                                          'proofing_method': 'passport',
+                                          'counts': {'saved': 2, 'success': 1, 'invalid_qr': 1}}])
+        self.assertEqual(res['totals'], {'saved': 2, 'success': 1, 'invalid_qr': 1})
+        rv = client.get('/audit/stats?proofing_method=id_card', environ_base=self.auth_env)
+        self.assertEqual(json.loads(rv.data.decode('utf-8'))['counts'], [])
+        rv = client.get('/audit/stats?first_day=2018-01-01&last_day=2020-01-01', environ_base=self.auth_env)
+        self.assertEqual(rv.status_code, 400)
+
+        # The backfill replaces the saved counts with the counts from the proofing log
+        app.proofing_stats._coll.delete_many({})
+        tomorrow = datetime.utcnow() + timedelta(days=1)
+        app.proofing_stats.set_counts(app.proofing_log.daily_counts(until=tomorrow))
+        self.assertEqual(app.proofing_stats.find_counts(today, today)[0]['counts'], {'saved': 2})
+
+    @skipUnless(os.environ.get('SE_LEG_RA_TEST_GEVENT'), 'requires gevent monkey patching')
+    @patch('requests.Session.post')
+    def test_concurrent_requests_gevent(self, mock_requests_post):
+        import gevent
+
+        def slow_op(*args, **kwargs):
+            time.sleep(0.5)
+            return MockResponse(200)
+        mock_requests_post.side_effect = slow_op
+
+        def proofing(n):
+            data = {'qr_code': self.test_qr_code, 'nin': self.test_nin, 'expiry_date': str(self.todays_date),
+                    'passport_number': '12345678', 'ocular_validation': True, 'csrf_token': 'bogus token'}
+            return self.app.test_client().post('/passport', environ_base=self.auth_env, data=data)
+
+        start = time.monotonic()
+        jobs = [gevent.spawn(proofing, n) for n in range(10)]
+        gevent.joinall(jobs)
+        # Waiting for the OP does not block other requests
+        self.assertLess(time.monotonic() - start, 2.5)
+        for job in jobs:
+            self.assertIn(b'Verifiering mottagen', job.value.data)
+        self.assertEqual(self.app.proofing_log.db_count(), 10)
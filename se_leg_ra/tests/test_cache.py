@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from unittest import TestCase
+from mock import patch
+from se_leg_ra.cache import TTLCache
+
+__author__ = 'lundberg'
+
+
+class TTLCacheTests(TestCase):
+
+    def test_hit_and_miss(self):
+        cache = TTLCache(max_size=10)
+        self.assertEqual(cache.get('key'), (False, None))
+        cache.set('key', False, ttl=10)
+        self.assertEqual(cache.get('key'), (True, False))
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['misses'], 1)
+
+    def test_expiry(self):
+        cache = TTLCache(max_size=10)
+        with patch('se_leg_ra.cache.time.monotonic', return_value=100):
+            cache.set('key', True, ttl=10)
+        with patch('se_leg_ra.cache.time.monotonic', return_value=105):
+            self.assertEqual(cache.get('key'), (True, True))
+        with patch('se_leg_ra.cache.time.monotonic', return_value=111):
+            self.assertEqual(cache.get('key'), (False, None))
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        cache = TTLCache(max_size=2)
+        cache.set('a', 1, ttl=10)
+        cache.set('b', 2, ttl=10)
+        cache.get('a')
+        cache.set('c', 3, ttl=10)
+        self.assertEqual(cache.get('a'), (True, 1))
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('c'), (True, 3))
+
+    def test_disabled(self):
+        cache = TTLCache(max_size=0)
+        cache.set('key', True, ttl=10)
+        self.assertEqual(cache.get('key'), (False, None))
+
+    def test_version_invalidation(self):
+        version = {'current': 1}
+        cache = TTLCache(max_size=10, version_check_interval=0, version_getter=lambda: version['current'])
+        cache.set('key', True, ttl=10)
+        self.assertEqual(cache.get('key'), (True, True))
+        version['current'] = 2
+        self.assertEqual(cache.get('key'), (False, None))
+        self.assertEqual(cache.stats['invalidations'], 1)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from unittest import TestCase
+from mock import patch
+from se_leg_ra.store import MemoryStore
+from se_leg_ra.circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+__author__ = 'lundberg'
+
+
+class CircuitBreakerTests(TestCase):
+
+    def setUp(self):
+        self.store = MemoryStore()
+        self.breaker = CircuitBreaker(self.store, 'test', failure_threshold=3, window=60, slow_call_time=5,
+                                      reset_timeout=30, probe_timeout=15)
+
+    def open_circuit(self):
+        for _ in range(3):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record_failure()
+
+    def test_opens_after_threshold(self):
+        for _ in range(2):
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_slow_calls_are_failures(self):
+        for _ in range(3):
+            self.breaker.record_success(6)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_half_open_probe(self):
+        self.open_circuit()
+        self.store.delete('circuit:test:open')  # The reset timeout has passed
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        # Only one probe at a time
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success(0.1)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.stats['failures'], 0)
+
+    def test_released_probe(self):
+        self.open_circuit()
+        self.store.delete('circuit:test:open')
+        self.assertTrue(self.breaker.allow())
+        self.breaker.release()
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_opens_circuit(self):
+        self.open_circuit()
+        self.store.delete('circuit:test:open')
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_shared_state(self):
+        other = CircuitBreaker(self.store, 'test', failure_threshold=3)
+        self.open_circuit()
+        self.assertFalse(other.allow())
+        # Breakers for other services are not affected
+        self.assertTrue(CircuitBreaker(self.store, 'other').allow())
+
+    @patch('se_leg_ra.store.time.monotonic')
+    def test_reset_timeout(self, mock_monotonic):
+        mock_monotonic.return_value = 1000
+        self.open_circuit()
+        mock_monotonic.return_value = 1031
+        self.assertEqual(self.breaker.state, HALF_OPEN)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from unittest import TestCase
+from datetime import datetime
+from bson import BSON, ObjectId
+from se_leg_ra.compact import compact_document, expand_document, COMPACT_VERSION
+
+__author__ = 'lundberg'
+
+
+class CompactFormatTests(TestCase):
+
+    def setUp(self):
+        self.doc = {
+            '_id': ObjectId(),
+            'created_ts': datetime(2018, 1, 2, 3, 4, 5, 6000),
+            'created_by': 'se-leg-ra',
+            'verified_by': 'test@localhost',
+            'nin': '190102031234',
+            'passport_number': '12345678',
+            'opaque': '1' + '{"nonce": "9a81a8dc-6a4e-4eba-a7f9-34eab3bc5ad1", '
+                            '"token": "64e5cd1e-c4b3-4c2b-9e4a-d6cf1bdaa6d4"}',
+            'ocular_validation': True,
+            'expiry_date': datetime(2028, 12, 31),
+            'proofing_method': 'passport',
+            'proofing_version': '2018v1',
+            'delivery': {'status': 'pending', 'attempts': 0},
+        }
+
+    def test_round_trip(self):
+        compact = compact_document(self.doc)
+        self.assertEqual(compact['v'], COMPACT_VERSION)
+        self.assertEqual(compact['m'], 2)
+        self.assertEqual(compact['pv'], 1)
+        self.assertEqual(compact['ed'], 20281231)
+        self.assertEqual(compact['di'], '12345678')
+        self.assertEqual(compact['delivery'], self.doc['delivery'])
+        self.assertEqual(expand_document(compact), self.doc)
+        self.assertLess(len(BSON.encode(compact)), len(BSON.encode(self.doc)))
+
+    def test_original_format_unchanged(self):
+        self.assertIs(expand_document(self.doc), self.doc)
+        compact = compact_document(self.doc)
+        self.assertIs(compact_document(compact), compact)
+
+    def test_unknown_values(self):
+        self.doc['proofing_version'] = '2030v1'
+        self.doc['opaque'] = 'x'
+        compact = compact_document(self.doc)
+        self.assertEqual(compact['pv'], '2030v1')
+        self.assertEqual(expand_document(compact), self.doc)
+
+    def test_stored_document(self):
+        # Binary data is read back from the database as bytes
+        compact = compact_document(self.doc)
+        stored = BSON.encode(compact).decode()
+        self.assertEqual(expand_document(stored), self.doc)
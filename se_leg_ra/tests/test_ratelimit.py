@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from unittest import TestCase
+from se_leg_ra.store import MemoryStore
+from se_leg_ra.ratelimit import take_token, take_limit_tokens, bucket_key, over_capacity
+
+__author__ = 'lundberg'
+
+
+class RateLimitTests(TestCase):
+
+    def setUp(self):
+        self.store = MemoryStore()
+        self.limits = {'eppn': (10, 60), 'nin': (2, 300)}
+
+    def test_take_token(self):
+        self.assertEqual(take_token(self.store, 'key', 2, 60), (True, 0))
+        self.assertEqual(take_token(self.store, 'key', 2, 60), (True, 0))
+        allowed, retry_after = take_token(self.store, 'key', 2, 60)
+        self.assertFalse(allowed)
+        self.assertGreater(retry_after, 0)
+
+    def test_cost_over_capacity(self):
+        self.assertEqual(take_token(self.store, 'key', 2, 60, cost=3), (False, 60))
+        self.assertIsNone(self.store.get('key'))
+
+    def test_rejected_request_takes_no_tokens(self):
+        costs = {'eppn': {'user@example.com': 1}, 'nin': {'190102031234': 1}}
+        for _ in range(2):
+            self.assertEqual(take_limit_tokens(self.store, self.limits, costs), (None, 0))
+        limit, retry_after = take_limit_tokens(self.store, self.limits, costs)
+        self.assertEqual(limit, 'nin')
+        self.assertGreater(retry_after, 0)
+        # Only the two accepted requests were counted for the user
+        state = self.store.get(bucket_key('eppn', 'user@example.com'))
+        self.assertAlmostEqual(state['tokens'], 8, places=2)
+
+    def test_weighted_costs(self):
+        costs = {'eppn': {'user@example.com': 3}, 'nin': {'190102031234': 1, '200001019876': 2}}
+        self.assertEqual(take_limit_tokens(self.store, self.limits, costs), (None, 0))
+        limit, _ = take_limit_tokens(self.store, self.limits, {'nin': {'200001019876': 1}})
+        self.assertEqual(limit, 'nin')
+        state = self.store.get(bucket_key('eppn', 'user@example.com'))
+        self.assertAlmostEqual(state['tokens'], 7, places=2)
+
+    def test_over_capacity(self):
+        self.assertIsNone(over_capacity(self.limits, {'eppn': {'user@example.com': 10}, 'nin': {'190102031234': 2}}))
+        self.assertEqual(over_capacity(self.limits, {'eppn': {'user@example.com': 11}}), 'eppn')
+        self.assertEqual(over_capacity(self.limits, {'nin': {'190102031234': 3}}), 'nin')
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from se_leg_ra.static_assets import build_static
+
+__author__ = 'lundberg'
+
+
+class StaticAssetsTests(TestCase):
+
+    def setUp(self):
+        self.source_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static')
+        self.destination_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.destination_dir)
+
+    def test_build_static(self):
+        manifest = build_static(self.source_dir, self.destination_dir)
+        self.assertNotIn('css/bootstrap.min.css.map', manifest)
+        self.assertFalse(os.path.exists(os.path.join(self.destination_dir, 'css/bootstrap.min.css.map')))
+
+        hashed_css = manifest['css/bootstrap.min.css']
+        self.assertNotEqual(hashed_css, 'css/bootstrap.min.css')
+        self.assertTrue(os.path.exists(os.path.join(self.destination_dir, hashed_css + '.gz')))
+        with open(os.path.join(self.destination_dir, hashed_css)) as f:
+            css = f.read()
+        self.assertNotIn('sourceMappingURL', css)
+        self.assertIn(os.path.basename(manifest['fonts/glyphicons-halflings-regular.woff']), css)
+
+        # Same input gives the same output
+        self.assertEqual(manifest, build_static(self.source_dir, self.destination_dir))
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import os
+import tempfile
+from unittest import TestCase, skipIf
+from mock import patch
+from se_leg_ra.store import MemoryStore, SqliteStore, RedisStore
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+__author__ = 'lundberg'
+
+
+class StoreTests(object):
+    """Tests for all stores, mixed in with TestCase"""
+
+    def get_store(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        super(StoreTests, self).setUp()
+        self.store = self.get_store()
+
+    def test_get_set_delete(self):
+        self.assertIsNone(self.store.get('key'))
+        self.store.set('key', {'a': [1, 2]}, ttl=10)
+        self.assertEqual(self.store.get('key'), {'a': [1, 2]})
+        self.store.delete('key')
+        self.assertIsNone(self.store.get('key'))
+
+    def test_add(self):
+        self.assertTrue(self.store.add('key', 'first', ttl=10))
+        self.assertFalse(self.store.add('key', 'second', ttl=10))
+        self.assertEqual(self.store.get('key'), 'first')
+
+    def test_incr(self):
+        self.assertEqual(self.store.incr('counter', 1, ttl=10), 1)
+        self.assertEqual(self.store.incr('counter', 2, ttl=10), 3)
+        self.assertEqual(self.store.get('counter'), 3)
+
+    def test_cas(self):
+        self.assertTrue(self.store.cas('key', None, 'first', ttl=10))
+        self.assertFalse(self.store.cas('key', None, 'second', ttl=10))
+        self.assertFalse(self.store.cas('key', 'other', 'second', ttl=10))
+        self.assertTrue(self.store.cas('key', 'first', 'second', ttl=10))
+        self.assertEqual(self.store.get('key'), 'second')
+
+
+class LocalStoreTests(StoreTests):
+
+    def test_expiry(self):
+        self.store.set('key', 'value', ttl=-1)
+        self.assertIsNone(self.store.get('key'))
+        self.assertTrue(self.store.add('key', 'value', ttl=10))
+
+    def test_incr_expiry(self):
+        self.store.incr('counter', 1, ttl=-1)
+        self.assertEqual(self.store.incr('counter', 1, ttl=10), 1)
+
+
+class MemoryStoreTests(LocalStoreTests, TestCase):
+
+    def get_store(self):
+        return MemoryStore(max_size=2)
+
+    def test_max_size(self):
+        for key in ['a', 'b', 'c']:
+            self.store.set(key, key, ttl=10)
+        self.assertEqual(self.store.size, 2)
+        self.assertIsNone(self.store.get('a'))
+
+
+class SqliteStoreTests(LocalStoreTests, TestCase):
+
+    def get_store(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        return SqliteStore(os.path.join(self.tmp_dir.name, 'store.sqlite'), max_size=2)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        super(SqliteStoreTests, self).tearDown()
+
+    def test_shared(self):
+        other_store = SqliteStore(self.store.path)
+        self.store.set('key', 'value', ttl=10)
+        self.assertEqual(other_store.get('key'), 'value')
+        self.assertFalse(other_store.add('key', 'value', ttl=10))
+
+    def test_max_size(self):
+        with patch.object(SqliteStore, 'PRUNE_INTERVAL', 1):
+            for key in ['a', 'b', 'c']:
+                self.store.set(key, key, ttl=10)
+        self.assertEqual(len(self.store), 2)
+
+
+@skipIf(fakeredis is None, 'fakeredis not installed')
+class RedisStoreTests(StoreTests, TestCase):
+
+    def get_store(self):
+        return RedisStore(fakeredis.FakeStrictRedis(), prefix='test:')
+
+    def test_prefix(self):
+        self.store.set('key', 'value', ttl=10)
+        self.assertEqual(self.store._redis.get('test:key'), b'"value"')
+        self.assertLessEqual(self.store._redis.pttl('test:key'), 10000)
+
+    def test_size(self):
+        self.store.set('key', 'value', ttl=10)
+        self.assertIsNone(self.store.size)
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 
-import datetime
+import csv
+import json
+import time
 import requests
-from requests.auth import HTTPBasicAuth
-from flask import current_app
+from datetime import datetime
+from flask import current_app, url_for
+from se_leg_ra.metrics import count_proofing, OUTCOME_SUCCESS, OUTCOME_PENDING, OUTCOME_INVALID_QR
+from se_leg_ra.metrics import OUTCOME_OP_UNREACHABLE, OUTCOME_SAVE_FAILURE, OUTCOME_REPLAYED_QR, OUTCOME_CIRCUIT_OPEN
+from se_leg_ra.nonce_cache import opaque_nonce
 
 __author__ = 'lundberg'
 
@@ -36,6 +41,52 @@ def urlappend(base, path):
     return '{!s}{!s}'.format(base, path)
 
 
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+
+def parse_datetime(value):
+    """
+    :param value: Date or date and time in ISO 8601 format
+    :type value: str
+    :return: Parsed datetime
+    :rtype: datetime.datetime
+
+    >>> parse_datetime('2018-01-02')
+    datetime.datetime(2018, 1, 2, 0, 0)
+    >>> parse_datetime('2018-01-02T03:04:05')
+    datetime.datetime(2018, 1, 2, 3, 4, 5)
+    """
+    for fmt in DATETIME_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Invalid date: {}'.format(value))
+
+
+def load_whitelist(path):
+    """
+    Read eppns from a JSON file with a list of eppns or of objects with an eppn key, or from a CSV file with
+    the eppns in the eppn column or, without a header, in the first column.
+
+    :param path: Path to a .json or .csv file
+    :type path: str
+    :return: Eppns
+    :rtype: set
+    """
+    with open(path, encoding='utf-8', newline='') as f:
+        if path.endswith('.json'):
+            items = json.load(f)
+            eppns = [item['eppn'] if isinstance(item, dict) else item for item in items]
+        else:
+            rows = [row for row in csv.reader(f) if row]
+            column = 0
+            if rows and 'eppn' in rows[0]:
+                column = rows.pop(0).index('eppn')
+            eppns = [row[column] for row in rows if len(row) > column]
+    return {eppn.strip() for eppn in eppns if eppn.strip()}
+
+
 def log_and_send_proofing(proofing_element, identity, view_context):
     """
 
@@ -50,38 +101,189 @@ def log_and_send_proofing(proofing_element, identity, view_context):
     :return: view_context
     :rtype: dict
     """
-    vetting_endpoint = current_app.config['VETTING_ENDPOINT']
-    ra_app_secret = current_app.config['RA_APP_SECRET']
+    eppn = view_context['user']['eppn']
+    idempotency_key = view_context['form'].idempotency_key.data
+    if current_app.idempotency_cache is None or not idempotency_key:
+        return _claim_and_log(proofing_element, identity, view_context)
+
+    started, outcome = current_app.idempotency_cache.begin(eppn, idempotency_key)
+    if not started:
+        current_app.logger.info('Repeated submission of form %s', idempotency_key)
+        if outcome is None:
+            view_context['error_message'] = 'Verifieringen behandlas fortfarande. Vänligen försök igen senare.'
+        else:
+            view_context.update(outcome)
+        return view_context
+    try:
+        view_context = _claim_and_log(proofing_element, identity, view_context)
+    except Exception:
+        current_app.idempotency_cache.forget(eppn, idempotency_key)
+        raise
+    if view_context['transient_error']:
+        current_app.idempotency_cache.forget(eppn, idempotency_key)
+    else:
+        outcome = {key: view_context[key] for key in ('success_message', 'error_message', 'delivery_status_url')}
+        current_app.idempotency_cache.finish(eppn, idempotency_key, outcome)
+    return view_context
+
+
+def _claim_and_log(proofing_element, identity, view_context):
+    if not claim_nonce(proofing_element):
+        # Another request is using or has used the same QR code
+        count_proofing(proofing_element.proofing_method, OUTCOME_REPLAYED_QR)
+        view_context['error_message'] = 'Ogiltig QR-kod. Be användaren påbörja en ny verifiering.'
+        return view_context
+    try:
+        if current_app.config['VETTING_OUTBOX_ENABLED']:
+            return log_proofing_for_delivery(proofing_element, view_context)
+        return _log_and_send(proofing_element, identity, view_context)
+    except Exception:
+        release_nonce(proofing_element)
+        raise
+
+
+def _log_and_send(proofing_element, identity, view_context):
+    if not vetting_circuit_allows():
+        # The OP is failing, do not save a proofing that can not be sent
+        count_proofing(proofing_element.proofing_method, OUTCOME_CIRCUIT_OPEN)
+        release_nonce(proofing_element)
+        view_context['transient_error'] = True
+        view_context['error_message'] = 'Ingen kontakt med verifieringstjänsten. Vänligen försök igen senare.'
+        return view_context
     if current_app.proofing_log.save(proofing_element):
         current_app.logger.info('Saved proofing element.')
-        current_app.logger.debug('{}'.format(proofing_element))
-        try:
-            data = {
-                'identity': identity,
-                'qrcode': proofing_element.opaque,
-                'meta': {
-                    'ocular_validation': proofing_element.ocular_validation,
-                    'expiry_date': proofing_element.expiry_date.timestamp(),
-                    'document_identifier': proofing_element.document_identifier,
-                    'proofing_method': proofing_element.proofing_method,
-                    'proofing_version': proofing_element.proofing_version
-                }
-            }
-            r = requests.post(vetting_endpoint, json=data,
-                              auth=HTTPBasicAuth(proofing_element.created_by, ra_app_secret))
-            if r.status_code != 200:
-                current_app.logger.error('Bad request to vetting endpoint: {}'.format(r.content))
-                # The nonce is invalid or expired
-                view_context['error_message'] = 'Ogiltig QR-kod. Be användaren påbörja en ny verifiering.'
-                return view_context
-        except requests.RequestException as e:
-            current_app.logger.error('Could not reach the vetting endpoint: {}'.format(e))
-            # Could not contact the op
+        current_app.logger.debug('%s', proofing_element)
+        outcome = send_proofing(proofing_element, identity)
+        if outcome == OUTCOME_OP_UNREACHABLE:
+            # Could not contact the op, the QR code can be used again
+            release_nonce(proofing_element)
+            view_context['transient_error'] = True
             view_context['error_message'] = 'Ingen kontakt med verifieringstjänsten. Vänligen försök igen senare.'
             return view_context
+        if outcome == OUTCOME_INVALID_QR:
+            # The nonce is invalid or expired
+            view_context['error_message'] = 'Ogiltig QR-kod. Be användaren påbörja en ny verifiering.'
+            return view_context
         # Everything went well
         view_context['success_message'] = 'Verifiering mottagen.'
         return view_context
     # Could not save the proofing
+    count_proofing(proofing_element.proofing_method, OUTCOME_SAVE_FAILURE)
+    release_nonce(proofing_element)
+    release_vetting_circuit()
+    view_context['transient_error'] = True
     view_context['error_message'] = 'Tillfälligt tekniskt fel. Vänligen försök igen senare.'
     return view_context
+
+
+def vetting_circuit_allows():
+    """
+    :return: False if proofings should fail fast as the vetting endpoint is failing
+    :rtype: bool
+    """
+    circuit_breaker = current_app.vetting_circuit_breaker
+    if circuit_breaker is None or circuit_breaker.allow():
+        return True
+    current_app.logger.warning('Vetting endpoint circuit is open')
+    return False
+
+
+def release_vetting_circuit():
+    """
+    Call when a proofing allowed by vetting_circuit_allows is never sent.
+    """
+    if current_app.vetting_circuit_breaker is not None:
+        current_app.vetting_circuit_breaker.release()
+
+
+def send_proofing(proofing_element, identity):
+    """
+    Send a saved proofing to the vetting endpoint, call vetting_circuit_allows first.
+
+    :param proofing_element: Proofing data that should be sent
+    :param identity: Proofed identity
+
+    :type proofing_element: ProofingLogElement
+    :type identity: six.string_types
+
+    :return: OUTCOME_SUCCESS, OUTCOME_INVALID_QR or OUTCOME_OP_UNREACHABLE
+    :rtype: str
+    """
+    outcome = _send_proofing(proofing_element, identity)
+    count_proofing(proofing_element.proofing_method, outcome)
+    if current_app.proofing_stats is not None:
+        current_app.proofing_stats.increment([proofing_element.to_dict()], outcome)
+    return outcome
+
+
+def _send_proofing(proofing_element, identity):
+    circuit_breaker = current_app.vetting_circuit_breaker
+    start = time.monotonic()
+    try:
+        r = current_app.vetting_client.send(proofing_element, identity)
+    except requests.RequestException as e:
+        current_app.logger.error('Could not reach the vetting endpoint: %s', e)
+        if circuit_breaker is not None:
+            circuit_breaker.record_failure()
+        return OUTCOME_OP_UNREACHABLE
+    if circuit_breaker is not None:
+        if r.status_code >= 500:
+            circuit_breaker.record_failure()
+        else:
+            circuit_breaker.record_success(time.monotonic() - start)
+    if r.status_code != 200:
+        current_app.logger.error('Bad request to vetting endpoint: %s', r.content)
+        return OUTCOME_INVALID_QR
+    return OUTCOME_SUCCESS
+
+
+def claim_nonce(proofing_element):
+    """
+    :param proofing_element: Proofing data
+    :type proofing_element: ProofingLogElement
+    :return: False if the QR code nonce already is claimed
+    :rtype: bool
+    """
+    nonce = opaque_nonce(proofing_element.opaque)
+    if current_app.nonce_cache is None or nonce is None:
+        return True
+    return current_app.nonce_cache.claim(nonce)
+
+
+def release_nonce(proofing_element):
+    """
+    :param proofing_element: Proofing data
+    :type proofing_element: ProofingLogElement
+    """
+    nonce = opaque_nonce(proofing_element.opaque)
+    if current_app.nonce_cache is not None and nonce is not None:
+        current_app.nonce_cache.release(nonce)
+
+
+def log_proofing_for_delivery(proofing_element, view_context):
+    """
+    Save the proofing and leave the delivery to the outbox worker.
+
+    :param proofing_element: Proofing data that should be logged
+    :param view_context: Data for the view template
+
+    :type: ProofingLogElement
+    :type view_context: dict
+
+    :return: view_context
+    :rtype: dict
+    """
+    proofing_id = current_app.proofing_log.save_for_delivery(proofing_element)
+    if proofing_id is None:
+        # Could not save the proofing
+        count_proofing(proofing_element.proofing_method, OUTCOME_SAVE_FAILURE)
+        release_nonce(proofing_element)
+        view_context['transient_error'] = True
+        view_context['error_message'] = 'Tillfälligt tekniskt fel. Vänligen försök igen senare.'
+        return view_context
+    current_app.logger.info('Saved proofing element %s for delivery.', proofing_id)
+    count_proofing(proofing_element.proofing_method, OUTCOME_PENDING)
+    current_app.logger.debug('%s', proofing_element)
+    view_context['success_message'] = 'Verifiering sparad.'
+    view_context['delivery_status_url'] = url_for('se_leg_ra.delivery_status', proofing_id=str(proofing_id))
+    return view_context
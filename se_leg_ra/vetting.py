@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import time
+import requests
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from requests.packages.urllib3.util.retry import Retry
+from se_leg_ra.metrics import VETTING_REQUEST_SECONDS
+
+__author__ = 'lundberg'
+
+
+def vetting_data(proofing_element, identity):
+    """
+    :param proofing_element: Proofing data that should be sent
+    :param identity: Proofed identity
+
+    :type proofing_element: se_leg_ra.db.ProofingLogElement
+    :type identity: six.string_types
+
+    :return: Vetting result in the format the OP expects
+    :rtype: dict
+    """
+    return {
+        'identity': identity,
+        'qrcode': proofing_element.opaque,
+        'meta': {
+            'ocular_validation': proofing_element.ocular_validation,
+            'expiry_date': proofing_element.expiry_date.timestamp(),
+            'document_identifier': proofing_element.document_identifier,
+            'proofing_method': proofing_element.proofing_method,
+            'proofing_version': proofing_element.proofing_version
+        }
+    }
+
+
+class VettingClient(object):
+    """
+    HTTP client for the OP vetting endpoint, keeps connections open between calls.
+
+    Only failures to connect are retried as the request never reached the OP and
+    a retry can not result in the vetting result being received twice.
+    """
+
+    def __init__(self, endpoint, app_secret, connect_timeout=3.05, read_timeout=10, retries=2, backoff_factor=0.2,
+                 pool_connections=1, pool_maxsize=10):
+        """
+        :param endpoint: Vetting endpoint URL
+        :param app_secret: RA app secret used for authentication
+        :param connect_timeout: Seconds to wait for a connection
+        :param read_timeout: Seconds to wait for a response
+        :param retries: Number of retries of failed connection attempts
+        :param backoff_factor: Backoff factor between retries
+        :param pool_connections: Number of connection pools to cache
+        :param pool_maxsize: Max number of connections to keep open per pool
+
+        :type endpoint: six.string_types
+        :type app_secret: six.string_types
+        :type connect_timeout: float
+        :type read_timeout: float
+        :type retries: int
+        :type backoff_factor: float
+        :type pool_connections: int
+        :type pool_maxsize: int
+        """
+        self.endpoint = endpoint
+        self.app_secret = app_secret
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(total=retries, connect=retries, read=0, redirect=0, status=0, backoff_factor=backoff_factor,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __repr__(self):
+        return '<se-leg {!s}: {!s}>'.format(self.__class__.__name__, self.endpoint)
+
+    def send(self, proofing_element, identity):
+        """
+        :param proofing_element: Proofing data that should be sent
+        :param identity: Proofed identity
+
+        :type proofing_element: se_leg_ra.db.ProofingLogElement
+        :type identity: six.string_types
+
+        :return: OP response
+        :rtype: requests.Response
+
+        :raises requests.RequestException: if the OP could not be reached
+        """
+        data = vetting_data(proofing_element, identity)
+        auth = HTTPBasicAuth(proofing_element.created_by, self.app_secret)
+        start = time.monotonic()
+        try:
+            return self.session.post(self.endpoint, json=data, auth=auth, timeout=self.timeout)
+        finally:
+            elapsed = time.monotonic() - start
+            VETTING_REQUEST_SECONDS.observe(elapsed)
+            current_app.logger.info('Vetting endpoint call took %.1f ms', elapsed * 1000)
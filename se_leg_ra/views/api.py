@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import Blueprint, current_app, request, jsonify, abort, url_for
+from werkzeug.datastructures import MultiDict
+from se_leg_ra.forms import DriversLicenseForm, IdCardForm, PassportForm, NationalIDCardForm
+from se_leg_ra.decorators import require_eppn
+from se_leg_ra.ratelimit import check_rate_limits, request_costs, over_capacity
+from se_leg_ra.db import IdCardProofing, DriversLicenseProofing, PassportProofing, NationalIdCardProofing
+from se_leg_ra.utils import claim_nonce, release_nonce, send_proofing
+from se_leg_ra.utils import vetting_circuit_allows, release_vetting_circuit
+from se_leg_ra.metrics import count_proofing, OUTCOME_PENDING, OUTCOME_SAVE_FAILURE, OUTCOME_REPLAYED_QR
+from se_leg_ra.metrics import OUTCOME_OP_UNREACHABLE, OUTCOME_INVALID_QR, OUTCOME_CIRCUIT_OPEN
+
+__author__ = 'lundberg'
+
+
+api_views = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Proofing method to form, proofing log element and document identifier field
+PROOFING_TYPES = {
+    'drivers_license': (DriversLicenseForm, DriversLicenseProofing, 'reference_number'),
+    'id_card': (IdCardForm, IdCardProofing, 'card_number'),
+    'passport': (PassportForm, PassportProofing, 'passport_number'),
+    'national_id_card': (NationalIDCardForm, NationalIdCardProofing, 'card_number'),
+}
+
+# Result statuses, only proofings with status op_unreachable or save_failure should be submitted again
+STATUS_INVALID = 'invalid'
+STATUS_REPLAYED = 'replayed'
+STATUS_SAVE_FAILURE = 'save_failure'
+STATUS_OP_UNREACHABLE = 'op_unreachable'
+STATUS_REJECTED = 'rejected'
+STATUS_PENDING = 'pending'
+STATUS_SENT = 'sent'
+
+
+def _formdata(item):
+    formdata = MultiDict()
+    for key, value in item.items():
+        if value is True:
+            formdata[key] = 'y'
+        elif value is not None and value is not False:
+            formdata[key] = str(value)
+    return formdata
+
+
+def _validate(item, user):
+    """
+    :return: Proofing log element and None, or None and validation errors
+    :rtype: (se_leg_ra.db.ProofingLogElement | None, dict | None)
+    """
+    if not isinstance(item, dict) or item.get('proofing_method') not in PROOFING_TYPES:
+        return None, {'proofing_method': ['Unknown proofing method']}
+    form_cls, element_cls, identifier_field = PROOFING_TYPES[item['proofing_method']]
+    form = form_cls(formdata=_formdata(item), meta={'csrf': False})
+    if not form.validate():
+        return None, form.errors
+    proofing_element = element_cls(current_app.config['RA_APP_ID'], user['eppn'], form.nin.data,
+                                   getattr(form, identifier_field).data, form.qr_code.data,
+                                   form.ocular_validation.data, form.expiry_date.data, '2018v1')
+    return proofing_element, None
+
+
+def _deliver(app, proofing_element):
+    with app.app_context():
+        return send_proofing(proofing_element, proofing_element.identity)
+
+
+@api_views.route('/proofings', methods=['POST'])
+@require_eppn
+def proofings(user):
+    """
+    Request body: a JSON array of proofings, every proofing has the fields of the form for its proofing_method
+    (drivers_license, id_card, passport or national_id_card) with expiry_date as YYYY-MM-DD.
+
+    Response: a result with a status per proofing, in the order of the request.
+    """
+    # Only JSON, forms posted cross-site can not have this content type
+    if request.mimetype != 'application/json':
+        abort(415)
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not items:
+        abort(400)
+    if len(items) > current_app.config['API_MAX_BATCH_SIZE']:
+        abort(413)
+    # Every proofing costs as much as a form submission
+    costs = request_costs(cost=len(items))
+    costs['nin'] = Counter(str(item['nin']) for item in items if isinstance(item, dict) and item.get('nin'))
+    if current_app.config['RATE_LIMIT_ENABLED']:
+        limit = over_capacity(current_app.config['RATE_LIMITS'], costs)
+        if limit is not None:
+            # Retrying can never help, the batch has to be split
+            current_app.logger.info('Batch of %s proofings is over the %s rate limit capacity', len(items), limit)
+            abort(413)
+    retry_after = check_rate_limits(costs)
+    if retry_after is not None:
+        response = jsonify({'error': 'rate_limited', 'retry_after': retry_after})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+    current_app.logger.info('%s submitted %s proofings', user['eppn'], len(items))
+
+    results = [{'index': index} for index in range(len(items))]
+    proofing_elements = []
+    for result, item in zip(results, items):
+        proofing_element, errors = _validate(item, user)
+        if errors:
+            result.update(status=STATUS_INVALID, errors=errors)
+        elif not claim_nonce(proofing_element):
+            count_proofing(proofing_element.proofing_method, OUTCOME_REPLAYED_QR)
+            result['status'] = STATUS_REPLAYED
+        elif not current_app.config['VETTING_OUTBOX_ENABLED'] and not vetting_circuit_allows():
+            count_proofing(proofing_element.proofing_method, OUTCOME_CIRCUIT_OPEN)
+            release_nonce(proofing_element)
+            result['status'] = STATUS_OP_UNREACHABLE
+        else:
+            proofing_elements.append((result, proofing_element))
+    if not proofing_elements:
+        return jsonify({'results': results})
+
+    outbox = current_app.config['VETTING_OUTBOX_ENABLED']
+    try:
+        ids = current_app.proofing_log.save_many([element for _, element in proofing_elements], for_delivery=outbox)
+    except Exception:
+        for _, proofing_element in proofing_elements:
+            release_nonce(proofing_element)
+        if not outbox:
+            release_vetting_circuit()
+        raise
+    saved = []
+    for (result, proofing_element), proofing_id in zip(proofing_elements, ids):
+        if proofing_id is None:
+            count_proofing(proofing_element.proofing_method, OUTCOME_SAVE_FAILURE)
+            release_nonce(proofing_element)
+            if not outbox:
+                # The proofing might have been allowed as the probe of a half open circuit
+                release_vetting_circuit()
+            result['status'] = STATUS_SAVE_FAILURE
+            continue
+        result['id'] = str(proofing_id)
+        if outbox:
+            count_proofing(proofing_element.proofing_method, OUTCOME_PENDING)
+            result['status'] = STATUS_PENDING
+            result['delivery_status_url'] = url_for('se_leg_ra.delivery_status', proofing_id=str(proofing_id))
+        else:
+            saved.append((result, proofing_element))
+    current_app.logger.info('Saved %s proofings', len(ids) - ids.count(None))
+
+    if saved:
+        app = current_app._get_current_object()
+        max_workers = min(current_app.config['API_DELIVERY_CONCURRENCY'], len(saved))
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = [executor.submit(_deliver, app, proofing_element) for _, proofing_element in saved]
+        # Answer before the worker is killed, proofings still waiting for the OP are given up
+        wait(futures, timeout=current_app.config['API_DELIVERY_DEADLINE'])
+        executor.shutdown(wait=False)
+        for (result, proofing_element), future in zip(saved, futures):
+            if future.done():
+                outcome = future.result()
+            elif future.cancel():
+                # Never sent
+                count_proofing(proofing_element.proofing_method, OUTCOME_OP_UNREACHABLE)
+                release_vetting_circuit()
+                outcome = OUTCOME_OP_UNREACHABLE
+            else:
+                current_app.logger.warning('Delivery deadline passed while sending proofing %s', result['id'])
+                outcome = OUTCOME_OP_UNREACHABLE
+            if outcome == OUTCOME_OP_UNREACHABLE:
+                # The QR code can be used again
+                release_nonce(proofing_element)
+                result['status'] = STATUS_OP_UNREACHABLE
+            elif outcome == OUTCOME_INVALID_QR:
+                # The nonce is invalid or expired
+                result['status'] = STATUS_REJECTED
+            else:
+                result['status'] = STATUS_SENT
+    return jsonify({'results': results})
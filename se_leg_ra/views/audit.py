@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import Blueprint, current_app, request, jsonify, abort, Response
+from se_leg_ra.decorators import require_eppn, require_auditor
+from se_leg_ra.utils import parse_datetime
+from se_leg_ra.export import export_stream, EXPORT_FORMATS, MASKABLE_FIELDS
+from se_leg_ra.db import STATS_DAY_FORMAT
+
+__author__ = 'lundberg'
+
+
+audit_views = Blueprint('audit', __name__, url_prefix='/audit')
+
+
+def _get_datetime(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return parse_datetime(value)
+    except ValueError:
+        abort(400)
+
+
+def _get_bool(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    if value not in ('true', 'false'):
+        abort(400)
+    return value == 'true'
+
+
+def _get_object_id(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        abort(400)
+
+
+def _to_json(doc):
+    res = {}
+    for key, value in doc.items():
+        if key == '_id':
+            res['id'] = str(value)
+        elif key == 'delivery':
+            res['delivery_status'] = value.get('status')
+        elif isinstance(value, datetime):
+            res[key] = value.isoformat()
+        else:
+            res[key] = value
+    return res
+
+
+@audit_views.route('/proofings', methods=['GET'])
+@require_eppn
+@require_auditor
+def proofings(user):
+    """
+    Query parameters: verified_by, nin, proofing_method, ocular_validation (true/false), created_after and
+    created_before (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS, UTC), limit and cursor (next_cursor of the previous page).
+    """
+    try:
+        limit = int(request.args.get('limit', current_app.config['AUDIT_PAGE_SIZE']))
+    except ValueError:
+        abort(400)
+    if not 0 < limit <= current_app.config['AUDIT_MAX_PAGE_SIZE']:
+        abort(400)
+
+    current_app.logger.info('%s queried the proofing log: %s', user['eppn'], request.args.to_dict())
+    docs, next_id = current_app.proofing_log.find_proofings(verified_by=request.args.get('verified_by') or None,
+                                                            nin=request.args.get('nin') or None,
+                                                            proofing_method=request.args.get('proofing_method') or None,
+                                                            ocular_validation=_get_bool('ocular_validation'),
+                                                            created_after=_get_datetime('created_after'),
+                                                            created_before=_get_datetime('created_before'),
+                                                            before_id=_get_object_id('cursor'), limit=limit)
+    return jsonify({
+        'proofings': [_to_json(doc) for doc in docs],
+        'next_cursor': str(next_id) if next_id else None,
+    })
+
+
+@audit_views.route('/export', methods=['GET'])
+@require_eppn
+@require_auditor
+def export(user):
+    """
+    Query parameters: format (ndjson or csv), gzip (true/false), mask (repeatable), created_after, created_before
+    and after_id (id of the last proofing of a previous export that was cut off after AUDIT_EXPORT_MAX_DOCS).
+    """
+    fmt = request.args.get('format', 'ndjson')
+    mask = request.args.getlist('mask')
+    if fmt not in EXPORT_FORMATS or not set(mask).issubset(MASKABLE_FIELDS):
+        abort(400)
+    compress = bool(_get_bool('gzip'))
+
+    current_app.logger.info('%s exported the proofing log: %s', user['eppn'], request.args.to_dict())
+    # Read everything from the request before the response is streamed
+    chunks = export_stream(current_app.proofing_log, fmt=fmt, compress=compress,
+                           max_docs=current_app.config['AUDIT_EXPORT_MAX_DOCS'], mask=mask,
+                           created_after=_get_datetime('created_after'),
+                           created_before=_get_datetime('created_before'),
+                           after_id=_get_object_id('after_id'),
+                           batch_size=current_app.config['AUDIT_EXPORT_BATCH_SIZE'])
+    filename = 'proofing_log.{}{}'.format(fmt, '.gz' if compress else '')
+    mimetype = 'application/gzip' if compress else {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}[fmt]
+    return Response(chunks, mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
+
+
+@audit_views.route('/stats', methods=['GET'])
+@require_eppn
+@require_auditor
+def stats(user):
+    """
+    Query parameters: first_day and last_day (YYYY-MM-DD, UTC, the last 30 days if not set), verified_by and
+    proofing_method.
+    """
+    if current_app.proofing_stats is None:
+        abort(404)
+    last_day = _get_datetime('last_day') or datetime.utcnow()
+    first_day = _get_datetime('first_day') or last_day - timedelta(days=29)
+    if not 0 <= (last_day - first_day).days < current_app.config['AUDIT_STATS_MAX_DAYS']:
+        abort(400)
+
+    counts = current_app.proofing_stats.find_counts(first_day.strftime(STATS_DAY_FORMAT),
+                                                    last_day.strftime(STATS_DAY_FORMAT),
+                                                    verified_by=request.args.get('verified_by') or None,
+                                                    proofing_method=request.args.get('proofing_method') or None)
+    totals = {}
+    for doc in counts:
+        for outcome, count in doc['counts'].items():
+            totals[outcome] = totals.get(outcome, 0) + count
+    return jsonify({
+        'first_day': first_day.strftime(STATS_DAY_FORMAT),
+        'last_day': last_day.strftime(STATS_DAY_FORMAT),
+        'counts': counts,
+        'totals': totals,
+    })
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 
-from flask import Blueprint, current_app, render_template, url_for, request, redirect
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import Blueprint, current_app, url_for, request, redirect, jsonify, abort
 from se_leg_ra.forms import DriversLicenseForm, IdCardForm, PassportForm, NationalIDCardForm
-from se_leg_ra.decorators import require_eppn
+from se_leg_ra.decorators import require_eppn, rate_limited
 from se_leg_ra.db import IdCardProofing, DriversLicenseProofing, PassportProofing, NationalIdCardProofing
 from se_leg_ra.utils import log_and_send_proofing
+from se_leg_ra.metrics import render_template
 
 __author__ = 'lundberg'
 
@@ -17,7 +20,12 @@ def get_view_context(form, user):
         'action_url': request.path,
         'user': user,
         'success_message': None,
-        'error_message': None
+        'error_message': None,
+        'delivery_status_url': None,
+        # Set if the proofing failed for a reason that may go away on a retry
+        'transient_error': False,
+        # Rendered form fields are cached for unsubmitted forms
+        'fragment_key': None if form.is_submitted() else form.__class__.__name__
     }
     return view_context
 
@@ -40,6 +48,7 @@ def login():
 
 
 @se_leg_ra_views.route('/id-card', methods=['GET', 'POST'])
+@rate_limited
 @require_eppn
 def id_card(user):
     form = IdCardForm()
@@ -54,7 +63,7 @@ def id_card(user):
             'expiry_date': form.expiry_date.data,
             'ocular_validation': form.ocular_validation.data
         }
-        current_app.logger.debug('Form data: {}'.format(data))
+        current_app.logger.debug('Form data: %s', data)
         # Log the vetting attempt
         proofing_element = IdCardProofing(current_app.config['RA_APP_ID'], user['eppn'], data['nin'],
                                           data['card_number'], data['qr_code'], data['ocular_validation'],
@@ -65,6 +74,7 @@ def id_card(user):
 
 
 @se_leg_ra_views.route('/drivers-license', methods=['GET', 'POST'])
+@rate_limited
 @require_eppn
 def drivers_license(user):
     form = DriversLicenseForm()
@@ -78,7 +88,7 @@ def drivers_license(user):
             'expiry_date': form.expiry_date.data,
             'ocular_validation': form.ocular_validation.data
         }
-        current_app.logger.debug('Form data: {}'.format(data))
+        current_app.logger.debug('Form data: %s', data)
         # Log the vetting attempt
         proofing_element = DriversLicenseProofing(current_app.config['RA_APP_ID'], user['eppn'], data['nin'],
                                                   data['reference_number'], data['qr_code'], data['ocular_validation'],
@@ -89,6 +99,7 @@ def drivers_license(user):
 
 
 @se_leg_ra_views.route('/passport', methods=['GET', 'POST'])
+@rate_limited
 @require_eppn
 def passport(user):
     form = PassportForm()
@@ -102,7 +113,7 @@ def passport(user):
             'passport_number': form.passport_number.data,
             'ocular_validation': form.ocular_validation.data
         }
-        current_app.logger.debug('Form data: {}'.format(data))
+        current_app.logger.debug('Form data: %s', data)
         # Log the vetting attempt
         proofing_element = PassportProofing(current_app.config['RA_APP_ID'], user['eppn'], data['nin'],
                                             data['passport_number'], data['qr_code'], data['ocular_validation'],
@@ -113,6 +124,7 @@ def passport(user):
 
 
 @se_leg_ra_views.route('/national-id-card', methods=['GET', 'POST'])
+@rate_limited
 @require_eppn
 def national_id_card(user):
     form = NationalIDCardForm()
@@ -126,7 +138,7 @@ def national_id_card(user):
             'card_number': form.card_number.data,
             'ocular_validation': form.ocular_validation.data
         }
-        current_app.logger.debug('Form data: {}'.format(data))
+        current_app.logger.debug('Form data: %s', data)
         # Log the vetting attempt
         proofing_element = NationalIdCardProofing(current_app.config['RA_APP_ID'], user['eppn'], data['nin'],
                                                   data['card_number'], data['qr_code'],
@@ -136,8 +148,21 @@ def national_id_card(user):
     return render_template('national_id_card.jinja2', view_context=view_context)
 
 
+@se_leg_ra_views.route('/delivery-status/<proofing_id>', methods=['GET'])
+@require_eppn
+def delivery_status(user, proofing_id):
+    try:
+        proofing_id = ObjectId(proofing_id)
+    except InvalidId:
+        abort(404)
+    delivery = current_app.proofing_log.get_delivery(proofing_id, verified_by=user['eppn'])
+    if delivery is None:
+        abort(404)
+    return jsonify({'status': delivery['status'], 'attempts': delivery['attempts']})
+
+
 @se_leg_ra_views.route('/logout', methods=['GET'])
 @require_eppn
 def logout(user):
-    current_app.logger.info('User {} logged out'.format(user['eppn']))
+    current_app.logger.info('User %s logged out', user['eppn'])
     return redirect(current_app.config['LOGOUT_URL'])
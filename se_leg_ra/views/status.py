@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
-from flask import Blueprint, current_app, jsonify
+from flask import Blueprint, current_app, jsonify, Response
+from se_leg_ra.metrics import generate_metrics
+from se_leg_ra.health import check_health
 
 __author__ = 'lundberg'
 
@@ -8,22 +10,41 @@ __author__ = 'lundberg'
 status_views = Blueprint('status', __name__, url_prefix='/status')
 
 
-def _check_mongo():
-    db = current_app.user_db
-    try:
-        return db.is_healthy()
-    except Exception as exc:
-        current_app.logger.warning('Mongodb health check failed: {}'.format(exc))
-        return False
-
-
 @status_views.route('/healthy', methods=['GET'])
 def health_check():
-    res = {'status': 'STATUS_FAIL'}
-    if not _check_mongo():
-        res['reason'] = 'mongodb check failed'
-        current_app.logger.warning('mongodb check failed')
+    if current_app.health_prober is not None:
+        res = current_app.health_prober.status
     else:
-        res['status'] = 'STATUS_OK'
-        res['reason'] = 'Databases tested OK'
+        res = check_health(current_app)
+    return jsonify(res)
+
+
+@status_views.route('/alive', methods=['GET'])
+def liveness_check():
+    # Never touches any dependencies
+    return jsonify({'status': 'STATUS_OK'})
+
+
+@status_views.route('/cache', methods=['GET'])
+def cache_stats():
+    res = {
+        'whitelist': current_app.user_db.whitelist_cache.stats,
+        'store': {'size': current_app.store.size, 'max_size': current_app.store.max_size},
+    }
+    if current_app.nonce_cache is not None:
+        res['qr_nonce'] = current_app.nonce_cache.stats
+    return jsonify(res)
+
+
+@status_views.route('/circuit-breaker', methods=['GET'])
+def circuit_breaker_stats():
+    res = {}
+    if current_app.vetting_circuit_breaker is not None:
+        res['vetting'] = current_app.vetting_circuit_breaker.stats
     return jsonify(res)
+
+
+@status_views.route('/metrics', methods=['GET'])
+def metrics():
+    data, content_type = generate_metrics()
+    return Response(data, content_type=content_type)